@@ -4,7 +4,17 @@ import matplotlib
 import numpy as np
 import time
 import subprocess
-from audioSocket import DataSocket
+import threading
+import audioProtocol as proto
+from audioAcquisition import AcquisitionThread
+from audioRecording import ReplaySocket
+from audioAnalysis import SpectrumProcessor, pixelBins, minMaxBin
+from audioDistortion import analyzeDistortion, coherentFrequency, HarmonicTracker
+from audioTransfer import TransferAnalyzer, crosstalk
+from audioZoom import ZoomProcessor
+from audioWaterfall import Waterfall, FLOOR
+from audioStats import PipelineStats, formatStats
+import audioSweep
 
 matplotlib.use('Qt5Agg')
 
@@ -13,10 +23,22 @@ from PyQt5 import QtCore, QtWidgets
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
 from matplotlib.figure import Figure
-from scipy.signal.windows import hann, hamming, kaiser, blackman
+from matplotlib import ticker
 
 kaiserBeta = 5
 
+# Full scale of the int32 samples from the server
+FULLSCALE = 2**31
+
+# FFT size of the zoom mode, the resolution is fs / (decimation * ZOOMSIZE)
+ZOOMSIZE = 4096
+
+# Rows and columns of the waterfall, and the least time per row. Faster
+# blocks are merged into one row by their peak.
+WATERFALLROWS = 256
+WATERFALLCOLUMNS = 1024
+WATERFALLROWTIME = 0.02
+
 # Widgets for:
 # Signal frequency: textbox
 # Min frequency: textbox
@@ -34,6 +56,35 @@ kaiserBeta = 5
 
 
 
+def measurementText(measurements):
+    
+    # One line per channel, and the transfer function at the fundamental
+    # relative to the first channel for the others
+    if 'THD' not in measurements[0]:
+        # Zoom mode only finds the largest peak
+        return "\n".join("Ch {0}: Peak {1:.3f} Hz  {2:.1f} dB".format(
+            c + 1, m['Fundamental'], 20 * np.log10(m['Amplitude'] + np.finfo(float).eps))
+            for c, m in enumerate(measurements))
+    
+    if len(measurements) == 1:
+        m = measurements[0]
+        return "THD: {0:.4f}%\nTHD+N: {1:.4f}%\nNoise: {2:.1f} dB".format(
+            m['THD'], m['THD+N'], m['Noise'])
+    
+    lines = []
+    for c, m in enumerate(measurements):
+        lines.append("Ch {0}: THD {1:.4f}%  THD+N {2:.4f}%  Noise {3:.1f} dB".format(
+            c + 1, m['THD'], m['THD+N'], m['Noise']))
+        if c > 0 and 'Coherence' in m:
+            lines.append("      Gain {0:.2f} dB  Phase {1:.1f}°  Coherence {2:.3f}  "
+                         "Crosstalk {3:.1f} dB".format(m['Gain'], m['Phase'], m['Coherence'],
+                                                       m['Crosstalk']))
+        elif c > 0:
+            lines.append("      Gain {0:.2f} dB  Phase {1:.1f}°".format(m['Gain'], m['Phase']))
+    
+    return "\n".join(lines)
+
+
 class MplCanvas(FigureCanvas):
 
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -41,47 +92,192 @@ class MplCanvas(FigureCanvas):
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = self.fig.add_subplot(111)
         self.lines = None
+        self.background = None
+        self.waterfall = None
+        self.waterfallImage = None
         
         super(MplCanvas, self).__init__(self.fig)
         
-    def initPlot(self, xData, yData, frequencyRange):
+        # Axes, grid and labels are only rendered on full redraws, after a
+        # resize or zoom for instance, and cached. Every frame after that
+        # restores the cache and draws just the changing artists.
+        self.mpl_connect('draw_event', self.onDraw)
         
-        self.lines = self.axes.semilogx(xData, 20.0 * np.log10(yData + np.finfo(float).eps))
+    def initPlot(self, xData, yData, frequencyRange, log=True, waterfall=None, rowTime=0):
         
-        self.hLines = []
-        self.maxHLines = 100
-        for i in range(self.maxHLines):
-            l = self.axes.semilogx(1, 1, 'ro')
-            self.hLines.append(l[0])
+        # The waterfall gets its own axes below the spectrum
+        self.fig.clear()
+        self.waterfall = waterfall
+        if waterfall is None:
+            self.axes = self.fig.add_subplot(111)
+            self.waterfallImage = None
+        else:
+            self.axes, waterfallAxes = self.fig.subplots(2, 1,
+                                                         gridspec_kw={'height_ratios': (2, 1)})
+            self.initWaterfall(waterfallAxes, frequencyRange, log, rowTime)
+        
+        # One line per channel
+        self.lines = []
+        for row in np.atleast_2d(yData):
+            self.lines += self.axes.semilogx(xData, 20.0 * np.log10(row + np.finfo(float).eps),
+                                             animated=True)
+        
+        # All harmonics in one artist
+        self.harmonicMarkers = self.axes.scatter([], [], s=36, c='r', zorder=3, animated=True)
             
+        if not log:
+            self.axes.set_xscale('linear')
         self.axes.axis((frequencyRange[0], frequencyRange[1], -140,5)) # Change
         self.axes.yaxis.grid(True)
         self.axes.xaxis.grid(True)
         self.axes.set_xlabel('Frequency [Hz]')
         self.axes.set_ylabel('Relative magnitude [dB]')
         
-        t = "THD: {0:.4f}%\nNoise: {1:.1f} dB".format(0, -200)
-        self.thdText = self.axes.text(frequencyRange[0]*1.1,-10, t)
+        t = "THD: {0:.4f}%\nTHD+N: {1:.4f}%\nNoise: {2:.1f} dB".format(0, 0, -200)
+        if log:
+            x = frequencyRange[0]*1.1
+        else:
+            x = frequencyRange[0] + 0.02 * (frequencyRange[1] - frequencyRange[0])
+        self.thdText = self.axes.text(x,-10, t, animated=True)
         self.thdText.set_bbox(dict(facecolor='white'))
         
+        self.statsText = self.axes.text(0.99, 0.01, '', transform=self.axes.transAxes,
+                                        ha='right', va='bottom', family='monospace',
+                                        fontsize='small', visible=False, animated=True)
+        self.statsText.set_bbox(dict(facecolor='white', alpha=0.8))
+        
         self.fig.tight_layout(pad=1)
+        self.background = None
+        self.draw_idle()
+        
+    def initWaterfall(self, axes, frequencyRange, log, rowTime):
+        
+        # Columns are evenly spaced on the frequency axis already, so the
+        # image is drawn on a column axis labelled with frequencies. The
+        # newest row is at the top.
+        waterfall = self.waterfall
+        self.waterfallCount = waterfall.count
+        self.waterfallImage = axes.imshow(waterfall.image(), aspect='auto', origin='lower',
+                                          interpolation='nearest', vmin=FLOOR, vmax=0,
+                                          extent=(0, waterfall.columns,
+                                                  -waterfall.rows * rowTime, 0),
+                                          animated=True)
+        if log:
+            locator = ticker.LogLocator()
+        else:
+            locator = ticker.MaxNLocator(8)
+        ticks = [f for f in locator.tick_values(*frequencyRange)
+                 if waterfall.edges[0] <= f <= waterfall.edges[-1]]
+        axes.set_xticks(waterfall.column(np.array(ticks)))
+        axes.set_xticklabels(["{0:g}".format(f) for f in ticks])
+        axes.set_xlabel('Frequency [Hz]')
+        axes.set_ylabel('Time [s]')
+        
+    def updateWaterfall(self):
+        
+        # Without a new row the cached image is drawn again as it is
+        if self.waterfallImage is not None and self.waterfall.count != self.waterfallCount:
+            self.waterfallCount = self.waterfall.count
+            self.waterfallImage.set_data(self.waterfall.image())
         
     def updatePlot(self, xData, yData, measurementData, frequencyRange, harmonics):
         
+        # Reduce the spectrum to a min/max pair per pixel column of the
+        # visible frequency range, so the cost does not grow with the FFT.
+        # Zoom spectra do not start at 0 Hz and are small enough as they are.
+        yData = np.atleast_2d(yData)
+        fmin, fmax = self.axes.get_xlim()
+        starts, stop, x = pixelBins(yData.shape[-1], 2 * xData[-1], fmin, fmax,
+                                    max(int(self.axes.bbox.width), 1),
+                                    self.axes.get_xscale() == 'log')
+        
         if not self.lines is None:
-            for column,line in enumerate(self.lines):
-                line.set_ydata(20.0 * np.log10(yData + np.finfo(float).eps))
-                
-        if (not self.hLines is None) and (not harmonics is None):
-            for column,line in enumerate(self.hLines):
-                if column < len(harmonics):
-                    line.set_xdata(harmonics[column,0])
-                    line.set_ydata(20.0*np.log10(harmonics[column,1] + np.finfo(float).eps))
+            for row,line in zip(yData, self.lines):
+                if len(x) < len(row) and xData[0] == 0:
+                    line.set_data(x, 20.0 * np.log10(minMaxBin(row, starts, stop) +
+                                                     np.finfo(float).eps))
                 else:
-                    line.set_xdata(1)
-                    line.set_ydata(1)
+                    line.set_data(xData, 20.0 * np.log10(row + np.finfo(float).eps))
+                
+        if not harmonics is None:
+            offsets = np.empty((len(harmonics), 2))
+            offsets[:,0] = harmonics[:,0]
+            offsets[:,1] = 20.0 * np.log10(harmonics[:,1] + np.finfo(float).eps)
+            self.harmonicMarkers.set_offsets(offsets)
+        
+        self.thdText.set_text(measurementText(measurementData))
         
-        self.thdText.set_text("THD: {0:.4f}%\nNoise: {1:.1f} dB".format(measurementData['THD'], measurementData['Noise']))
+    def setStatsText(self, text):
+        
+        # None hides the statistics overlay
+        self.statsText.set_visible(text is not None)
+        if text is not None:
+            self.statsText.set_text(text)
+        
+    def drawArtists(self):
+        
+        for artist in self.lines + [self.harmonicMarkers, self.thdText, self.statsText]:
+            self.axes.draw_artist(artist)
+        if self.waterfallImage is not None:
+            self.waterfallImage.axes.draw_artist(self.waterfallImage)
+        
+    def onDraw(self, event):
+        
+        if self.lines is None:
+            return
+        self.background = self.copy_from_bbox(self.fig.bbox)
+        self.drawArtists()
+        
+    def render(self):
+        
+        # Blit the changing artists onto the cached background, or redraw
+        # everything when there is no valid background yet
+        if self.background is None:
+            self.draw()
+            return
+        self.restore_region(self.background)
+        self.drawArtists()
+        self.blit(self.fig.bbox)
+
+
+class ResponseWindow(QtWidgets.QMainWindow):
+    
+    # Magnitude, phase and distortion against frequency of a sweep measurement
+    
+    def __init__(self, *args, **kwargs):
+        
+        super(ResponseWindow, self).__init__(*args, **kwargs)
+        
+        self.fig = Figure(figsize=(8, 8), dpi=100)
+        self.canvas = FigureCanvas(self.fig)
+        self.setCentralWidget(self.canvas)
+        self.addToolBar(NavigationToolbar2QT(self.canvas, self))
+        self.setWindowTitle("Frequency response")
+        
+    def showResult(self, result):
+        
+        self.fig.clear()
+        magnitude, phase, distortion = self.fig.subplots(3, 1, sharex=True)
+        f = result['Frequency']
+        for c in range(len(result['Magnitude'])):
+            label = "Ch {0}, delay {1:.2f} ms".format(c + 1, result['Delay'][c] * 1000)
+            magnitude.semilogx(f, result['Magnitude'][c], label=label)
+            phase.semilogx(f, result['Phase'][c])
+            distortion.semilogx(f, 20 * np.log10(result['THD'][c] / 100 + np.finfo(float).eps),
+                                label="Ch {0} THD".format(c + 1))
+        for k, level in enumerate(result['Harmonics'][0]):
+            distortion.semilogx(f, level, '--', linewidth=0.8, label="H{0}".format(k + 2))
+        magnitude.set_ylabel('Magnitude [dB]')
+        magnitude.legend(loc='lower left')
+        phase.set_ylabel('Phase [°]')
+        distortion.set_ylabel('Distortion [dB]')
+        distortion.set_xlabel('Frequency [Hz]')
+        distortion.legend(loc='upper left', ncol=3, fontsize='small')
+        for axes in (magnitude, phase, distortion):
+            axes.grid(True, which='both')
+        self.fig.tight_layout(pad=1)
+        self.canvas.draw_idle()
+        self.show()
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -92,30 +288,42 @@ class MainWindow(QtWidgets.QMainWindow):
         
         self.samplingRate = 192000
         self.generatorFrequency = 1000
+        self.configId = 0       # Last 'configure' request sent to the server
         self.generatorActive = False
         self.blockSize = 16384
+        self.channels = 1
         self.averaging = 64
+        self.aveMode = 'linear'
+        self.overlap = 0.5
+        self.zoom = 1
+        self.zoomHarmonic = 1
+        self.tracking = False
+        self.showWaterfall = False
+        self.waterfall = None
+        self.waterfallKey = None
+        self.compression = 0
+        self.sweepKind = audioSweep.SWEEP_CHIRP
+        self.sweepSettings = None
         self.winTxt= 'Hann'
         self.minFreq = 10
         self.maxFreq = self.samplingRate/2
         self.serverAddress = "audio-analyzer.local"
-        self.bufIdx = 0
         self.cleanup = False
         
-        self.measurementData = np.ones(self.blockSize) * np.finfo(float).eps
-        self.dataBuf = np.zeros((self.blockSize, self.averaging))
+        # Never redraw faster than the screen refreshes
+        self.displayInterval = int(np.ceil(1000 / app.primaryScreen().refreshRate()))
         
-        if self.winTxt == 'Hann':
-            self.win = hann(self.blockSize)
-        elif self.winTxt == 'Hamming':
-            self.win = hamming(self.blockSize)
-        elif self.winTxt == 'Blackman':
-            self.win = blackman(self.blockSize)
-        elif self.winTxt == 'Kaiser':
-            self.win = kaiser(self.blockSize, kaiserBeta)
+        # Held while the acquisition thread processes a block, and while
+        # the GUI replaces the buffers it works on
+        self.lock = threading.Lock()
+        
+        # Timing of every stage on this side, the server sends its own on request
+        self.stats = PipelineStats()
+        self.showStats = False
+        self.lastStatsRequest = 0
         
-        self.frequencies = np.arange(self.blockSize) / self.blockSize * self.samplingRate
-        self.dataLen = int(self.blockSize/2) + 1
+        # Sets the plotted frequencies and data as well
+        self.makeProcessor()
         
         # GUI elements
         self.canvas = MplCanvas(self, width=10, height=8, dpi=100)
@@ -156,6 +364,12 @@ class MainWindow(QtWidgets.QMainWindow):
         elif self.samplingRate == 192000:
             self.sampPopup.setCurrentIndex(4)
         
+        self.channelsPopup = QtWidgets.QComboBox(objectName="Channels")
+        self.channelsPopup.addItem("1 channel")
+        self.channelsPopup.addItem("2 channels")
+        self.channelsPopup.activated[str].connect(self.doPopupChannels)
+        self.channelsPopup.setCurrentIndex(self.channels - 1)
+        
         self.aveTxt = QtWidgets.QLabel("Averaging #")
         self.avePopup = QtWidgets.QComboBox(objectName="Averaging")
         self.avePopup.addItem("1")
@@ -193,6 +407,40 @@ class MainWindow(QtWidgets.QMainWindow):
         elif self.averaging == 1024:
             self.avePopup.setCurrentIndex(10)
         
+        self.aveModePopup = QtWidgets.QComboBox(objectName="AveragingMode")
+        self.aveModePopup.addItem("Linear")
+        self.aveModePopup.addItem("Exponential")
+        self.aveModePopup.activated[str].connect(self.doPopupAverageMode)
+        if self.aveMode == 'linear':
+            self.aveModePopup.setCurrentIndex(0)
+        elif self.aveMode == 'exponential':
+            self.aveModePopup.setCurrentIndex(1)
+        
+        self.overlapPopup = QtWidgets.QComboBox(objectName="Overlap")
+        self.overlapPopup.addItem("No overlap")
+        self.overlapPopup.addItem("50% overlap")
+        self.overlapPopup.addItem("75% overlap")
+        self.overlapPopup.activated[str].connect(self.doPopupOverlap)
+        if self.overlap == 0:
+            self.overlapPopup.setCurrentIndex(0)
+        elif self.overlap == 0.5:
+            self.overlapPopup.setCurrentIndex(1)
+        elif self.overlap == 0.75:
+            self.overlapPopup.setCurrentIndex(2)
+        
+        self.zoomPopup = QtWidgets.QComboBox(objectName="Zoom")
+        self.zoomPopup.addItem("Full band")
+        self.zoomPopup.addItem("Zoom x16")
+        self.zoomPopup.addItem("Zoom x64")
+        self.zoomPopup.addItem("Zoom x256")
+        self.zoomPopup.activated[str].connect(self.doPopupZoom)
+        
+        self.zoomCenterPopup = QtWidgets.QComboBox(objectName="ZoomCenter")
+        self.zoomCenterPopup.addItem("Around fundamental")
+        for k in range(2, 6):
+            self.zoomCenterPopup.addItem("Around harmonic {0}".format(k))
+        self.zoomCenterPopup.activated[int].connect(self.doPopupZoomCenter)
+        
         self.dataSizeTxt = QtWidgets.QLabel("Data size")
         self.dataSizePopup = QtWidgets.QComboBox(objectName="DataSize")
         self.dataSizePopup.addItem("1024")
@@ -244,21 +492,63 @@ class MainWindow(QtWidgets.QMainWindow):
         self.lockCheckBox.stateChanged.connect(self.doLockCheckBox)
         self.lockCheckBox.setEnabled(True)
         
+        self.trackCheckBox = QtWidgets.QCheckBox('Fast THD')
+        self.trackCheckBox.stateChanged.connect(self.doTrackCheckBox)
+        self.trackCheckBox.setEnabled(True)
+        
+        self.waterfallCheckBox = QtWidgets.QCheckBox('Waterfall')
+        self.waterfallCheckBox.stateChanged.connect(self.doWaterfallCheckBox)
+        self.waterfallCheckBox.setEnabled(True)
+        
+        self.statsCheckBox = QtWidgets.QCheckBox('Show statistics')
+        self.statsCheckBox.stateChanged.connect(self.doStatsCheckBox)
+        self.statsCheckBox.setEnabled(True)
+        
+        self.compressCheckBox = QtWidgets.QCheckBox('Compress data')
+        self.compressCheckBox.stateChanged.connect(self.doCompressCheckBox)
+        self.compressCheckBox.setEnabled(True)
+        
+        self.recordCheckBox = QtWidgets.QCheckBox('Record capture')
+        self.recordCheckBox.stateChanged.connect(self.doRecordCheckBox)
+        self.recordCheckBox.setEnabled(False)
+        
+        self.replayButton = QtWidgets.QPushButton('Replay...')
+        self.replayButton.clicked.connect(self.doReplayButton)
+        
+        self.sweepPopup = QtWidgets.QComboBox(objectName="Sweep")
+        self.sweepPopup.addItem("Log chirp")
+        self.sweepPopup.addItem("Stepped sine")
+        self.sweepPopup.activated[int].connect(self.doPopupSweep)
+        
+        self.measureButton = QtWidgets.QPushButton('Measure response')
+        self.measureButton.clicked.connect(self.doMeasureButton)
+        self.measureButton.setEnabled(False)
+        
+        self.responseWindow = ResponseWindow(self)
+        
         self.serverTxt = QtWidgets.QLabel("Server address")
         self.serverInput = QtWidgets.QLineEdit(self.serverAddress, objectName="Server")
         self.serverInput.returnPressed.connect(self.doServerAddressText)
         
         
         self.connectButton.setFixedWidth(100)
+        self.replayButton.setFixedWidth(100)
         self.shutDownButton.setFixedWidth(100)
         #self.closeButton.setFixedWidth(100)
         self.freqInput.setFixedWidth(100)
         self.dataSizePopup.setFixedWidth(100)
         self.avePopup.setFixedWidth(150)
+        self.aveModePopup.setFixedWidth(150)
+        self.overlapPopup.setFixedWidth(150)
+        self.sweepPopup.setFixedWidth(150)
+        self.measureButton.setFixedWidth(150)
         self.scalePopup.setFixedWidth(150)
+        self.zoomPopup.setFixedWidth(150)
+        self.zoomCenterPopup.setFixedWidth(150)
         self.windowPopup.setFixedWidth(150)
         self.serverInput.setFixedWidth(200)
         self.sampPopup.setFixedWidth(150)
+        self.channelsPopup.setFixedWidth(150)
         
         mainContainer = QtWidgets.QWidget(self)
         self.setCentralWidget(mainContainer)
@@ -271,28 +561,48 @@ class MainWindow(QtWidgets.QMainWindow):
         layout1.addWidget(self.freqInput)
         layout1.addSpacing(5)
         layout1.addWidget(self.generatorCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.sweepPopup)
+        layout1.addWidget(self.measureButton)
         layout1.addSpacing(15)
         layout1.addWidget(self.sampTxt)
         layout1.addWidget(self.sampPopup)
+        layout1.addWidget(self.channelsPopup)
         layout1.addSpacing(15)
         layout1.addWidget(self.dataSizeTxt)
         layout1.addWidget(self.dataSizePopup)
         layout1.addSpacing(15)
         layout1.addWidget(self.aveTxt)
         layout1.addWidget(self.avePopup)
+        layout1.addWidget(self.aveModePopup)
+        layout1.addWidget(self.overlapPopup)
         layout1.addSpacing(15)
         layout1.addWidget(self.scaleTxt)
         layout1.addWidget(self.scalePopup)
+        layout1.addWidget(self.zoomPopup)
+        layout1.addWidget(self.zoomCenterPopup)
         layout1.addSpacing(15)
         layout1.addWidget(self.windowTxt)
         layout1.addWidget(self.windowPopup)
         layout1.addSpacing(15)
         layout1.addWidget(self.lockCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.trackCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.waterfallCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.statsCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.compressCheckBox)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.recordCheckBox)
         layout1.addStretch(1)
         layout1.addWidget(self.serverTxt)
         layout1.addWidget(self.serverInput)
         layout1.addSpacing(5)
         layout1.addWidget(self.connectButton)
+        layout1.addSpacing(5)
+        layout1.addWidget(self.replayButton)
         layout1.addSpacing(15)
         layout1.addWidget(self.shutDownButton)
         #layout1.addWidget(self.closeButton)
@@ -310,13 +620,13 @@ class MainWindow(QtWidgets.QMainWindow):
         mainContainer.setLayout(layout3)
         self.show()
         
-        self.canvas.initPlot(self.frequencies[:self.dataLen], 
-                             self.measurementData[:self.dataLen], 
-                             (self.minFreq, self.maxFreq))
+        self.resetPlot()
 
         # Setup a timer to trigger the redraw by calling update.
+        # Data is received and averaged in the acquisition thread, the timer
+        # only sets the display rate.
         self.timer = QtCore.QTimer()
-        self.timer.setInterval(200)
+        self.timer.setInterval(self.displayInterval)
         self.timer.timeout.connect(self.update)
         #self.timer.start()
         
@@ -328,7 +638,7 @@ class MainWindow(QtWidgets.QMainWindow):
         
         print("Closing...")
         if self.connected:
-            self.socket.close()
+            self.acquisition.stop()
         
     def keyPressEvent(self, e):
         """
@@ -344,11 +654,11 @@ class MainWindow(QtWidgets.QMainWindow):
         if sender.isChecked():
             self.generatorActive = True
             if self.connected:
-                res = self.socket.sendCmd('startGen')
+                res = self.acquisition.sendCmd('startGen')
         else:
             self.generatorActive = False
             if self.connected:
-                res = self.socket.sendCmd('stopGen')
+                res = self.acquisition.sendCmd('stopGen')
                 
     def doLockCheckBox(self):
         
@@ -363,22 +673,32 @@ class MainWindow(QtWidgets.QMainWindow):
         sender = self.sender()
         if sender.text() == 'Connect':
             try:
-                self.socket = DataSocket(self.blockSize)
-                self.socket.connect(self.serverAddress, 10000)
-                res = self.socket.sendCmd('dataSize', self.blockSize)
-                self.socket.sendCmd('startSend')
+                self.acquisition = AcquisitionThread(self.blockSize, self.processBlock,
+                                                     stats=self.stats)
+                self.configId = 0
+                self.acquisition.connect(self.serverAddress, 10000)
+                self.acquisition.setFormat((np.int32,), self.compression)
+                self.acquisition.start()
+                # Everything the server has to agree on, in one go
+                self.configureServer(fs=self.samplingRate, channels=self.channels,
+                                     dataSize=self.blockSize, frequency=self.generatorFrequency,
+                                     generator=int(self.generatorActive))
+                self.acquisition.sendCmd('startSend')
                 sender.setText('Disconnect')
                 self.serverInput.setEnabled(False)
                 self.shutDownButton.setEnabled(True)
                 self.connected = True
                 self.timer.start()
                 self.generatorCheckBox.setEnabled(True)
+                self.recordCheckBox.setEnabled(True)
+                self.measureButton.setEnabled(True)
+                self.replayButton.setEnabled(False)
             except:
                 print("Connection failed!")
                 self.connected = False
         elif sender.text() == 'Disconnect':
             try:
-                self.socket.close()
+                self.acquisition.stop()
                 self.connected = False
                 self.timer.stop()
                 sender.setText('Connect')
@@ -387,11 +707,116 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.shutDownButton.setEnabled(False)
                 self.generatorCheckBox.setEnabled(False)
                 self.generatorCheckBox.setCheckState(0)
+                self.recordCheckBox.setCheckState(0)
+                self.recordCheckBox.setEnabled(False)
+                self.measureButton.setEnabled(False)
+                self.replayButton.setEnabled(True)
             except:
                 print("Disconnect failed!")
             
         #print("Connect "+sender.text())
         
+    def doTrackCheckBox(self):
+        
+        # Only the fundamental and harmonics of the generator, on every block.
+        # Exact for a coherent generator frequency, which is set first.
+        sender = self.sender()
+        self.tracking = sender.isChecked()
+        self.setGeneratorFrequency(self.generatorFrequency)
+        with self.lock:
+            self.makeProcessor()
+        self.resetPlot()
+        
+    def doWaterfallCheckBox(self):
+        
+        sender = self.sender()
+        with self.lock:
+            self.showWaterfall = sender.isChecked()
+            self.makeWaterfall()
+        self.resetPlot()
+        
+    def doStatsCheckBox(self):
+        
+        sender = self.sender()
+        self.showStats = sender.isChecked()
+        if not self.showStats:
+            self.canvas.setStatsText(None)
+            self.canvas.render()
+        
+    def doCompressCheckBox(self):
+        
+        # Lossless, for weak wireless links
+        sender = self.sender()
+        if sender.isChecked():
+            self.compression = proto.FLAG_ZLIB | proto.FLAG_DELTA | proto.FLAG_SHUFFLE
+        else:
+            self.compression = 0
+        if self.connected:
+            self.acquisition.setFormat((np.int32,), self.compression)
+        
+    def doRecordCheckBox(self):
+        
+        sender = self.sender()
+        if not self.connected:
+            return
+        if sender.isChecked():
+            path = time.strftime("capture-%Y%m%d-%H%M%S.npy")
+            print("Recording to", path)
+            self.acquisition.startRecording(path)
+        else:
+            self.acquisition.stopRecording()
+        
+    def doReplayButton(self):
+        
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Replay recording", "",
+                                                        "Recordings (*.npy)")
+        if not path or self.connected:
+            return
+        try:
+            replay = ReplaySocket(path, realtime=True, loop=True)
+        except (OSError, ValueError) as e:
+            print("Replay failed!", e)
+            return
+        
+        # Take over the block size, channels and sampling rate of the recording
+        blockSize = str(replay.samples.shape[1])
+        channels = replay.samples.shape[2] if replay.samples.ndim > 2 else 1
+        self.channelsPopup.setCurrentIndex(channels - 1)
+        self.doPopupChannels(str(channels))
+        samplingRate = str(int(replay.index[0]['sampleRate']))
+        self.sampPopup.setCurrentIndex(self.sampPopup.findText(samplingRate))
+        self.doPopupSamplingFreq(samplingRate)
+        self.dataSizePopup.setCurrentIndex(self.dataSizePopup.findText(blockSize))
+        self.doPopupDataSize(blockSize)
+        
+        self.acquisition = AcquisitionThread(self.blockSize, self.processBlock, sock=replay,
+                                             stats=self.stats)
+        self.configId = 0
+        self.acquisition.start()
+        self.connected = True
+        self.timer.start()
+        self.connectButton.setText('Disconnect')
+        self.serverInput.setEnabled(False)
+        self.replayButton.setEnabled(False)
+        
+    def doPopupSweep(self, index):
+        
+        self.sweepKind = index
+        
+    def doMeasureButton(self):
+        
+        # The server plays the excitation instead of the generator and sends
+        # the aligned capture, which update() picks up and analyzes
+        f1 = max(20, self.minFreq)
+        f2 = min(20000, 0.45 * self.samplingRate)
+        if self.sweepKind == audioSweep.SWEEP_CHIRP:
+            duration = 2.0
+        else:
+            duration = 0.1
+        self.sweepSettings = (self.sweepKind, f1, f2, duration)
+        self.acquisition.measure(*self.sweepSettings)
+        self.measureButton.setEnabled(False)
+        
     def doShutDownButton(self):
         
         sender = self.sender()
@@ -418,11 +843,54 @@ class MainWindow(QtWidgets.QMainWindow):
         
         f = float(sender.text())
         if (f >= 20) and (f <= 20000):
-            cycles = np.round(self.blockSize * f / self.samplingRate)
-            cycles = np.floor(cycles / 2) * 2 + 1
-            self.generatorFrequency = cycles * self.samplingRate / self.blockSize
-            if self.connected:
-                res = self.socket.sendCmd('frequency', self.generatorFrequency)
+            self.setGeneratorFrequency(f)
+        
+    def setGeneratorFrequency(self, f):
+        
+        # An odd number of cycles per block keeps the harmonics on bins
+        self.generatorFrequency = coherentFrequency(f, self.blockSize, self.samplingRate)
+        if self.connected:
+            res = self.acquisition.sendCmd('frequency', self.generatorFrequency)
+        if self.zoom > 1 or self.tracking:
+            # The zoomed band and the tracked harmonics follow the generator
+            with self.lock:
+                self.makeProcessor()
+            self.resetPlot()
+        
+    def configureServer(self, **settings):
+        
+        # Applied by the server together, followServer takes over the answer
+        requestId = self.acquisition.configure(**settings)
+        if requestId is None:
+            print("Settings not sent to the server")
+        else:
+            self.configId = requestId
+        
+    def followServer(self):
+        
+        # Takes over the stream settings the server ended up with, so both
+        # sides agree. Answers to requests that were followed by others are
+        # skipped, the last one decides.
+        effective = self.acquisition.takeSettings()
+        if effective is None or effective['id'] < self.configId:
+            return
+        
+        fs = int(effective['fs'])
+        channels = int(effective['channels'])
+        blockSize = int(effective['dataSize'])
+        if (fs, channels, blockSize) == (self.samplingRate, self.channels, self.blockSize):
+            return
+        self.sampPopup.setCurrentIndex(self.sampPopup.findText(str(fs)))
+        self.channelsPopup.setCurrentIndex(channels - 1)
+        self.dataSizePopup.setCurrentIndex(self.dataSizePopup.findText(str(blockSize)))
+        with self.lock:
+            self.samplingRate = fs
+            self.maxFreq = fs / 2
+            self.channels = channels
+            self.blockSize = blockSize
+            self.makeProcessor()
+        self.acquisition.setDataLen(blockSize)
+        self.resetPlot()
         
     def doServerAddressText(self):
         
@@ -446,58 +914,83 @@ class MainWindow(QtWidgets.QMainWindow):
             
         self.maxFreq = self.samplingRate/2
         
+        with self.lock:
+            self.makeProcessor()
+        
+        self.resetPlot()
         if (oldSamp != self.samplingRate) and self.connected:
-            res = self.socket.sendCmd('fs', self.samplingRate)
-            
-        self.measurementData = np.ones(self.blockSize) * np.finfo(float).eps
+            self.configureServer(fs=self.samplingRate)
+        if self.tracking:
+            self.setGeneratorFrequency(self.generatorFrequency)
         
-        self.bufIdx = 0
-        self.dataBuf = np.zeros((self.blockSize, self.averaging))
+    def doPopupAverage(self, text):
         
-        self.frequencies = np.arange(self.blockSize) / self.blockSize * self.samplingRate
-        self.dataLen = int(self.blockSize/2) + 1
+        with self.lock:
+            self.averaging = int(text)
+            self.makeProcessor()
         
-        self.canvas.axes.cla()
-        self.canvas.initPlot(self.frequencies[:self.dataLen], 
-                             self.measurementData[:self.dataLen], 
-                             (self.minFreq, self.maxFreq))
+    def doPopupAverageMode(self, text):
         
+        with self.lock:
+            self.aveMode = text.lower()
+            self.makeProcessor()
         
-    def doPopupAverage(self, text):
+    def doPopupOverlap(self, text):
         
-        self.averaging = int(text)
-        self.bufIdx = 0
-        self.dataBuf = np.zeros((self.blockSize, self.averaging))
+        with self.lock:
+            if text.startswith('50'):
+                self.overlap = 0.5
+            elif text.startswith('75'):
+                self.overlap = 0.75
+            else:
+                self.overlap = 0
+            self.makeProcessor()
+        
+    def doPopupChannels(self, text):
+        
+        with self.lock:
+            self.channels = int(text.split()[0])
+            self.makeProcessor()
+        
+        self.resetPlot()
+        if self.connected:
+            self.configureServer(channels=self.channels)
         
     def doPopupDataSize(self, text):
         
-        self.blockSize = int(text)
+        with self.lock:
+            self.blockSize = int(text)
+            self.makeProcessor()
         
-        if self.winTxt == 'Hann':
-            self.win = hann(self.blockSize)
-        elif self.winTxt == 'Hamming':
-            self.win = hamming(self.blockSize)
-        elif self.winTxt == 'Blackman':
-            self.win = blackman(self.blockSize)
-        elif self.winTxt == 'Kaiser':
-            self.win = kaiser(self.blockSize, kaiserBeta)
+        if self.connected:
+            self.acquisition.setDataLen(self.blockSize)
         
+        self.resetPlot()
         if self.connected:
-            res = self.socket.sendCmd('dataSize', self.blockSize)
-            self.socket.setDataLen(self.blockSize)
+            self.configureServer(dataSize=self.blockSize)
+        if self.tracking:
+            # Coherent for the new block size
+            self.setGeneratorFrequency(self.generatorFrequency)
         
-        self.measurementData = np.ones(self.blockSize) * np.finfo(float).eps
+    def doPopupZoom(self, text):
         
-        self.bufIdx = 0
-        self.dataBuf = np.zeros((self.blockSize, self.averaging))
+        with self.lock:
+            if text.startswith('Zoom'):
+                self.zoom = int(text.split('x')[1])
+            else:
+                self.zoom = 1
+            self.makeProcessor()
         
-        self.frequencies = np.arange(self.blockSize) / self.blockSize * self.samplingRate
-        self.dataLen = int(self.blockSize/2) + 1
+        self.resetPlot()
         
-        self.canvas.axes.cla()
-        self.canvas.initPlot(self.frequencies[:self.dataLen], 
-                             self.measurementData[:self.dataLen], 
-                             (self.minFreq, self.maxFreq))
+    def doPopupZoomCenter(self, index):
+        
+        with self.lock:
+            self.zoomHarmonic = index + 1
+            self.makeProcessor()
+        
+        if self.zoom > 1:
+            self.resetPlot()
         
     def doPopupScale(self, text):
         
@@ -505,15 +998,9 @@ class MainWindow(QtWidgets.QMainWindow):
         
     def doPopupWindow(self, text):
         
-        self.winTxt = text
-        if self.winTxt == 'Hann':
-            self.win = hann(self.blockSize)
-        elif self.winTxt == 'Hamming':
-            self.win = hamming(self.blockSize)
-        elif self.winTxt == 'Blackman':
-            self.win = blackman(self.blockSize)
-        elif self.winTxt == 'Kaiser':
-            self.win = kaiser(self.blockSize, kaiserBeta)
+        with self.lock:
+            self.winTxt = text
+            self.makeProcessor()
         #print("Window "+text)
         
     def center(self):
@@ -522,61 +1009,205 @@ class MainWindow(QtWidgets.QMainWindow):
         qr.moveCenter(cp)
         self.move(qr.topLeft())
         
-    def getHarmonics(self, f, data, fc):
+    def makeProcessor(self):
+        
+        # Windows are cached, so switching window or size back and forth is cheap
+        if self.tracking:
+            self.processor = HarmonicTracker(self.blockSize, self.samplingRate,
+                                             self.generatorFrequency, fullScale=FULLSCALE,
+                                             channels=self.channels)
+        elif self.zoom > 1:
+            center = min(self.zoomHarmonic * self.generatorFrequency, 0.45 * self.samplingRate)
+            self.processor = ZoomProcessor(self.samplingRate, center, self.zoom, ZOOMSIZE,
+                                           self.winTxt, self.averaging, self.aveMode,
+                                           kaiserBeta, FULLSCALE, self.overlap, self.channels)
+        elif self.channels > 1:
+            self.processor = TransferAnalyzer(self.blockSize, self.samplingRate, self.winTxt,
+                                              self.averaging, self.aveMode, kaiserBeta,
+                                              FULLSCALE, self.overlap, self.channels)
+        else:
+            self.processor = SpectrumProcessor(self.blockSize, self.samplingRate, self.winTxt,
+                                               self.averaging, self.aveMode, kaiserBeta,
+                                               FULLSCALE, self.overlap)
+        self.processor.stats = self.stats
+        
+        # The plotted frequencies follow the processor, the tracker has no
+        # spectrum and keeps the full band
+        if self.tracking:
+            self.frequencies = np.arange(self.blockSize // 2 + 1) * self.samplingRate / self.blockSize
+        else:
+            self.frequencies = self.processor.frequencies()
+        self.dataLen = len(self.frequencies)
+        self.measurementData = np.ones((self.channels, self.dataLen)) * np.finfo(float).eps
+        self.makeWaterfall()
+        
+    def makeWaterfall(self):
+        
+        # Kept over changes that leave its axes alone, such as the averaging
+        if self.zoomed():
+            blockTime = max(self.blockSize, self.processor.hop * self.zoom) / self.samplingRate
+        else:
+            blockTime = self.blockSize / self.samplingRate
+        decimation = max(int(round(WATERFALLROWTIME / blockTime)), 1)
+        key = (self.showWaterfall and not self.tracking, self.dataLen, self.frequencies[0],
+               self.frequencies[-1], self.plotRange(), decimation)
+        if key == self.waterfallKey:
+            return
+        self.waterfallKey = key
+        if not key[0]:
+            self.waterfall = None
+            return
+        fmin, fmax = self.plotRange()
+        self.waterfall = Waterfall(self.frequencies, fmin, fmax,
+                                   min(WATERFALLCOLUMNS, self.dataLen), WATERFALLROWS,
+                                   not self.zoomed(), decimation)
+        self.waterfallRowTime = decimation * blockTime
+        
+    def zoomed(self):
+        
+        return self.zoom > 1 and not self.tracking
+        
+    def plotRange(self):
+        
+        if self.zoomed():
+            return (self.frequencies[0], self.frequencies[-1])
+        
+        return (self.minFreq, self.maxFreq)
+        
+    def resetPlot(self):
+        
+        if self.waterfall is None:
+            self.canvas.initPlot(self.frequencies, self.measurementData, self.plotRange(),
+                                 not self.zoomed())
+        else:
+            self.canvas.initPlot(self.frequencies, self.measurementData, self.plotRange(),
+                                 not self.zoomed(), self.waterfall, self.waterfallRowTime)
         
-        n = int(2e4 / fc)
-        h = np.zeros((n-1, 2))
-        for i in range(n-1):
-            fn = fc * (i + 2)
-            ind = np.where(f < fn)[0][-1]
-            h[i,0] = fn
-            h[i,1] = np.max(data[(ind-5):(ind+6)])
+    def processBlock(self, data):
+        
+        # Runs in the acquisition thread for every received block
+        with self.lock:
+            channels = data.shape[1] if data.ndim > 1 else 1
+            if len(data) != self.blockSize or channels != self.channels:
+                # Still in flight from before a block size or channel change
+                return None
             
-        return h
+            # Segments may only span blocks that directly follow each other
+            result = self.processor.process(data, self.acquisition.socket.isConsecutive())
+            if result is None:
+                return None
+            if self.tracking:
+                # Per block figures only, there is no spectrum to show
+                return (None, result)
+            if self.waterfall is not None:
+                # Every block before averaging, of the first channel
+                with self.stats.timed('waterfall'):
+                    self.waterfall.add(np.atleast_2d(self.processor.peakSpectrum())[0])
+            if self.zoom > 1:
+                spectra = np.atleast_2d(result)
+                measurements = [self.processor.peak(spectrum) for spectrum in spectra]
+                for m in measurements:
+                    m['Harmonics'] = np.empty((0, 2))
+                return (spectra, measurements)
+            if self.channels > 1:
+                spectra = result['Spectra']
+            else:
+                spectra = result[np.newaxis]
+            if self.generatorActive:
+                fundamental = self.generatorFrequency
+            else:
+                fundamental = None
+            
+            # Cheap enough to run on every block, not just the displayed ones
+            with self.stats.timed('harmonics'):
+                measurements = [analyzeDistortion(spectrum, self.samplingRate,
+                                                  self.processor.enbw, fundamental)
+                                for spectrum in spectra]
+                if self.channels > 1:
+                    # Transfer function of every channel against the first at
+                    # the fundamental of the first
+                    k = int(round(measurements[0]['Fundamental'] * self.blockSize /
+                                  self.samplingRate))
+                    levels = crosstalk(spectra, self.samplingRate, self.processor.enbw,
+                                       measurements[0]['Fundamental'])
+                    for c, m in enumerate(measurements):
+                        m['Gain'] = result['Magnitude'][c,k]
+                        m['Phase'] = result['Phase'][c,k]
+                        m['Coherence'] = result['Coherence'][c,k]
+                        m['Crosstalk'] = levels[c]
+            return (spectra, measurements)
 
     def update(self):
         
-        # Acquire data
-        #self.measurementData = np.abs(np.random.randn(self.blockSize))
+        # Display the latest averaged spectrum from the acquisition thread
         if self.connected:
-            data = self.socket.receiveData()
-            if len(data) > 0:
-                self.measurementData = np.abs(np.fft.fft(data * self.win))
-                #self.measurementData /= np.max(self.measurementData)
-            self.socket.sendCmd('idle')
-        
-        if len(self.measurementData) == self.blockSize:
-            self.dataBuf[:,self.bufIdx % self.averaging] = self.measurementData
-            if self.bufIdx == 0:
-                data = self.dataBuf[:,0]
-            elif self.bufIdx < self.averaging:
-                data = np.mean(self.dataBuf[:,:self.bufIdx], axis=1)
-            else:
-                data = np.mean(self.dataBuf, axis=1)
-        
-            self.bufIdx += 1
-        
-            measurementData = {}
-            measurementData['THD'] = 0
-            measurementData['Noise'] = 0
+            self.followServer()
+            result = self.acquisition.getLatest()
+            self.showMeasurement()
+        else:
+            result = None
+        
+        if result is None:
+            return
+        
+        data, measurementData = result
+        if data is None:
+            # Fast THD mode, the fundamental is shown with the harmonics
+            data = self.measurementData
+            harmonics = np.concatenate([np.vstack(([m['Fundamental'], m['Amplitude']],
+                                                   m['Harmonics'])) for m in measurementData])
+            peak = max(m['Amplitude'] for m in measurementData)
+        else:
+            harmonics = np.concatenate([m['Harmonics'] for m in measurementData])
+            peak = np.max(data)
+        if data.shape == (self.channels, self.dataLen):
             if not self.freezeScale:
-                self.maxVal = np.max(data[:self.dataLen])
-                ind = np.argmax(data[:self.dataLen])
-                fMax = self.frequencies[:self.dataLen][ind]
-                harmonics = self.getHarmonics(self.frequencies[:self.dataLen], data[:self.dataLen], fMax)
-                harmonics[:,1] /= self.maxVal
-                measurementData['THD'] = np.sqrt(np.sum(harmonics[:,1]**2)) * 100
-            else:
-                harmonics = None
+                self.maxVal = peak
+            harmonics[:,1] /= self.maxVal
             #print(maxVal)
             self.canvas.updatePlot(self.frequencies[:self.dataLen], 
-                                   data[:self.dataLen]/self.maxVal, measurementData,
+                                   data/self.maxVal, measurementData,
                                    (self.minFreq, self.maxFreq), harmonics)
-            self.canvas.draw()
-
+            if self.waterfall is not self.canvas.waterfall:
+                # Replaced by a setting that did not reset the plot
+                self.resetPlot()
+            self.canvas.updateWaterfall()
+            if self.showStats:
+                self.canvas.setStatsText(self.statsReport())
+            with self.stats.timed('draw'):
+                self.canvas.render()
+            
+    def showMeasurement(self):
+        
+        captured = self.acquisition.takeMeasurement()
+        if captured is None or self.sweepSettings is None:
+            return
+        kind, f1, f2, duration = self.sweepSettings
+        # The server plays the excitation at the generator amplitude, which
+        # is left at full scale here
+        result = audioSweep.analyzeMeasurement(kind, captured, self.samplingRate, f1, f2,
+                                               duration, fullScale=FULLSCALE)
+        self.responseWindow.showResult(result)
+        self.measureButton.setEnabled(True)
+        
+    def statsReport(self):
+        
+        # Ask the server for fresh numbers about once a second
+        if time.monotonic() - self.lastStatsRequest > 1:
+            self.lastStatsRequest = time.monotonic()
+            self.acquisition.requestStats()
+        
+        text = formatStats(self.stats.snapshot(), "Analyzer        mean      p99      max")
+        serverStats = self.acquisition.serverStats
+        if serverStats is not None:
+            text += "\n" + formatStats(serverStats['server'], "Server")
+            text += "\n" + formatStats(serverStats['session'], "Connection")
+        
+        return text
 
-app = QtWidgets.QApplication(sys.argv)
-w = MainWindow(app)
-app.exec_()
-#w.close()
-app.quit()
\ No newline at end of file
+if __name__ == '__main__':
+    app = QtWidgets.QApplication(sys.argv)
+    w = MainWindow(app)
+    app.exec_()
+    #w.close()
+    app.quit()
\ No newline at end of file
@@ -0,0 +1,155 @@
+import queue
+import socket
+import threading
+from audioSocket import DataSocket
+from audioRecording import Recorder
+from audioStats import PipelineStats
+
+
+class AcquisitionThread(threading.Thread):
+    """
+    Receives blocks continuously from the audio server in the background.
+    Every block is handed to process (if given) in this thread and only the
+    most recent result is kept, so a consumer polling at its own rate
+    always gets the latest data without ever blocking on the network.
+    """
+
+    def __init__(self, blockSize, process=None, sock=None, stats=None):
+
+        super(AcquisitionThread, self).__init__(daemon=True)
+
+        # Anything with the DataSocket interface, such as a ReplaySocket
+        if sock is None:
+            self.socket = DataSocket(blockSize)
+        else:
+            self.socket = sock
+        self.process = process
+        self.stats = PipelineStats() if stats is None else stats
+        self.socket.stats = self.stats
+        self.recorder = None
+        self.recordLock = threading.Lock()
+        self.results = queue.Queue(maxsize=1)
+        self.sendLock = threading.Lock()
+        self.running = False
+        self.blocksReceived = 0
+        self.settingsTaken = 0
+        self.error = None
+
+    def connect(self, host, port):
+        self.socket.connect(host, port)
+
+    def sendCmd(self, msg, arg=0, *args):
+        # Sending and receiving on the same socket from two threads is fine,
+        # the lock only keeps concurrent commands from interleaving
+        with self.sendLock:
+            return self.socket.sendCmd(msg, arg, *args)
+
+    def setFormat(self, dtypes, compression=0, level=1):
+        with self.sendLock:
+            return self.socket.setFormat(dtypes, compression, level)
+
+    def measure(self, kind, f1, f2, duration, pointsPerOctave=6, tail=0.5):
+        with self.sendLock:
+            return self.socket.measure(kind, f1, f2, duration, pointsPerOctave, tail)
+
+    def configure(self, **settings):
+        # Settings for the server to apply together. Returns the request id,
+        # the answer arrives in the stream and is picked up by takeSettings.
+        with self.sendLock:
+            return self.socket.configure(**settings)
+
+    def waitSettings(self, requestId, timeout=1.0):
+        # For scripts, the GUI thread should poll takeSettings instead
+        return self.socket.waitSettings(requestId, timeout)
+
+    def takeSettings(self):
+        # Answer to the last 'configure' command, or None if none arrived since the last call
+        settings = self.socket.settings
+        if settings is None or settings['id'] <= self.settingsTaken:
+            return None
+        self.settingsTaken = settings['id']
+        return settings
+
+    def takeMeasurement(self):
+        # Capture of the last measurement, or None if none arrived since the last call
+        measurement = self.socket.measurement
+        self.socket.measurement = None
+        return measurement
+
+    def setDataLen(self, dataLen):
+        self.socket.setDataLen(dataLen)
+
+    def requestStats(self, reset=False):
+        # The answer arrives in the stream and ends up in serverStats
+        return self.sendCmd('stats', int(reset))
+
+    @property
+    def serverStats(self):
+        return self.socket.serverStats
+
+    def startRecording(self, path):
+
+        with self.recordLock:
+            if self.recorder is None:
+                self.recorder = Recorder(path)
+
+    def stopRecording(self):
+
+        with self.recordLock:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+    def getLatest(self):
+        # Latest result, or None if nothing new arrived since the last call
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def publish(self, result):
+        # Replace any result the consumer has not picked up yet
+        try:
+            self.results.get_nowait()
+        except queue.Empty:
+            pass
+        self.results.put_nowait(result)
+
+    def run(self):
+
+        self.running = True
+        try:
+            for block in self.socket.streamData():
+                if not self.running:
+                    break
+                self.blocksReceived += 1
+                if self.socket.lastGap:
+                    self.stats.count('lostBlocks', self.socket.lastGap)
+                if self.recorder is not None:
+                    with self.recordLock:
+                        if self.recorder is not None:
+                            self.recorder.write(block, self.socket.header)
+                if self.process is not None:
+                    result = self.process(block)
+                else:
+                    result = block.copy()
+                if result is not None:
+                    self.publish(result)
+        except Exception as e:
+            if self.running:
+                print("Acquisition stopped:", e)
+                self.error = e
+        self.running = False
+
+    def stop(self):
+
+        self.running = False
+        try:
+            self.socket.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+        # The thread may be copying from a shared ring, which is unmapped on close
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(1.0)
+        self.socket.close()
+        self.stopRecording()
@@ -0,0 +1,326 @@
+import os
+import time
+import functools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    # scipy.fft is faster and can spread batched transforms over several cores
+    import scipy.fft as fftpack
+    FFTARGS = {'workers': os.cpu_count() or 1}
+except ImportError:
+    import numpy.fft as fftpack
+    FFTARGS = {}
+
+WINDOWCACHE = 16
+
+
+class SpectrumAverager:
+    """
+    Averages successive spectra at a cost of O(bins) per spectrum.
+
+    In 'linear' mode the mean of the last count spectra is kept as a running
+    sum, the oldest spectrum is subtracted when a new one is added. The
+    history is stored as float32 and the sum as float64, which is only ever
+    changed by the exact stored values so it does not drift noticeably.
+    In 'exponential' mode no history is kept at all, the average decays
+    with a time constant of count spectra. bins may also be a shape, for
+    spectra of several channels in rows.
+    """
+
+    def __init__(self, bins, count=1, mode='linear'):
+
+        self.bins = bins
+        self.count = count
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+
+        self.n = 0
+        self.sum = np.zeros(self.bins)
+        if self.mode == 'linear':
+            self.history = np.zeros((self.count,) + np.shape(self.sum), dtype=np.float32)
+        else:
+            self.history = None
+
+    def configure(self, bins=None, count=None, mode=None):
+
+        if bins is not None:
+            self.bins = bins
+        if count is not None:
+            self.count = count
+        if mode is not None:
+            self.mode = mode
+        self.reset()
+
+    def accumulate(self, spectrum):
+
+        if self.mode == 'exponential':
+            # Plain mean until count spectra have arrived, then a fixed
+            # smoothing factor of 1/count
+            self.n += 1
+            k = min(self.n, self.count)
+            self.sum += (spectrum - self.sum) / k
+            return
+
+        idx = self.n % self.count
+        row = self.history[idx]
+        if self.n >= self.count:
+            self.sum -= row
+        row[:] = spectrum
+        self.sum += row
+        self.n += 1
+
+    def average(self):
+        # The current average as a new array
+        if self.mode == 'exponential':
+            return self.sum.copy()
+
+        return self.sum / max(min(self.n, self.count), 1)
+
+    def add(self, spectrum):
+
+        self.accumulate(spectrum)
+        return self.average()
+
+    def addMany(self, spectra):
+        # Rows of spectra in order, returning the average after the last one
+        for spectrum in spectra:
+            self.accumulate(spectrum)
+
+        return self.average()
+
+
+WINDOWS = ['Hann', 'Hamming', 'Blackman', 'Kaiser']
+
+# Fraction of each segment shared with the next one
+OVERLAPS = [0, 0.5, 0.75]
+
+
+def rfft(x, axis=-1):
+
+    return fftpack.rfft(x, axis=axis, **FFTARGS)
+
+
+def deinterleave(samples, channels):
+    # (frames, channels) view of interleaved samples, without copying
+    return samples.reshape(-1, channels)
+
+
+def makeWindow(name, size, beta=5):
+    # NumPy's windows are the same symmetric windows as scipy.signal.windows,
+    # this keeps scipy off the audio server
+    if name == 'Hann':
+        return np.hanning(size)
+    elif name == 'Hamming':
+        return np.hamming(size)
+    elif name == 'Blackman':
+        return np.blackman(size)
+    elif name == 'Kaiser':
+        return np.kaiser(size, beta)
+    else:
+        raise ValueError("Unknown window {}".format(name))
+
+
+@functools.lru_cache(maxsize=WINDOWCACHE)
+def getWindow(name, size, beta=5):
+    # Cached and read only, as the same array is shared by every caller
+    win = makeWindow(name, size, beta)
+    win.flags.writeable = False
+
+    return win
+
+
+@functools.lru_cache(maxsize=WINDOWCACHE)
+def windowGains(name, size, beta=5):
+    # Coherent gain, and equivalent noise bandwidth in bins
+    win = getWindow(name, size, beta)
+    s1 = np.sum(win)
+    s2 = np.sum(win**2)
+
+    return (s1 / size, size * s2 / s1**2)
+
+
+def amplitudeScale(window, size, beta=5, fullScale=1.0):
+    # Turns FFT magnitudes into one sided peak amplitudes relative to fullScale
+    coherentGain, enbw = windowGains(window, size, beta)
+    scale = np.full(size // 2 + 1, 2 / (size * coherentGain * fullScale))
+    # DC and Nyquist have no mirror image to fold in
+    scale[0] /= 2
+    if size % 2 == 0:
+        scale[-1] /= 2
+
+    return scale
+
+
+def logBinEdges(bins, fs, binsPerOctave=24, fmin=10):
+    # First FFT bin of each log frequency band, for np.maximum.reduceat
+    n = 2 * (bins - 1)
+    fmax = fs / 2
+    nBands = int(np.ceil(np.log2(fmax / fmin) * binsPerOctave))
+    edges = fmin * 2.0**(np.arange(nBands) / binsPerOctave)
+    idx = np.unique(np.ceil(edges * n / fs).astype(int))
+    idx = idx[idx < bins]
+
+    return idx
+
+
+def logBin(spectrum, edges, fs):
+    # Peak of each band, returned as rows of (centre frequency, magnitude)
+    n = 2 * (len(spectrum) - 1)
+    upper = np.append(edges[1:], len(spectrum))
+    res = np.empty((len(edges), 2), dtype=np.float32)
+    res[:,0] = np.sqrt(edges * (upper - 1).clip(min=edges)) * fs / n
+    res[:,1] = np.maximum.reduceat(spectrum, edges)
+
+    return res
+
+
+@functools.lru_cache(maxsize=WINDOWCACHE)
+def pixelBins(bins, fs, fmin, fmax, width, log=True):
+    """
+    Maps a spectrum of bins onto width pixel columns between fmin and fmax
+    on a log or linear frequency axis. Returns the first bin of every
+    column that holds at least one bin, the bin after the last column, and
+    the x coordinates of a (min, max) pair per column at the centre
+    frequency of its bins. Cached, so the arrays are read only.
+    """
+    df = fs / (2 * (bins - 1))
+    if log:
+        edges = np.geomspace(max(fmin, df / 2), fmax, width + 1)
+    else:
+        edges = np.linspace(fmin, fmax, width + 1)
+    idx = np.unique(np.ceil(edges / df).astype(int).clip(0, bins))
+    starts = idx[:-1]
+    stop = int(idx[-1]) if len(idx) else 0
+    x = np.repeat((starts + np.append(starts[1:], stop) - 1) * df / 2, 2)
+    for a in (starts, x):
+        a.flags.writeable = False
+
+    return (starts, stop, x)
+
+
+def minMaxBin(spectrum, starts, stop):
+    # Smallest and largest value of every column, interleaved, so peaks and
+    # nulls both survive the reduction
+    res = np.empty(2 * len(starts))
+    if len(starts):
+        res[0::2] = np.minimum.reduceat(spectrum[:stop], starts)
+        res[1::2] = np.maximum.reduceat(spectrum[:stop], starts)
+
+    return res
+
+
+class SpectrumProcessor:
+    """
+    Window, real FFT and averaging of a stream of equally sized blocks.
+
+    Spectra are one sided amplitude spectra relative to fullScale: the
+    coherent gain of the window is divided out, so a sine reads its peak
+    amplitude at its bin regardless of window. enbw is the equivalent noise
+    bandwidth in bins, needed to turn summed bins into noise power.
+
+    Blocks of several channels, interleaved or as (frames, channels),
+    are transformed for all channels in one batched FFT, and the spectra
+    have the channels in rows.
+
+    With overlap set, blocks are treated as a continuous stream and cut
+    into segments of blockSize that start every hop samples (Welch's
+    method). The samples after the last whole segment are carried over
+    to the next block, and all segments of a block are transformed in one
+    batched FFT. Every segment counts as one spectrum for the averaging.
+
+    If stats is set to an audioStats.PipelineStats, the time spent in the
+    FFT and in the averaging of every block is recorded there.
+    """
+
+    def __init__(self, blockSize, fs, window='Hann', averaging=1, aveMode='linear', beta=5,
+                 fullScale=1.0, overlap=0, channels=1):
+
+        self.blockSize = blockSize
+        self.fs = fs
+        self.channels = channels
+        self.bins = blockSize // 2 + 1
+        self.win = getWindow(window, blockSize, beta)
+        self.enbw = windowGains(window, blockSize, beta)[1]
+        self.scale = amplitudeScale(window, blockSize, beta, fullScale)
+        rows = () if channels == 1 else (channels,)
+        self.windowed = np.empty(rows + (blockSize,))
+        self.magnitude = np.empty(rows + (self.bins,))
+        self.averager = SpectrumAverager(rows + (self.bins,), averaging, aveMode)
+        self.overlap = overlap
+        self.hop = max(int(round(blockSize * (1 - overlap))), 1)
+        self.tail = np.empty(0)
+        self.unaveraged = ()
+        self.stats = None
+
+    def frequencies(self):
+
+        return np.arange(self.bins) * self.fs / self.blockSize
+
+    def peakSpectrum(self):
+        # Largest of the spectra of the last block before averaging, for
+        # displays that must not hide transients
+        return np.max(self.unaveraged, axis=0)
+
+    def transform(self, block):
+        # Windowed FFT of a single block, channels in rows
+        if self.channels > 1:
+            block = deinterleave(block, self.channels).T
+        np.multiply(block, self.win, out=self.windowed)
+
+        return rfft(self.windowed)
+
+    def spectrum(self, block):
+        # Amplitude spectrum of a single block, overwritten on the next call
+        np.abs(self.transform(block), out=self.magnitude)
+        np.multiply(self.magnitude, self.scale, out=self.magnitude)
+
+        return self.magnitude
+
+    def segments(self, block, continuous=True):
+        # Overlapping segments of the carried over samples and block, as a
+        # strided view. The remaining samples are kept for the next block.
+        if self.channels > 1:
+            block = deinterleave(block, self.channels)
+        if continuous and len(self.tail):
+            block = np.concatenate((self.tail, block))
+        count = (len(block) - self.blockSize) // self.hop + 1 if len(block) >= self.blockSize else 0
+        self.tail = np.array(block[count * self.hop:])
+        if count == 0:
+            return np.empty((0,) + self.windowed.shape)
+
+        return sliding_window_view(block, self.blockSize, axis=0)[:count * self.hop:self.hop]
+
+    def spectra(self, segments):
+        # Amplitude spectra of rows of segments in one batched transform
+        spectra = np.abs(rfft(segments * self.win, axis=-1))
+        spectra *= self.scale
+
+        return spectra
+
+    def process(self, block, continuous=True):
+        """
+        Averaged spectrum including this block, as a new array. With
+        overlap, continuous must be False when samples were lost since the
+        previous block, and None is returned while not even one segment
+        has been collected.
+        """
+        start = time.perf_counter()
+        if not self.overlap:
+            spectra = (self.spectrum(block),)
+        else:
+            segments = self.segments(block, continuous)
+            if len(segments) == 0:
+                return None
+            spectra = self.spectra(segments)
+        transformed = time.perf_counter()
+        self.unaveraged = spectra
+        average = self.averager.addMany(spectra)
+
+        if self.stats is not None:
+            self.stats.add('fft', transformed - start)
+            self.stats.add('averaging', time.perf_counter() - transformed)
+
+        return average
@@ -0,0 +1,249 @@
+import os
+import csv
+import struct
+import argparse
+import concurrent.futures
+import numpy as np
+from audioAnalysis import SpectrumProcessor, WINDOWS, OVERLAPS
+from audioDistortion import analyzeDistortion
+from audioRecording import indexPath
+
+EXTENSIONS = ('.wav', '.raw', '.npy')
+
+COLUMNS = ['Fundamental', 'Amplitude', 'THD', 'THD+N', 'SINAD', 'SNR', 'Noise', 'NoiseFloor']
+
+# WAV format tags
+WAVE_PCM = 1
+WAVE_FLOAT = 3
+WAVE_EXTENSIBLE = 0xFFFE
+
+
+def readWavHeader(path):
+    # Returns (format tag, channels, fs, bits, data offset, data bytes)
+    with open(path, 'rb') as f:
+        riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError("{} is not a WAV file".format(path))
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("{} has no data chunk".format(path))
+            chunkId, chunkSize = struct.unpack('<4sI', chunk)
+            if chunkId == b'fmt ':
+                data = f.read(chunkSize)
+                tag, channels, fs, _, _, bits = struct.unpack_from('<HHIIHH', data)
+                if tag == WAVE_EXTENSIBLE:
+                    tag, = struct.unpack_from('<H', data, 24)
+                fmt = (tag, channels, fs, bits)
+                if chunkSize & 1:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunkId == b'data':
+                if fmt is None:
+                    raise ValueError("{} has no fmt chunk".format(path))
+                return fmt + (f.tell(), chunkSize)
+            else:
+                f.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+
+
+def openRecording(path, fs=None, dtype='int32', channel=0):
+    """
+    Memory map a recording without reading it. Returns (samples, fs, fullScale)
+    where samples can be sliced into a one dimensional array of one channel.
+    """
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.wav':
+        tag, channels, fs, bits, offset, nbytes = readWavHeader(path)
+        width = bits // 8
+        frames = nbytes // (width * channels)
+        if tag == WAVE_FLOAT:
+            dt = np.float32 if bits == 32 else np.float64
+            data = np.memmap(path, dtype=dt, mode='r', offset=offset, shape=(frames, channels))
+            return (data[:,channel], fs, 1.0)
+        elif bits == 24:
+            data = np.memmap(path, dtype=np.uint8, mode='r', offset=offset,
+                             shape=(frames, channels, 3))
+            return (Pcm24(data[:,channel]), fs, 2.0**23)
+        elif bits == 8:
+            data = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(frames, channels))
+            return (Pcm8(data[:,channel]), fs, 2.0**7)
+        else:
+            dt = {16: np.int16, 32: np.int32}[bits]
+            data = np.memmap(path, dtype=dt, mode='r', offset=offset, shape=(frames, channels))
+            return (data[:,channel], fs, 2.0**(bits - 1))
+    elif ext == '.npy' and os.path.exists(indexPath(path)):
+        # A capture from audioRecording, blocks back to back
+        data = np.load(path, mmap_mode='r')
+        if data.ndim > 2:
+            data = data.reshape(-1, data.shape[2])[:,channel]
+        else:
+            data = data.reshape(-1)
+        index = np.load(indexPath(path), mmap_mode='r')
+        if fs is None and len(index):
+            fs = int(index['sampleRate'][0])
+    elif ext == '.npy':
+        data = np.load(path, mmap_mode='r')
+        if data.ndim > 1:
+            data = data[:,channel]
+    else:
+        data = np.memmap(path, dtype=dtype, mode='r')
+
+    if fs is None:
+        raise ValueError("The sampling frequency of {} must be given".format(path))
+    if np.issubdtype(data.dtype, np.integer):
+        fullScale = 2.0**(8 * data.dtype.itemsize - 1)
+    else:
+        fullScale = 1.0
+
+    return (data, fs, fullScale)
+
+
+class Pcm8:
+    # Sliceable view of unsigned 8 bit samples, centred on 0 on access
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return np.asarray(self.data[idx], dtype=np.int16) - 128
+
+
+class Pcm24:
+    # Sliceable view of packed 24 bit samples, unpacked to int32 on access
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        b = np.asarray(self.data[idx], dtype=np.int32)
+        return (b[...,0] | (b[...,1] << 8) | (b[...,2] << 16)) << 8 >> 8
+
+
+def findRecordings(paths):
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, n) for n in sorted(names)
+                          if n.lower().endswith(EXTENSIONS)
+                          and not n.lower().endswith('.index.npy')]
+        else:
+            files.append(path)
+
+    return files
+
+
+def makeTasks(files, options):
+    # One task per segment of every recording
+
+    tasks = []
+    for path in files:
+        samples, fs, fullScale = openRecording(path, options['fs'], options['dtype'],
+                                               options['channel'])
+        if options['segment']:
+            segment = int(options['segment'] * fs)
+        else:
+            segment = len(samples)
+        segment = max(segment, options['blockSize'])
+        for i, start in enumerate(range(0, len(samples) - options['blockSize'] + 1, segment)):
+            tasks.append((path, i, start, min(segment, len(samples) - start), options))
+
+    return tasks
+
+
+def analyzeSegment(task):
+    # Averaged spectrum of all complete blocks in the segment, then distortion
+
+    path, index, start, length, options = task
+    samples, fs, fullScale = openRecording(path, options['fs'], options['dtype'],
+                                           options['channel'])
+    blockSize = options['blockSize']
+    hop = max(int(round(blockSize * (1 - options['overlap']))), 1)
+    count = (length - blockSize) // hop + 1
+    if options['averaging']:
+        count = min(count, options['averaging'])
+    processor = SpectrumProcessor(blockSize, fs, options['window'], count, 'linear',
+                                  fullScale=fullScale, overlap=options['overlap'])
+    # Read in blocks, the processor carries the overlap between them
+    end = start + (count - 1) * hop + blockSize
+    for first in range(start, end, blockSize):
+        result = processor.process(samples[first:min(first + blockSize, end)])
+        if result is not None:
+            spectrum = result
+
+    res = analyzeDistortion(spectrum, fs, processor.enbw, options['fundamental'],
+                            options['minFrequency'], options['maxFrequency'])
+
+    return [path, index, start / fs, count] + [float(res[c]) for c in COLUMNS]
+
+
+def writeResults(path, rows):
+
+    header = ['File', 'Segment', 'Start', 'Blocks'] + COLUMNS
+    if path.lower().endswith('.npz'):
+        columns = list(zip(*rows)) if rows else [[] for h in header]
+        np.savez_compressed(path, **{h: np.array(c) for h, c in zip(header, columns)})
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Distortion analysis of audio captures")
+    parser.add_argument('paths', nargs='+', help="WAV, raw or NPY files, or directories of them")
+    parser.add_argument('-o', '--output', default='results.csv', help="CSV or NPZ result table")
+    parser.add_argument('-b', '--block-size', type=int, default=16384)
+    parser.add_argument('-w', '--window', default='Hann', choices=WINDOWS)
+    parser.add_argument('-a', '--averaging', type=int, default=0,
+                        help="Blocks averaged per segment, 0 for all")
+    parser.add_argument('--overlap', type=float, default=0, choices=OVERLAPS,
+                        help="Overlap of the averaged blocks")
+    parser.add_argument('-s', '--segment', type=float, default=0,
+                        help="Segment length in seconds, 0 for whole files")
+    parser.add_argument('--fs', type=int, default=None, help="Sampling rate of raw and NPY files")
+    parser.add_argument('--dtype', default='int32', help="Sample type of raw files")
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--fundamental', type=float, default=None)
+    parser.add_argument('--min-frequency', type=float, default=20)
+    parser.add_argument('--max-frequency', type=float, default=20000)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    options = {
+        'blockSize': args.block_size,
+        'window': args.window,
+        'averaging': args.averaging,
+        'segment': args.segment,
+        'overlap': args.overlap,
+        'fs': args.fs,
+        'dtype': args.dtype,
+        'channel': args.channel,
+        'fundamental': args.fundamental,
+        'minFrequency': args.min_frequency,
+        'maxFrequency': args.max_frequency,
+    }
+
+    tasks = makeTasks(findRecordings(args.paths), options)
+    print("Analyzing {} segments on {} processes".format(len(tasks), args.jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        chunk = max(1, len(tasks) // (4 * args.jobs))
+        rows = list(pool.map(analyzeSegment, tasks, chunksize=chunk))
+
+    writeResults(args.output, rows)
+    print("Results written to", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+from audioLoopback import LoopbackServer
+from audioSocket import DataSocket
+from audioAnalysis import SpectrumProcessor, WINDOWS, pixelBins, minMaxBin
+from audioDistortion import analyzeDistortion, coherentFrequency, HarmonicTracker
+from audioZoom import ZoomProcessor
+from audioWaterfall import Waterfall, FLOOR
+import audioAnalysis as analysis
+import audioProtocol as proto
+
+BLOCKSIZES = [1024, 4096, 16384, 65536]
+
+AVERAGING = [1, 16, 256]
+
+COMPRESSION = [0, proto.FLAG_ZLIB | proto.FLAG_DELTA | proto.FLAG_SHUFFLE]
+
+DECIMATIONS = [16, 64, 256]
+
+# Compared metrics, 1 where higher is better and -1 where lower is better
+DIRECTIONS = {
+    'MBPerSecond': 1,
+    'blocksPerSecond': 1,
+    'firstDataLatency': -1,
+    'medianLatency': -1,
+    'processTime': -1,
+    'distortionTime': -1,
+    'zoomTime': -1,
+    'trackTime': -1,
+    'fullDrawTime': -1,
+    'blitTime': -1,
+    'reducedBlitTime': -1,
+    'waterfallAddTime': -1,
+    'waterfallBlitTime': -1,
+}
+
+
+def result(benchmark, params, metrics):
+
+    print(benchmark, params, {k: round(v, 4) for k, v in metrics.items()})
+    return {'benchmark': benchmark, 'params': params, 'metrics': metrics}
+
+
+def timeCall(f, repeats):
+    # Median time of repeats calls in ms
+    times = np.empty(repeats)
+    for i in range(repeats):
+        t = time.perf_counter()
+        f()
+        times[i] = time.perf_counter() - t
+
+    return float(np.median(times) * 1000)
+
+
+def connect(server, blockSize, shared=False):
+
+    client = DataSocket(blockSize, shared=shared)
+    client.connect('127.0.0.1', server.address[1])
+    client.sendCmd('dataSize', blockSize)
+
+    return client
+
+
+def benchThroughput(blockSizes, fs, duration):
+    # Sustained transfer with the loopback producing as fast as it can.
+    # MB/s counts decoded samples, wire MB/s what was actually sent, none
+    # through shared memory.
+
+    results = []
+    for blockSize in blockSizes:
+        for compression, shared in [(c, False) for c in COMPRESSION] + [(0, True)]:
+            server = LoopbackServer(fs, max(blockSize, 4096), speed=0)
+            server.start()
+            client = connect(server, blockSize, shared)
+            client.setFormat((np.int32,), compression)
+            client.sendCmd('startSend')
+            count = 0
+            wireBytes = 0
+            start = time.perf_counter()
+            for block in client.streamData():
+                count += 1
+                if client.ring is None:
+                    wireBytes += client.header.length
+                if time.perf_counter() - start >= duration:
+                    break
+            elapsed = time.perf_counter() - start
+            client.close()
+            server.stop()
+            params = {'blockSize': blockSize, 'fs': fs, 'compression': compression}
+            if shared:
+                params['transport'] = 'shared'
+            results.append(result('throughput', params, {
+                'MBPerSecond': count * block.nbytes / elapsed / 1e6,
+                'wireMBPerSecond': wireBytes / elapsed / 1e6,
+                'blocksPerSecond': count / elapsed,
+                'lostBlocks': client.lostBlocks,
+            }))
+
+    return results
+
+
+def peakFrequency(block, fs):
+
+    return np.argmax(np.abs(np.fft.rfft(block))) * fs / len(block)
+
+
+def benchLatency(fs, repeats, blockSize=1024, framesPerBuffer=256):
+    # Real time loopback, from a command to the first block reflecting it
+
+    server = LoopbackServer(fs, framesPerBuffer, speed=1)
+    server.start()
+    client = connect(server, blockSize)
+    client.sendCmd('frequency', 1000)
+    client.sendCmd('startGen')
+
+    start = time.perf_counter()
+    client.sendCmd('startSend')
+    stream = client.streamData()
+    next(stream)
+    firstData = time.perf_counter() - start
+
+    tolerance = 2 * fs / blockSize
+    latencies = []
+    for i in range(repeats):
+        frequency = 3000 if i % 2 == 0 else 1000
+        start = time.perf_counter()
+        client.sendCmd('frequency', frequency)
+        for block in stream:
+            if abs(peakFrequency(block, fs) - frequency) < tolerance:
+                break
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    server.stop()
+
+    return [result('latency', {'blockSize': blockSize, 'framesPerBuffer': framesPerBuffer,
+                               'fs': fs}, {
+        'firstDataLatency': firstData * 1000,
+        'medianLatency': float(np.median(latencies) * 1000),
+        'maxLatency': float(np.max(latencies) * 1000),
+    })]
+
+
+def benchAnalysis(blockSizes, fs, repeats):
+    # Per block cost of windowing, FFT and averaging, and of the distortion analysis
+
+    results = []
+    rng = np.random.default_rng(0)
+    for blockSize in blockSizes:
+        t = np.arange(blockSize) / fs
+        block = (0.5 * np.sin(2 * np.pi * 1000 * t) * 2**31 +
+                 rng.standard_normal(blockSize) * 1e4).astype(np.int32)
+        for window in WINDOWS:
+            for averaging in AVERAGING:
+                processor = SpectrumProcessor(blockSize, fs, window, averaging,
+                                              fullScale=2**31)
+                # Fill the average first, so the running sum path is timed
+                for i in range(min(averaging, 4)):
+                    spectrum = processor.process(block)
+                processTime = timeCall(lambda: processor.process(block), repeats)
+                distortionTime = timeCall(lambda: analyzeDistortion(spectrum, fs, processor.enbw),
+                                          repeats)
+                results.append(result('analysis', {'blockSize': blockSize, 'window': window,
+                                                   'averaging': averaging, 'fs': fs}, {
+                    'processTime': processTime,
+                    'distortionTime': distortionTime,
+                }))
+        # The per block fast path needs no window and no averaging
+        tracker = HarmonicTracker(blockSize, fs, coherentFrequency(1000, blockSize, fs),
+                                  fullScale=2**31)
+        results.append(result('track', {'blockSize': blockSize, 'fs': fs}, {
+            'trackTime': timeCall(lambda: tracker.process(block), repeats),
+        }))
+
+    return results
+
+
+def benchZoom(blockSize, fs, repeats, size=4096):
+    # Per block cost of the zoom FFT against a full band FFT of the same resolution
+
+    rng = np.random.default_rng(0)
+    t = np.arange(blockSize) / fs
+    block = (0.5 * np.sin(2 * np.pi * 1000 * t) * 2**31 +
+             rng.standard_normal(blockSize) * 1e4).astype(np.int32)
+    results = []
+    for decimation in DECIMATIONS:
+        zoom = ZoomProcessor(fs, 1000, decimation, size, fullScale=2**31)
+        zoomTime = timeCall(lambda: zoom.process(block), repeats)
+        # The full band processor takes a block as long as its FFT
+        full = SpectrumProcessor(decimation * size, fs, fullScale=2**31)
+        long = np.resize(block, decimation * size)
+        fullTime = timeCall(lambda: full.process(long), max(repeats // 4, 1))
+        results.append(result('zoom', {'blockSize': blockSize, 'decimation': decimation,
+                                       'size': size, 'fs': fs}, {
+            'zoomTime': zoomTime,
+            # The full FFT covers decimation * size / blockSize blocks
+            'fullTimePerBlock': fullTime * blockSize / (decimation * size),
+            'resolution': fs / (decimation * size),
+        }))
+
+    return results
+
+
+def benchRender(blockSizes, fs, repeats):
+    # Drawing without a GUI, with matplotlib's Agg canvas
+
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        print("matplotlib is not installed, skipping the render benchmark")
+        return []
+
+    results = []
+    rng = np.random.default_rng(0)
+    for blockSize in blockSizes:
+        bins = blockSize // 2 + 1
+        frequencies = np.arange(bins) * fs / blockSize
+        spectrum = rng.random(bins) * 1e-3
+        harmonics = np.column_stack((1000.0 * np.arange(2, 12), np.full(10, -100.0)))
+
+        fig = Figure(figsize=(10, 8), dpi=100)
+        canvas = FigureCanvasAgg(fig)
+        axes = fig.add_subplot(111)
+        line, = axes.semilogx(frequencies, 20 * np.log10(spectrum + np.finfo(float).eps))
+        markers = axes.scatter(harmonics[:,0], harmonics[:,1], s=36, c='r', zorder=3)
+        axes.axis((10, fs / 2, -140, 5))
+        axes.grid(True)
+
+        def full():
+            line.set_ydata(20 * np.log10(spectrum + np.finfo(float).eps))
+            canvas.draw()
+
+        fullDrawTime = timeCall(full, repeats)
+
+        line.set_animated(True)
+        markers.set_animated(True)
+        canvas.draw()
+        background = canvas.copy_from_bbox(fig.bbox)
+
+        def blit(x, y):
+            line.set_data(x, 20 * np.log10(y + np.finfo(float).eps))
+            canvas.restore_region(background)
+            axes.draw_artist(line)
+            axes.draw_artist(markers)
+
+        blitTime = timeCall(lambda: blit(frequencies, spectrum), repeats)
+
+        def reduced():
+            fmin, fmax = axes.get_xlim()
+            starts, stop, x = pixelBins(bins, fs, fmin, fmax, int(axes.bbox.width))
+            blit(x, minMaxBin(spectrum, starts, stop))
+
+        reducedBlitTime = timeCall(reduced, repeats)
+
+        # A new waterfall row and the image blitted below the spectrum
+        waterfall = Waterfall(frequencies, 10, fs / 2, min(1024, bins))
+        waterfallAxes = fig.add_subplot(212)
+        image = waterfallAxes.imshow(waterfall.image(), aspect='auto', origin='lower',
+                                     interpolation='nearest', vmin=FLOOR, vmax=0, animated=True)
+        canvas.draw()
+        background = canvas.copy_from_bbox(fig.bbox)
+        waterfallAddTime = timeCall(lambda: waterfall.add(rng.random(bins) * 1e-3), repeats)
+
+        def waterfallBlit():
+            waterfall.add(spectrum)
+            image.set_data(waterfall.image())
+            canvas.restore_region(background)
+            waterfallAxes.draw_artist(image)
+
+        waterfallBlitTime = timeCall(waterfallBlit, repeats)
+        results.append(result('render', {'blockSize': blockSize, 'fs': fs}, {
+            'fullDrawTime': fullDrawTime,
+            'blitTime': blitTime,
+            'reducedBlitTime': reducedBlitTime,
+            'waterfallAddTime': waterfallAddTime,
+            'waterfallBlitTime': waterfallBlitTime,
+        }))
+
+    return results
+
+
+def compareResults(results, baseline, tolerance):
+    """
+    Compares results with those of an earlier run. Returns the list of
+    (benchmark, params, metric, baseline value, value) that got worse by
+    more than the relative tolerance.
+    """
+
+    previous = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)): r['metrics']
+                for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get((r['benchmark'], json.dumps(r['params'], sort_keys=True)))
+        if old is None:
+            continue
+        for metric, value in r['metrics'].items():
+            direction = DIRECTIONS.get(metric)
+            if direction is None or metric not in old or old[metric] <= 0:
+                continue
+            change = (value - old[metric]) / old[metric] * direction
+            if change < -tolerance:
+                regressions.append((r['benchmark'], r['params'], metric, old[metric], value))
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmarks against a synthetic loopback server")
+    parser.add_argument('benchmarks', nargs='*',
+                        default=['throughput', 'latency', 'analysis', 'zoom', 'render'],
+                        help="Any of throughput, latency, analysis, zoom and render")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="JSON result file")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON result file of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Relative change counted as a regression")
+    parser.add_argument('--fs', type=int, default=192000)
+    parser.add_argument('-b', '--block-sizes', type=int, nargs='+', default=BLOCKSIZES)
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="Seconds of streaming per throughput run")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    results = []
+    if 'throughput' in args.benchmarks:
+        results += benchThroughput(args.block_sizes, args.fs, args.duration)
+    if 'latency' in args.benchmarks:
+        results += benchLatency(48000, args.repeats)
+    if 'analysis' in args.benchmarks:
+        results += benchAnalysis(args.block_sizes, args.fs, args.repeats)
+    if 'zoom' in args.benchmarks:
+        results += benchZoom(16384, args.fs, args.repeats)
+    if 'render' in args.benchmarks:
+        results += benchRender(args.block_sizes, args.fs, args.repeats)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'fft': analysis.fftpack.__name__,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Results written to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        for benchmark, params, metric, old, new in regressions:
+            print("Regression in", benchmark, params, metric, "from", old, "to", new)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import threading
+import time
+import numpy as np
+
+
+class BlockRing:
+    """
+    Preallocated ring of fixed-size sample blocks.
+
+    One producer (the audio callback) appends samples with write(), which
+    only copies into the preallocated slots. One consumer drains complete
+    blocks in order with read(). Every block gets a sequence number; if the
+    producer laps the consumer the oldest blocks are dropped and counted
+    as overruns.
+    """
+
+    def __init__(self, blockLen=1024, nBlocks=32, dtype=np.int32):
+        self.nBlocks = nBlocks
+        self.dtype = np.dtype(dtype)
+        # Only held by write() and reset(), so the consumer never blocks the
+        # producer and a reset never races with a half written block
+        self.lock = threading.Lock()
+        self.reset(blockLen)
+
+    def reset(self, blockLen=None):
+
+        with self.lock:
+            if blockLen is not None:
+                if blockLen < 1:
+                    # write() would never complete a block
+                    raise ValueError("Block length has to be at least 1")
+                self.blockLen = int(blockLen)
+                self.data = np.zeros((self.nBlocks, self.blockLen), dtype=self.dtype)
+                self.timestamps = np.zeros(self.nBlocks)
+            self.writeSeq = 0       # Number of completed blocks
+            self.writePos = 0       # Samples written into the current block
+            self.readSeq = 0        # Next block to hand to the consumer
+            self.overruns = 0       # Blocks dropped because the consumer was too slow
+
+    def write(self, samples):
+
+        with self.lock:
+            n = len(samples)
+            pos = 0
+            while pos < n:
+                slot = self.writeSeq % self.nBlocks
+                count = min(n - pos, self.blockLen - self.writePos)
+                self.data[slot, self.writePos:self.writePos + count] = samples[pos:pos + count]
+                if self.writePos == 0:
+                    self.timestamps[slot] = time.time()
+                self.writePos += count
+                pos += count
+                if self.writePos == self.blockLen:
+                    self.writePos = 0
+                    self.writeSeq += 1
+
+    def available(self):
+
+        return self.writeSeq - self.readSeq
+
+    def discard(self, keep=1):
+        # Skip ahead so that only the newest keep blocks remain unread. Unlike
+        # overruns this is a deliberate choice of the consumer and not counted.
+        self.readSeq = max(self.readSeq, self.writeSeq - keep)
+
+    def read(self, out=None):
+        """
+        Copy the oldest unread block into out (allocated if None).
+        Returns (seq, overruns, timestamp, block) or None if no block is ready.
+        """
+
+        lag = self.writeSeq - self.readSeq
+        if lag <= 0:
+            return None
+        if lag >= self.nBlocks:
+            # Keep one slot of margin, it may be written to while we copy
+            skipped = lag - self.nBlocks + 1
+            self.overruns += skipped
+            self.readSeq += skipped
+
+        seq = self.readSeq
+        slot = seq % self.nBlocks
+        if out is None:
+            out = np.empty(self.blockLen, dtype=self.dtype)
+        out[:] = self.data[slot]
+        timestamp = self.timestamps[slot]
+
+        if self.writeSeq - seq >= self.nBlocks:
+            # The producer lapped us during the copy, the block is torn
+            self.overruns += 1
+            self.readSeq = seq + 1
+            return self.read(out)
+
+        self.readSeq = seq + 1
+        return (seq, self.overruns, timestamp, out)
@@ -0,0 +1,208 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Levels in dB are relative to a full scale sine, whose power is 1/2
+FULLSCALEPOWER = 0.5
+
+# The leakage skirt of the fundamental ends where the spectrum envelope
+# drops below this factor times the median noise floor
+SKIRTFACTOR = 4
+
+
+def interpolatePeak(spectrum, k):
+    # Fractional bin of the peak at k, from a parabola through the log
+    # magnitudes. Exact for Gaussian shaped main lobes, and close for the
+    # usual windows.
+    if k <= 0 or k >= len(spectrum) - 1:
+        return float(k)
+    a, b, c = np.log(spectrum[k-1:k+2] + np.finfo(float).tiny)
+    denom = a - 2 * b + c
+    if denom >= 0:
+        return float(k)
+
+    return k + 0.5 * (a - c) / denom
+
+
+def analyzeDistortion(spectrum, fs, enbw=1.5, fundamental=None, minFrequency=20,
+                      maxFrequency=20000, maxHarmonics=None, width=None):
+    """
+    Distortion and noise figures of an amplitude spectrum as returned by
+    audioAnalysis.SpectrumProcessor.
+
+    The fundamental is the largest peak above minFrequency unless its
+    frequency is given. Harmonic bins follow from the interpolated
+    fundamental by index arithmetic, and the power of every component is
+    integrated over width bins on each side of its centre, by default
+    enough to cover the main lobe of the window, for the fundamental out
+    to where its leakage meets the noise floor. Everything in the band
+    from minFrequency to maxFrequency that is neither fundamental nor
+    harmonic is counted as noise.
+
+    Returns a dict with THD and THD+N in percent, SINAD and SNR in dB, the
+    integrated Noise and the median NoiseFloor per bin in dB relative to
+    full scale, the Fundamental frequency and Amplitude, and the Harmonics
+    as rows of (frequency, amplitude).
+    """
+
+    bins = len(spectrum)
+    n = 2 * (bins - 1)
+    df = fs / n
+    if width is None:
+        width = int(np.ceil(2 * enbw))
+
+    # A sine of amplitude a sums to a**2 * enbw over its bins, so the power
+    # of any group of bins is sum(A**2) / (2 * enbw)
+    power = spectrum.astype(np.float64)**2 / (2 * enbw)
+    cumPower = np.concatenate(([0.0], np.cumsum(power)))
+
+    lo = max(int(np.ceil(minFrequency / df)), 1)
+    hi = min(int(np.floor(maxFrequency / df)), bins - 1)
+
+    if fundamental is None:
+        k = lo + int(np.argmax(spectrum[lo:hi+1]))
+    else:
+        k = min(max(int(round(fundamental / df)), lo), hi)
+        k = k - 1 + int(np.argmax(spectrum[k-1:k+2]))
+    k0 = interpolatePeak(spectrum, k)
+
+    # Centres of the harmonics inside the band
+    count = int((hi + 0.5) / k0)
+    if maxHarmonics is not None:
+        count = min(count, maxHarmonics)
+    order = np.arange(2, count + 1)
+    centres = np.round(order * k0).astype(int)
+
+    start = np.clip(centres - width, 0, bins)
+    stop = np.clip(centres + width + 1, 0, bins)
+    harmonicPower = cumPower[stop] - cumPower[start]
+
+    # The fundamental takes its whole leakage skirt, otherwise the sidelobes
+    # of a large fundamental would be counted as noise. The skirt stops
+    # halfway to the second harmonic, and a sliding maximum bridges the
+    # nulls between sidelobes.
+    floor = np.median(spectrum[lo:hi+1])
+    reach = max(int(k0 / 2), width)
+    first = max(k - reach, 0)
+    last = min(k + reach + 1, bins)
+    envelope = sliding_window_view(np.pad(spectrum[first:last], width, mode='edge'),
+                                   2 * width + 1).max(axis=1)
+    below = envelope <= SKIRTFACTOR * floor
+    left = below[k-first::-1]
+    right = below[k-first:]
+    fStart = k - (int(np.argmax(left)) if left.any() else k - first)
+    fStop = k + (int(np.argmax(right)) if right.any() else last - 1 - k) + 1
+    fStart = max(min(fStart, k - width), 0)
+    fStop = min(max(fStop, k + width + 1), bins)
+    fundPower = cumPower[fStop] - cumPower[fStart]
+    totalPower = cumPower[hi + 1] - cumPower[lo]
+
+    # The union of all harmonic bins, so that close harmonics at low
+    # resolution are not counted twice
+    mask = np.zeros(bins, dtype=bool)
+    if len(centres):
+        mask[(centres[:,np.newaxis] + np.arange(-width, width + 1)).clip(0, bins - 1)] = True
+    mask[fStart:fStop] = False
+    mask[:lo] = False
+    mask[hi+1:] = False
+    distPower = np.sum(power[mask])
+
+    noisePower = max(totalPower - fundPower - distPower, np.finfo(float).tiny)
+    residualPower = max(totalPower - fundPower, np.finfo(float).tiny)
+    fundPower = max(fundPower, np.finfo(float).tiny)
+
+    harmonics = np.empty((len(order), 2))
+    harmonics[:,0] = order * k0 * df
+    harmonics[:,1] = np.sqrt(2 * harmonicPower)
+
+    return {
+        'Fundamental': k0 * df,
+        'Amplitude': np.sqrt(2 * fundPower),
+        'Harmonics': harmonics,
+        'THD': np.sqrt(distPower / fundPower) * 100,
+        'THD+N': np.sqrt(residualPower / fundPower) * 100,
+        'SINAD': 10 * np.log10(totalPower / residualPower),
+        'SNR': 10 * np.log10(fundPower / noisePower),
+        'Noise': 10 * np.log10(noisePower / FULLSCALEPOWER),
+        'NoiseFloor': 20 * np.log10(floor + np.finfo(float).eps),
+    }
+
+
+def coherentFrequency(frequency, blockSize, fs, odd=True):
+    # Closest frequency with a whole, by default odd, number of cycles per block
+    cycles = max(np.round(blockSize * frequency / fs), 1)
+    if odd:
+        cycles = np.floor(cycles / 2) * 2 + 1
+
+    return cycles * fs / blockSize
+
+
+class HarmonicTracker:
+    """
+    Distortion figures of every block from the fundamental and its
+    harmonics only, without a full spectrum.
+
+    The cosine and sine of every harmonic are precomputed as the columns
+    of one matrix, so a block of all channels costs a single matrix
+    product of blockSize times twice the number of harmonics, plus the
+    total power for THD+N. No window is applied, which is exact when the
+    fundamental is coherent, a whole number of cycles per block as from
+    coherentFrequency, and leaks otherwise.
+    """
+
+    def __init__(self, blockSize, fs, fundamental, maxHarmonics=10, maxFrequency=20000,
+                 fullScale=1.0, channels=1):
+
+        self.blockSize = blockSize
+        self.fs = fs
+        self.fundamental = fundamental
+        self.fullScale = fullScale
+        self.channels = channels
+        order = np.arange(1, maxHarmonics + 1)
+        order = order[(order == 1) | (order * fundamental <= min(maxFrequency, fs / 2))]
+        self.frequencies = order * fundamental
+        phase = 2 * np.pi / fs * np.outer(np.arange(blockSize), self.frequencies)
+        self.basis = np.hstack((np.cos(phase), np.sin(phase)))
+        self.stats = None
+
+    def process(self, block, continuous=True):
+        """
+        A dict per channel with the same keys as analyzeDistortion except
+        NoiseFloor, and for channels after the first the Gain in dB and
+        Phase in degrees of their fundamental relative to the first. Noise
+        is that of the whole band up to fs / 2.
+        """
+
+        x = block.reshape(-1, self.channels).T.astype(np.float64)
+        k = len(self.frequencies)
+        n = self.blockSize
+        projection = x @ self.basis
+        components = (projection[:,:k] - 1j * projection[:,k:]) * (2 / (n * self.fullScale))
+        amplitudes = np.abs(components)
+
+        # Power of everything but DC, relative to a full scale sine
+        mean = x.mean(axis=1)
+        total = (np.einsum('ij,ij->i', x, x) / n - mean**2) / (self.fullScale**2 * FULLSCALEPOWER)
+        fundPower = np.maximum(amplitudes[:,0]**2, np.finfo(float).tiny)
+        distPower = np.sum(amplitudes[:,1:]**2, axis=1)
+        residualPower = np.maximum(total - fundPower, np.finfo(float).tiny)
+        noisePower = np.maximum(residualPower - distPower, np.finfo(float).tiny)
+
+        measurements = []
+        for c in range(self.channels):
+            m = {
+                'Fundamental': self.fundamental,
+                'Amplitude': amplitudes[c,0],
+                'Harmonics': np.column_stack((self.frequencies[1:], amplitudes[c,1:])),
+                'THD': np.sqrt(distPower[c] / fundPower[c]) * 100,
+                'THD+N': np.sqrt(residualPower[c] / fundPower[c]) * 100,
+                'SINAD': 10 * np.log10(max(total[c], np.finfo(float).tiny) / residualPower[c]),
+                'SNR': 10 * np.log10(fundPower[c] / noisePower[c]),
+                'Noise': 10 * np.log10(noisePower[c]),
+            }
+            if c > 0:
+                ratio = components[c,0] / (components[0,0] + np.finfo(float).tiny)
+                m['Gain'] = 20 * np.log10(np.abs(ratio) + np.finfo(float).tiny)
+                m['Phase'] = np.degrees(np.angle(ratio))
+            measurements.append(m)
+
+        return measurements
@@ -0,0 +1,160 @@
+import numpy as np
+
+FULLSCALE = 2**31-1
+
+# Standard intermodulation test signals as (frequency, relative amplitude)
+SMPTE = ((60.0, 0.8), (7000.0, 0.2))
+CCIF = ((19000.0, 0.5), (20000.0, 0.5))
+
+
+class SignalGenerator:
+    """
+    Phase continuous signal generator for the audio callback.
+
+    All work buffers are allocated up front for the largest block size, and
+    render() only computes into them with out= arguments. Every tone keeps
+    its own phase accumulator which is carried over between blocks, so
+    frequency changes and sweeps never produce phase jumps.
+    """
+
+    def __init__(self, fs=192000, maxFrames=65536):
+
+        self.fs = fs
+        self.amplitude = 1.0
+        self.active = False
+        self.sweepPos = 0
+        self.setTone(1000)
+        self.allocate(maxFrames)
+
+    def allocate(self, maxFrames):
+
+        self.maxFrames = maxFrames
+        self.ramp = np.arange(maxFrames, dtype=np.float64)
+        self.phaseBuf = np.empty(maxFrames)
+        self.toneBuf = np.empty(maxFrames)
+        self.mixBuf = np.empty(maxFrames)
+        self.out = np.zeros(maxFrames, dtype=np.int32)
+
+    def setFs(self, fs):
+
+        self.fs = fs
+        self.sweepPos = 0
+
+    def setTone(self, frequency, amplitude=1.0):
+
+        self.setTones(((frequency, amplitude),))
+
+    def setTones(self, tones):
+        # tones is a sequence of (frequency, relative amplitude)
+        frequencies = np.array([t[0] for t in tones], dtype=np.float64)
+        levels = np.array([t[1] for t in tones], dtype=np.float64)
+        # Keep the phase of the tones that were already playing
+        oldPhases = self.tones[2] if hasattr(self, 'tones') else np.zeros(0)
+        phases = np.zeros(len(tones))
+        n = min(len(oldPhases), len(tones))
+        phases[:n] = oldPhases[:n]
+        # Replaced in one assignment, render() may run in another thread
+        self.sweep = None
+        self.tones = (frequencies, levels, phases)
+
+    def setSweep(self, f1, f2, duration, log=True, repeat=True):
+
+        sweep = (float(f1), float(f2), float(duration), bool(log), bool(repeat))
+        self.sweepEndPhase = np.remainder(self.sweepPhaseAt(np.array([duration]), np.empty(1), sweep)[0],
+                                          2 * np.pi)
+        self.sweepPos = 0
+        phases = self.tones[2][:1].copy() if len(self.tones[2]) else np.zeros(1)
+        self.tones = (np.array([float(f1)]), np.ones(1), phases)
+        self.sweep = sweep
+
+    def reset(self):
+
+        self.tones[2][:] = 0
+        self.sweepPos = 0
+
+    def sweepPhaseAt(self, t, out, sweep):
+        # Closed form phase of the sweep at t seconds after its start,
+        # evaluated in place in t. out is used as scratch.
+        f1, f2, duration, log, repeat = sweep
+        if log:
+            k = duration / np.log(f2 / f1)
+            np.multiply(t, 1 / k, out=t)
+            np.expm1(t, out=t)
+            np.multiply(t, 2 * np.pi * f1 * k, out=t)
+        else:
+            np.multiply(t, (f2 - f1) / (2 * duration), out=out)
+            np.add(out, f1, out=out)
+            np.multiply(t, out, out=t)
+            np.multiply(t, 2 * np.pi, out=t)
+
+        return t
+
+    def sweepPhase(self, n, phase, sweep, phases):
+        # Sweep phase of the next n frames. The analytic phase is used instead
+        # of integrating the frequency, so the signal matches the ideal sweep
+        # exactly, and every restart continues from the phase where the
+        # previous sweep ended.
+        f1, f2, duration, log, repeat = sweep
+        length = duration * self.fs
+        t = self.toneBuf[:n]
+        np.add(self.ramp[:n], self.sweepPos, out=t)
+        if repeat:
+            np.divide(t, length, out=phase)
+            np.floor(phase, out=phase)
+            np.multiply(phase, self.sweepEndPhase, out=phase)
+            np.remainder(t, length, out=t)
+        else:
+            # Hold the end frequency after a single sweep
+            np.subtract(t, length, out=phase)
+            np.maximum(phase, 0, out=phase)
+            np.multiply(phase, 2 * np.pi * f2 / self.fs, out=phase)
+            np.minimum(t, length, out=t)
+        np.multiply(t, 1 / self.fs, out=t)
+        np.add(phase, self.sweepPhaseAt(t, self.mixBuf[:n], sweep), out=phase)
+        np.add(phase, phases[0], out=phase)
+
+        self.sweepPos += n
+        if repeat and self.sweepPos >= length:
+            cycles = self.sweepPos // length
+            phases[0] = np.remainder(phases[0] + cycles * self.sweepEndPhase, 2 * np.pi)
+            self.sweepPos -= cycles * length
+
+        return phase
+
+    def render(self, n):
+        """
+        Generate the next n frames as int32. Returns a view into the output
+        buffer, which is overwritten on the next call.
+        """
+
+        if n > self.maxFrames:
+            self.allocate(n)
+
+        out = self.out[:n]
+        if (not self.active) or n == 0:
+            out[:] = 0
+            return out
+
+        mix = self.mixBuf[:n]
+        phase = self.phaseBuf[:n]
+        sweep = self.sweep
+        frequencies, levels, phases = self.tones
+        if sweep is not None:
+            np.sin(self.sweepPhase(n, phase, sweep, phases), out=mix)
+        else:
+            mix[:] = 0
+            tone = self.toneBuf[:n]
+            for i in range(len(frequencies)):
+                step = 2 * np.pi * frequencies[i] / self.fs
+                np.multiply(self.ramp[:n], step, out=phase)
+                np.add(phase, phases[i], out=phase)
+                np.sin(phase, out=tone)
+                np.multiply(tone, levels[i], out=tone)
+                np.add(mix, tone, out=mix)
+                phases[i] = np.remainder(phases[i] + n * step, 2 * np.pi)
+
+        np.multiply(mix, self.amplitude * FULLSCALE, out=mix)
+        np.clip(mix, -FULLSCALE, FULLSCALE, out=mix)
+        np.copyto(out, mix, casting='unsafe')
+
+        return out
@@ -0,0 +1,184 @@
+import time
+import asyncio
+import argparse
+import threading
+import numpy as np
+from audioServer import AudioServer, PORT, FULLSCALE
+from audioGenerator import SignalGenerator
+
+# Samples of precomputed noise, cycled from a random offset every block
+NOISELENGTH = 1 << 18
+
+
+class LoopbackServer(AudioServer):
+    """
+    Stand-in for AudioServer that needs neither PyAudio nor audio hardware,
+    speaking the same protocol to the same clients.
+
+    The generator output is looped back to the input one buffer later, as
+    with a cable from output to input, and a fixed tone is captured while
+    the generator is off and no measurement runs. Noise at the given level
+    relative to full scale is added to everything, independently on every
+    channel, and crosstalk adds that fraction of every other output
+    channel to each input. With speed 1 buffers are produced in real
+    time, with larger values that much faster, and with 0 as fast as
+    possible.
+    """
+
+    def __init__(self, fs=192000, framesPerBuffer=4096, frequency=1000, amplitude=0.5,
+                 noise=1e-5, speed=1, channels=1, crosstalk=1e-4):
+
+        super(LoopbackServer, self).__init__(fs, channels, framesPerBuffer)
+
+        self.tone = SignalGenerator(fs, framesPerBuffer)
+        self.tone.setTone(frequency)
+        self.tone.amplitude = amplitude
+        self.tone.active = True
+        self.noise = noise * FULLSCALE * np.random.default_rng().standard_normal(NOISELENGTH)
+        self.speed = speed
+        self.crosstalk = crosstalk
+
+        self.thread = None
+        self.running = False
+        self.serverThread = None
+        self.stopEvent = None
+
+    def allocate(self):
+
+        super(LoopbackServer, self).allocate()
+        shape = (self.framesPerBuffer, self.channels)
+        self.mix = np.empty(shape)
+        self.inData = np.empty(shape, dtype=np.int32)
+
+    def setStream(self, fs, framesPerBuffer, channels):
+
+        super(LoopbackServer, self).setStream(fs, framesPerBuffer, channels)
+        self.tone.setFs(fs)
+        if framesPerBuffer > self.tone.maxFrames:
+            self.tone.allocate(framesPerBuffer)
+
+    def nextInput(self, outData):
+        # Last output, or the fixed tone on every channel, plus noise
+        n = self.framesPerBuffer
+        if self.generator.active or self.measurement is not None:
+            source = outData.reshape(n, -1)
+            if self.channels > 1 and self.crosstalk:
+                # Each input also picks up the sum of the other outputs
+                total = source.sum(axis=1, keepdims=True, dtype=np.float64)
+                np.multiply(total - source, self.crosstalk, out=self.mix)
+                np.add(self.mix, source, out=self.mix)
+                source = self.mix
+        else:
+            source = self.tone.render(n)[:,np.newaxis]
+        offset = np.random.randint(NOISELENGTH - n * self.channels)
+        noise = self.noise[offset:offset + n * self.channels].reshape(n, self.channels)
+        np.add(source, noise, out=self.mix)
+        np.clip(self.mix, -FULLSCALE, FULLSCALE - 1, out=self.mix)
+        np.copyto(self.inData, self.mix, casting='unsafe')
+
+        return self.inData
+
+    def run(self):
+
+        n = self.framesPerBuffer
+        outData = np.zeros((n, self.channels), dtype=np.int32)
+        deadline = time.monotonic()
+        while self.running:
+            inData = self.nextInput(outData)
+            outData = self.processAudio(inData.tobytes(), n)
+            if self.speed > 0:
+                deadline += n / self.fs / self.speed
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, do not try to catch up in a burst
+                    deadline = time.monotonic()
+
+    def openAudio(self):
+        pass
+
+    def closeAudio(self):
+        pass
+
+    def openStream(self):
+
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def streamOpen(self):
+
+        return self.thread is not None
+
+    def closeStream(self):
+
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+
+    async def serveUntilStopped(self, host, port):
+
+        self.stopEvent = asyncio.Event()
+        task = asyncio.ensure_future(self.serve(host, port))
+        await self.stopEvent.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def start(self, host='127.0.0.1', port=0, timeout=5.0):
+        """
+        Serve from a background thread, for benchmarks and tests. Returns
+        the port, which is picked by the system when port is 0.
+        """
+
+        self.serverThread = threading.Thread(target=asyncio.run,
+                                             args=(self.serveUntilStopped(host, port),),
+                                             daemon=True)
+        self.serverThread.start()
+        end = time.monotonic() + timeout
+        while self.address is None:
+            if time.monotonic() > end or not self.serverThread.is_alive():
+                raise RuntimeError("Loopback server did not start")
+            time.sleep(0.01)
+
+        return self.address[1]
+
+    def stop(self):
+
+        if self.serverThread is not None:
+            self.loop.call_soon_threadsafe(self.stopEvent.set)
+            self.serverThread.join()
+            self.serverThread = None
+            self.address = None
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Audio server with synthetic loopback capture")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--fs', type=int, default=192000)
+    parser.add_argument('--frames', type=int, default=4096, help="Frames per buffer")
+    parser.add_argument('--frequency', type=float, default=1000,
+                        help="Tone captured while the generator is off")
+    parser.add_argument('--amplitude', type=float, default=0.5)
+    parser.add_argument('--noise', type=float, default=1e-5, help="Noise level relative to full scale")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="Rate relative to real time, 0 for as fast as possible")
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--crosstalk', type=float, default=1e-4,
+                        help="Fraction of the other outputs picked up by every input")
+    args = parser.parse_args(argv)
+
+    server = LoopbackServer(args.fs, args.frames, args.frequency, args.amplitude, args.noise,
+                            args.speed, args.channels, args.crosstalk)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
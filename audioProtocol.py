@@ -0,0 +1,246 @@
+import json
+import zlib
+import struct
+from collections import namedtuple
+import numpy as np
+
+# Every frame starts with the same fixed size little endian header:
+# magic, version, frame type, payload length, sample dtype, channels, flags,
+# sampling rate, block sequence number, overrun count, capture timestamp
+MAGIC = b'AA'
+VERSION = 1
+HEADER = struct.Struct('<2sBBIBBHIQId')
+
+FRAME_DATA = 1
+FRAME_COMMAND = 2
+FRAME_SPECTRUM = 3      # One sided magnitude spectrum, float32
+FRAME_BINNED = 4        # Log frequency bands as (frequency, magnitude) rows
+FRAME_HARMONICS = 5     # Harmonics as (frequency, magnitude) rows
+FRAME_STATS = 6         # Pipeline statistics as UTF-8 JSON
+FRAME_SWEEP = 7         # Capture of a sweep measurement, aligned with its start
+FRAME_SHARED = 8        # Name of the shared memory ring as UTF-8 JSON, empty when not in use
+FRAME_CONFIG = 9        # Effective settings after a 'configure' command as UTF-8 JSON
+
+# Frame types whose payload is UTF-8 JSON
+JSONFRAMES = (FRAME_STATS, FRAME_SHARED, FRAME_CONFIG)
+
+# Frame types whose payload is a float32 array of (frequency, value) rows
+PAIRFRAMES = (FRAME_BINNED, FRAME_HARMONICS)
+
+# Header flags of data frames. Compression is lossless, the header still
+# gives the sample type and the payload length after compression.
+FLAG_ZLIB = 1       # Payload compressed with zlib
+FLAG_DELTA = 2      # Integer samples as differences to the previous frame of the channel
+FLAG_SHUFFLE = 4    # Bytes grouped by significance, least significant first
+
+# Server side processing modes for the 'spectrum' command
+SPECTRUM_OFF = 0
+SPECTRUM_MAGNITUDE = 1
+SPECTRUM_BINNED = 2
+SPECTRUM_HARMONICS = 3
+SPECTRUM_TRACK = 4      # Harmonics of the generator frequency of every block, no FFT
+
+# Commands are a code followed by one or more float64 arguments
+COMMAND = struct.Struct('<H')
+
+COMMANDS = {
+    'idle': 0,
+    'dataSize': 1,
+    'frequency': 2,
+    'fs': 3,
+    'startGen': 4,
+    'stopGen': 5,
+    'startSend': 6,
+    'stopSend': 7,
+    'decimation': 8,
+    'sendInterval': 9,
+    'amplitude': 10,
+    'tones': 11,
+    'sweep': 12,
+    'spectrum': 13,
+    'window': 14,
+    'averaging': 15,
+    'stats': 16,
+    'channels': 17,
+    'outputs': 18,
+    'format': 19,
+    'compression': 20,
+    'measure': 21,
+    'shared': 22,
+    'configure': 23,
+}
+COMMANDNAMES = {code: name for name, code in COMMANDS.items()}
+
+# Settings of the 'configure' command. Its arguments are a request id and
+# pairs of setting code and value, all applied together.
+CONFIGKEYS = {
+    'fs': 0,
+    'framesPerBuffer': 1,
+    'channels': 2,
+    'frequency': 3,
+    'amplitude': 4,
+    'generator': 5,     # 1 to start, 0 to stop
+    'outputs': 6,       # Bit c set drives output channel c
+    'dataSize': 7,
+    'decimation': 8,
+}
+CONFIGNAMES = {code: name for name, code in CONFIGKEYS.items()}
+
+DTYPES = {
+    0: np.dtype(np.uint8),
+    1: np.dtype(np.int16),
+    2: np.dtype(np.int32),
+    3: np.dtype(np.float32),
+    4: np.dtype(np.float64),
+}
+DTYPECODES = {dtype: code for code, dtype in DTYPES.items()}
+
+# Sample types the server can send data in, int32 being the capture format
+TRANSPORTDTYPES = (np.dtype(np.int32), np.dtype(np.int16), np.dtype(np.float32))
+
+FrameHeader = namedtuple('FrameHeader', ['frameType', 'length', 'dtype', 'channels',
+                                         'flags', 'sampleRate', 'seq', 'overruns',
+                                         'timestamp'])
+
+
+def packHeader(frameType, length, dtype=np.uint8, channels=1, flags=0,
+               sampleRate=0, seq=0, overruns=0, timestamp=0.0):
+
+    return HEADER.pack(MAGIC, VERSION, frameType, length, DTYPECODES[np.dtype(dtype)],
+                       channels, flags, int(sampleRate), seq, overruns, timestamp)
+
+
+def unpackHeader(data):
+
+    magic, version, frameType, length, dtypeCode, channels, flags, sampleRate, \
+        seq, overruns, timestamp = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise RuntimeError("Bad frame magic {}".format(magic))
+    if version != VERSION:
+        raise RuntimeError("Unsupported protocol version {}".format(version))
+    if dtypeCode not in DTYPES:
+        raise RuntimeError("Unknown sample type {}".format(dtypeCode))
+
+    return FrameHeader(frameType, length, DTYPES[dtypeCode], channels, flags,
+                       sampleRate, seq, overruns, timestamp)
+
+
+def packCommand(msg, arg=0, *args):
+
+    args = (arg,) + args
+    payload = COMMAND.pack(COMMANDS[msg]) + struct.pack('<%dd' % len(args), *args)
+    return packHeader(FRAME_COMMAND, len(payload)) + payload
+
+
+def unpackCommand(payload):
+    # Returns the command name and the tuple of its arguments
+    code, = COMMAND.unpack_from(payload)
+    args = struct.unpack_from('<%dd' % ((len(payload) - COMMAND.size) // 8), payload, COMMAND.size)
+    return (COMMANDNAMES.get(code, code), args)
+
+
+def packDataHeader(data, sampleRate=0, seq=0, overruns=0, timestamp=0.0, channels=1,
+                   frameType=FRAME_DATA, flags=0, length=None):
+    # length is that of the encoded payload when it differs from data.nbytes
+
+    if length is None:
+        length = data.nbytes
+    return packHeader(frameType, length, data.dtype, channels, flags, sampleRate,
+                      seq, overruns, timestamp)
+
+
+def fullScale(dtype):
+    # Full scale of the samples of a data frame
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        return 2.0**(8 * dtype.itemsize - 1)
+
+    return 1.0
+
+
+def encodePayload(data, flags, channels=1, level=1):
+    """
+    Payload bytes of a contiguous sample array with the given flags
+    applied. FLAG_DELTA is only valid for integer samples, the differences
+    wrap around like the samples do, so decoding restores them exactly.
+    """
+
+    if flags & FLAG_DELTA:
+        frames = data.reshape(-1, channels)
+        delta = np.empty_like(frames)
+        delta[:1] = frames[:1]
+        np.subtract(frames[1:], frames[:-1], out=delta[1:])
+        data = delta.reshape(-1)
+    if flags & FLAG_SHUFFLE:
+        data = data.view(np.uint8).reshape(-1, data.itemsize).T
+    payload = np.ascontiguousarray(data).view(np.uint8)
+    if flags & FLAG_ZLIB:
+        return zlib.compress(payload, level)
+
+    return payload.tobytes()
+
+
+def decodePayload(header, payload):
+    # Typed view of a data or spectrum payload, or the dict of a JSON frame.
+    # Data of several channels comes as a (frames, channels) view of the
+    # interleaved samples, spectra with the channels in rows.
+
+    if header.frameType in JSONFRAMES:
+        return json.loads(bytes(payload).decode('utf-8'))
+
+    flags = header.flags
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    if flags & FLAG_SHUFFLE:
+        planes = np.frombuffer(payload, dtype=np.uint8).reshape(header.dtype.itemsize, -1)
+        payload = np.ascontiguousarray(planes.T)
+    data = np.frombuffer(payload, dtype=header.dtype)
+    if flags & FLAG_DELTA:
+        data = np.cumsum(data.reshape(-1, header.channels), axis=0,
+                         dtype=header.dtype).reshape(-1)
+    if header.frameType in PAIRFRAMES:
+        data = data.reshape(-1, 2)
+    elif header.frameType == FRAME_SWEEP:
+        data = data.reshape(-1, header.channels)
+    elif header.channels > 1 and header.frameType == FRAME_DATA:
+        data = data.reshape(-1, header.channels)
+    elif header.channels > 1 and header.frameType == FRAME_SPECTRUM:
+        data = data.reshape(header.channels, -1)
+
+    return data
+
+
+class FrameParser:
+    """
+    Incremental frame splitter for non-blocking readers.
+    Bytes are appended with feed(), complete frames are taken out of
+    the buffer as (header, payload) pairs when iterating.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                raise StopIteration
+            self.header = unpackHeader(self.buffer[:HEADER.size])
+            del self.buffer[:HEADER.size]
+
+        if len(self.buffer) < self.header.length:
+            raise StopIteration
+
+        header = self.header
+        payload = bytes(self.buffer[:header.length])
+        del self.buffer[:header.length]
+        self.header = None
+
+        return (header, payload)
@@ -0,0 +1,236 @@
+import os
+import time
+import struct
+import threading
+import numpy as np
+import audioProtocol as proto
+from audioSocket import DataSocket
+
+# Blocks mapped at a time while recording
+CHUNKBLOCKS = 64
+
+# Per block index stored next to the samples
+INDEXDTYPE = np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('overruns', '<u4'),
+                       ('sampleRate', '<u4')])
+
+# Room reserved in the header for the final shape
+HEADERLENGTH = 256
+
+
+def indexPath(path):
+
+    return os.path.splitext(path)[0] + '.index.npy'
+
+
+def npyHeader(dtype, shape):
+    # NPY version 1.0 header padded to a fixed length, so it can be
+    # rewritten in place with the final shape
+    d = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    if len(d) > HEADERLENGTH - 11:
+        raise ValueError("NPY header too long for {}".format(dtype))
+    header = d.ljust(HEADERLENGTH - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpyAppender:
+    """
+    Appends rows to an NPY file through a small memory mapped window, so
+    the file can grow without bound while memory use stays constant.
+    """
+
+    def __init__(self, path, dtype, rowShape=(), chunkRows=CHUNKBLOCKS):
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rowShape = tuple(rowShape)
+        self.rowBytes = self.dtype.itemsize * int(np.prod(self.rowShape, dtype=int))
+        self.chunkRows = chunkRows
+        self.rows = 0
+        self.map = None
+        self.mapStart = 0
+        self.file = open(path, 'wb+')
+        self.file.write(npyHeader(self.dtype, (0,) + self.rowShape))
+
+    def mapChunk(self):
+
+        if self.map is not None:
+            self.map.flush()
+            del self.map
+        self.mapStart = self.rows
+        end = HEADERLENGTH + (self.rows + self.chunkRows) * self.rowBytes
+        self.file.truncate(end)
+        self.map = np.memmap(self.file, dtype=self.dtype, mode='r+',
+                             offset=HEADERLENGTH + self.rows * self.rowBytes,
+                             shape=(self.chunkRows,) + self.rowShape)
+
+    def append(self, row):
+
+        if self.map is None or self.rows - self.mapStart >= self.chunkRows:
+            self.mapChunk()
+        self.map[self.rows - self.mapStart] = row
+        self.rows += 1
+
+    def close(self):
+
+        if self.map is not None:
+            self.map.flush()
+            del self.map
+            self.map = None
+        self.file.truncate(HEADERLENGTH + self.rows * self.rowBytes)
+        self.file.seek(0)
+        self.file.write(npyHeader(self.dtype, (self.rows,) + self.rowShape))
+        self.file.close()
+
+
+class Recorder:
+    """
+    Records received blocks to path as an NPY array of shape (blocks,
+    blockSize), or (blocks, blockSize, channels) for several channels,
+    with the sequence number, capture timestamp, overrun count and sampling
+    rate of every block in a structured NPY array next to it. All blocks
+    must have the same size and type as the first one.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.samples = None
+        self.index = NpyAppender(indexPath(path), INDEXDTYPE, chunkRows=4096)
+        self.entry = np.zeros((), dtype=INDEXDTYPE)
+
+    def write(self, block, header):
+
+        if self.samples is None:
+            self.samples = NpyAppender(self.path, block.dtype, block.shape)
+        elif block.shape != self.samples.rowShape:
+            # Recording a changed block size would need a new file
+            return False
+        self.samples.append(block)
+        self.entry['seq'] = header.seq
+        self.entry['timestamp'] = header.timestamp
+        self.entry['overruns'] = header.overruns
+        self.entry['sampleRate'] = header.sampleRate
+        self.index.append(self.entry)
+
+        return True
+
+    def close(self):
+
+        if self.samples is not None:
+            self.samples.close()
+        self.index.close()
+
+
+class ReplaySocket:
+    """
+    Plays a recording back through the same interface as DataSocket.
+    With realtime set blocks are paced by their capture timestamps,
+    otherwise they are delivered as fast as they are consumed.
+    """
+
+    def __init__(self, path, realtime=True, loop=False):
+
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.samples = np.load(path, mmap_mode='r')
+        self.index = np.load(indexPath(path), mmap_mode='r')
+        self.position = 0
+        self.closed = False
+
+        self.seq = -1
+        self.overruns = 0
+        self.lostBlocks = 0
+        self.lastGap = 0
+        self.header = None
+        self.serverStats = None
+        self.measurement = None
+        self.stats = None
+
+        self.settings = None
+        self.configId = 0
+        self.settingsChanged = threading.Condition()
+
+    def connect(self, host=None, port=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def setDataLen(self, dataLen):
+        pass
+
+    def sendCmd(self, msg, arg=0, *args):
+        # A recording can not be reconfigured, commands are accepted and ignored
+        return True
+
+    def setFormat(self, dtypes, compression=0, level=1):
+        return True
+
+    def configure(self, **settings):
+        # Answered right away with what the recording was made with
+        self.configId += 1
+        entry = self.index[0]
+        channels = self.samples.shape[2] if self.samples.ndim > 2 else 1
+        self.updateSettings({'fs': int(entry['sampleRate']), 'channels': channels,
+                             'dataSize': self.samples.shape[1], 'id': self.configId,
+                             'error': "A recording can not be reconfigured"})
+        return self.configId
+
+    def measure(self, kind, f1, f2, duration, pointsPerOctave=6, tail=0.5):
+        # Nothing is played back to measure
+        return False
+
+    updateSequence = DataSocket.updateSequence
+    updateSettings = DataSocket.updateSettings
+    waitSettings = DataSocket.waitSettings
+    isConsecutive = DataSocket.isConsecutive
+
+    def nextBlock(self):
+        # Returns the next block as a view into the mapped file, or None at the end
+
+        if self.position >= len(self.samples):
+            if not self.loop or len(self.samples) == 0:
+                return None
+            self.position = 0
+            self.seq = -1
+        entry = self.index[self.position]
+        block = self.samples[self.position]
+        self.position += 1
+        channels = block.shape[1] if block.ndim > 1 else 1
+        header = proto.FrameHeader(proto.FRAME_DATA, block.nbytes, block.dtype, channels, 0,
+                                   int(entry['sampleRate']), int(entry['seq']),
+                                   int(entry['overruns']), float(entry['timestamp']))
+        self.updateSequence(header)
+
+        return block
+
+    def streamData(self, poolSize=4, frameTypes=(proto.FRAME_DATA,)):
+
+        while not self.closed:
+            block = self.nextBlock()
+            if block is None:
+                return
+            if self.realtime:
+                if self.position == 1:
+                    start = (time.monotonic(), self.header.timestamp)
+                    count = 0
+                if self.header.timestamp > 0:
+                    target = self.header.timestamp - start[1]
+                else:
+                    # No capture times, pace by the block length instead
+                    target = count * len(block) / self.header.sampleRate
+                count += 1
+                delay = target - (time.monotonic() - start[0])
+                if delay > 0:
+                    time.sleep(delay)
+            yield block
+
+    def receiveData(self, frameTypes=(proto.FRAME_DATA,)):
+
+        block = self.nextBlock()
+        if block is None:
+            return np.zeros(0)
+
+        return np.array(block)
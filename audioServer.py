@@ -1,156 +1,857 @@
-import select
+import json
+import asyncio
 import socket
-import sys
-import pickle
 import time
 import numpy as np
-import pyaudio
+try:
+    import pyaudio
+except ImportError:
+    # Only needed for real capture, audioLoopback serves without it
+    pyaudio = None
+from audioBuffer import BlockRing
+from audioShared import SharedRing
+from audioGenerator import SignalGenerator
+import audioAnalysis as analysis
+from audioDistortion import analyzeDistortion, HarmonicTracker
+import audioProtocol as proto
+import audioSweep
+from audioStats import PipelineStats
 
 MAXDATALEN = 2048
 
 DATALENGTH = 1024
 
-sendData = False
-dataLength = 4
-frequency = 1000
-fs = 192000
-amplitude = 2**31-1
-startIdx = 0
-generatorActive = False
-audioStream = None
-measurementData = None
-		
-def sendMyData(sock, data):
-		
-	totalsent = 0
-	d = bytes(data)
-		
-	while totalsent < len(d):
-		sent = sock.send(d[totalsent:])
-		if sent == 0:
-			raise RuntimeError("Socket connection broken")
-		totalsent += sent
-	
-	return totalsent
-	
-def audioCallback(inData, frameCount, timeInfo, status):
-    
-    global startIdx, measurementData
-    
-    if generatorActive:
-        t = (startIdx + np.arange(frameCount)) / fs
-        t = t.reshape(-1, 1)
-        outData = (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.int32)
-        startIdx += frameCount
-    else:
-        outData = np.zeros(frameCount)
-        
-    if any(inData):
-        measurementData = np.frombuffer(inData, dtype=np.float32)[:dataLength]
-    else:
-        measurementData = None
-        #print(len(inData))
-        
-    return (outData.astype(np.int32).tobytes(), pyaudio.paContinue)
-
-p = pyaudio.PyAudio()
-
-# Create a TCP/IP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#server.setblocking(0)
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-# Bind the socket to the port
-server_address = ('0.0.0.0', 10000)
-print('starting up on %s port %s' % server_address)
-sock.bind(server_address)
-
-# Listen for incoming connections
-sock.listen(5)
-
-while True:
-	print("Waiting for a connection")
-	connection, client_address = sock.accept()
-	
-	try:
-		print("Connection from", client_address)
-		audioStream = p.open(format=pyaudio.paInt32, channels=1, rate=fs, output=True,
-		                     input=True, input_device_index=0, output_device_index=0,
-		                     frames_per_buffer=65536, stream_callback=audioCallback)
-		
-		while(True):
-			try:
-				data = connection.recv(1024)
-			except:
-				data = None
-				connection.close()
-				print("No data")
-				break
-			if data:
-				d = pickle.loads(data)
-				if type(d) is list:
-					cmd = d[0]
-					if len(d) > 1:
-						arg = d[1]
-					if cmd == 'dataSize':
-						print("Set data size to", arg)
-						dataLength = arg
-					elif cmd == 'frequency':
-					    print("Set generator frequency to", arg)
-					    frequency = arg
-					elif cmd == 'fs':
-					    print("Set sampling frequency to", arg)
-					    fs = arg
-					elif cmd == 'startGen':
-					    print("Starting generator")
-					    if not generatorActive:
-					        generatorActive = True
-					        startIdx = 0
-					elif cmd == 'stopGen':
-					    print("Stopping generator")
-					    if generatorActive:
-					        generatorActive = False
-					elif cmd == 'startSend':
-						print("Start sending data")
-						if not sendData:
-						    sendData = True
-						    audioStream.start_stream()
-					elif cmd == 'stopSend':
-						print("Stop sending data")
-						if sendData:
-						    sendData = False
-					elif cmd != 'idle':
-						break
-			else:
-				print("No data from", client_address)
-				if not sendData:
-					break
-			
-			if sendData:
-				try:
-					#if measurementData is None:
-					#	measurementData = np.ones(dataLength)
-					if not measurementData is None:
-					    mData = measurementData.copy()
-					else:
-					    mData = np.random.randn(dataLength)
-					if sendMyData(connection, mData) > 0:
-					    pass
-						#print("Sending data of length {}".format(dataLength))
-					#connection.send(bytes(b))
-					time.sleep(0.1)
-				except:
-					print("Transmission error")
-					connection.close()
-					break
-	finally:
-		# Clean up
-		print("Closing current connection")
-		if not audioStream is None:
-		    if sendData:
-		        audioStream.stop_stream()
-		        audioStream.close()
-		        audioStream = None
-		connection.close()
-
-p.terminate()
\ No newline at end of file
+PORT = 10000
+
+# Limits of the stream settings accepted by the 'configure' command
+MINFS = 1000
+MAXFS = 768000
+MAXFRAMESPERBUFFER = 65536
+
+# Spectra are sent relative to the full scale of the int32 capture
+FULLSCALE = 2**31
+
+# PortAudio callback status flags, the same as pyaudio.paInputUnderflow etc.
+STATUSFLAGS = ((1, 'inputUnderflow'), (2, 'inputOverflow'), (4, 'outputUnderflow'),
+               (8, 'outputOverflow'))
+
+
+class Measurement:
+    """
+    A sweep or stepped sine measurement for one client. The excitation is
+    played from the start of an audio buffer on and the input is captured
+    from that same buffer on, so the capture is aligned with the
+    excitation up to the fixed round trip latency. Both buffers are
+    allocated up front, the audio callback only copies.
+    """
+
+    def __init__(self, session, excitation, frames, channels, framesPerBuffer):
+
+        self.session = session
+        # Zero padded, so the tail can be played as slices of the same array
+        self.excitation = np.zeros(frames + framesPerBuffer, dtype=np.int32)
+        self.excitation[:len(excitation)] = excitation
+        self.capture = np.zeros((frames, channels), dtype=np.int32)
+        self.pos = 0
+
+    def play(self, frameCount):
+
+        out = self.excitation[self.pos:self.pos + frameCount]
+        if len(out) < frameCount:
+            out = np.zeros(frameCount, dtype=np.int32)
+
+        return out
+
+    def record(self, samples):
+        # Returns True once the capture is complete
+        frames = samples.reshape(-1, self.capture.shape[1])
+        n = min(len(frames), len(self.capture) - self.pos)
+        self.capture[self.pos:self.pos + n] = frames[:n]
+        self.pos += len(frames)
+
+        return self.pos >= len(self.capture)
+
+
+class ClientSession:
+    """
+    State of one connected client. Each client has its own capture ring,
+    block size, decimation and send interval, and its own sender task, so
+    a slow client only overruns its own ring. The ring holds interleaved
+    frames of all captured channels.
+    """
+
+    def __init__(self, server, reader, writer):
+
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+
+        self.dataLength = DATALENGTH
+        self.decimation = 1
+        self.sendInterval = 0
+        self.sendData = False
+
+        # Sample type and compression flags of data frames
+        self.dtype = np.dtype(np.int32)
+        self.compression = 0
+        self.level = 1
+
+        # Server side spectrum processing
+        self.spectrumMode = proto.SPECTRUM_OFF
+        self.spectrumArg = 0
+        self.window = 'Hann'
+        self.beta = 5
+        self.averaging = 1
+        self.aveMode = 'linear'
+        self.processor = None
+
+        self.ring = BlockRing(self.dataLength * self.decimation * server.channels)
+        self.block = np.empty(self.ring.blockLen, dtype=self.ring.dtype)
+        self.dataReady = asyncio.Event()
+
+        # A client on the same host may read raw blocks from a ring in shared memory
+        self.sharedRequested = False
+        self.announced = None
+
+        self.stats = PipelineStats()
+        self.lastOverruns = 0
+
+    def resize(self):
+
+        blockLen = self.dataLength * self.decimation * self.server.channels
+        if isinstance(self.ring, SharedRing):
+            # Shared rings have a fixed size, updateShared makes a new one
+            self.replaceRing(BlockRing(blockLen))
+        else:
+            self.ring.reset(blockLen)
+        self.block = np.empty(self.ring.blockLen, dtype=self.ring.dtype)
+        self.lastOverruns = 0
+        self.updateProcessor()
+
+    def replaceRing(self, ring):
+
+        old = self.ring
+        self.ring = ring
+        self.block = np.empty(ring.blockLen, dtype=ring.dtype)
+        self.lastOverruns = 0
+        if isinstance(old, SharedRing):
+            self.retire(old)
+
+    def retire(self, ring):
+        # The audio callback may still be writing into the ring, and the
+        # client may still be attaching to it, so it is closed a while later
+        self.server.retired.add(ring)
+        self.server.loop.call_later(1.0, self.server.closeRing, ring)
+
+    def updateShared(self):
+        """
+        Moves the capture ring into shared memory while the client asked
+        for it and takes raw blocks, and out again otherwise. The client
+        is told the name of the ring, or an empty name when it has to read
+        data frames from the socket again.
+        """
+
+        blockLen = self.dataLength * self.decimation * self.server.channels
+        shared = isinstance(self.ring, SharedRing)
+        if (self.sharedRequested and SharedRing.available() and self.decimation == 1 and
+                self.processor is None and self.dtype == self.ring.dtype):
+            if not shared or self.ring.blockLen != blockLen:
+                self.replaceRing(SharedRing(blockLen, self.ring.nBlocks, self.ring.dtype))
+        elif shared:
+            self.replaceRing(BlockRing(blockLen, self.ring.nBlocks, self.ring.dtype))
+
+        name = self.ring.name if isinstance(self.ring, SharedRing) else ''
+        announcement = {'name': name, 'channels': self.server.channels,
+                        'sampleRate': self.server.fs}
+        if announcement != self.announced and (name or self.announced is not None):
+            self.announced = announcement
+            self.sendJson(proto.FRAME_SHARED, announcement)
+
+    def configure(self, requestId, settings):
+        """
+        Applies a batch of settings as one change and answers with the
+        settings in effect afterwards. Nothing is applied if any of them is
+        invalid, and the previous stream settings stay in effect if the
+        stream does not open with the new ones. Frames sent before the
+        answer are in the old format, all after it in the new one.
+        """
+
+        start = time.perf_counter()
+        error = self.server.checkSettings(settings)
+        reopened = False
+        if error is None:
+            print(self.address, "Configure", settings)
+            dataLength = int(settings.get('dataSize', self.dataLength))
+            decimation = int(settings.get('decimation', self.decimation))
+            resize = (dataLength, decimation) != (self.dataLength, self.decimation)
+            self.dataLength = dataLength
+            self.decimation = decimation
+            # A reopened stream resizes every session, this one included
+            reopened, error = self.server.configure(settings)
+            if resize and not reopened:
+                self.resize()
+        if error is not None:
+            print(self.address, "Settings rejected:", error)
+
+        effective = self.server.settings()
+        effective.update({'dataSize': self.dataLength, 'decimation': self.decimation,
+                          'id': requestId, 'error': error, 'reopened': reopened,
+                          'time': time.perf_counter() - start})
+        self.sendJson(proto.FRAME_CONFIG, effective)
+
+    def close(self):
+
+        if isinstance(self.ring, SharedRing):
+            self.retire(self.ring)
+
+    def updateProcessor(self):
+        # A new processor is made on every change rather than modifying the
+        # one that may be busy in the executor
+        if self.spectrumMode == proto.SPECTRUM_OFF:
+            self.processor = None
+        elif self.spectrumMode == proto.SPECTRUM_TRACK:
+            fs = self.server.fs / self.decimation
+            self.processor = HarmonicTracker(self.dataLength, fs, self.server.generatorFrequency(),
+                                             int(self.spectrumArg) or 10, fs / 2, FULLSCALE,
+                                             self.server.channels)
+        else:
+            self.processor = analysis.SpectrumProcessor(self.dataLength,
+                                                        self.server.fs / self.decimation,
+                                                        self.window, self.averaging,
+                                                        self.aveMode, self.beta, FULLSCALE,
+                                                        channels=self.server.channels)
+            self.processor.stats = self.stats
+            if self.spectrumMode == proto.SPECTRUM_BINNED:
+                self.logEdges = analysis.logBinEdges(self.processor.bins, self.processor.fs,
+                                                     int(self.spectrumArg) or 24)
+        self.updateShared()
+
+    def processBlock(self, processor, mode, data):
+        # Runs in the executor, returns the frame type and payload to send.
+        # The mode is that of the processor, the client may change it meanwhile.
+        if mode == proto.SPECTRUM_TRACK:
+            # Fundamental first, followed by its harmonics, of the first channel
+            with self.stats.timed('harmonics'):
+                m = processor.process(data)[0]
+            harmonics = np.vstack(([m['Fundamental'], m['Amplitude']], m['Harmonics']))
+            return (proto.FRAME_HARMONICS, harmonics.astype(np.float32))
+        spectrum = processor.process(data)
+        if mode == proto.SPECTRUM_MAGNITUDE:
+            return (proto.FRAME_SPECTRUM, spectrum.astype(np.float32))
+        elif spectrum.ndim > 1:
+            # Bands and harmonics are of the first channel only
+            spectrum = spectrum[0]
+        if mode == proto.SPECTRUM_BINNED:
+            return (proto.FRAME_BINNED, analysis.logBin(spectrum, self.logEdges, processor.fs))
+        elif mode == proto.SPECTRUM_HARMONICS:
+            # Fundamental first, followed by its harmonics
+            with self.stats.timed('harmonics'):
+                res = analyzeDistortion(spectrum, processor.fs, processor.enbw,
+                                        maxFrequency=processor.fs / 2,
+                                        maxHarmonics=int(self.spectrumArg) or 10)
+            harmonics = np.vstack(([res['Fundamental'], res['Amplitude']], res['Harmonics']))
+            return (proto.FRAME_HARMONICS, harmonics.astype(np.float32))
+
+    def encodeData(self, data):
+        """
+        Converts captured int32 samples, or their decimated means, to the
+        sample type of this client. Returns the samples, and the flags and
+        payload to send them with, None for the samples as they are.
+        """
+
+        if data.dtype != self.dtype:
+            if self.dtype.kind == 'f':
+                data = (data * (1 / FULLSCALE)).astype(self.dtype)
+            elif data.dtype.kind == 'f':
+                scale = proto.fullScale(self.dtype) / FULLSCALE
+                info = np.iinfo(self.dtype)
+                data = np.rint(data * scale).clip(info.min, info.max).astype(self.dtype)
+            else:
+                # The most significant bits of the capture
+                data = (data >> (32 - 8 * self.dtype.itemsize)).astype(self.dtype)
+
+        flags = self.compression
+        if data.dtype.kind == 'f':
+            flags &= ~proto.FLAG_DELTA
+        if not flags:
+            return (data, 0, None)
+
+        with self.stats.timed('compress'):
+            payload = proto.encodePayload(data, flags, self.server.channels, self.level)
+        self.stats.add('compressionRatio', data.nbytes / max(len(payload), 1), base=1)
+
+        return (data, flags, payload)
+
+    def handleCommand(self, cmd, args):
+
+        arg = args[0]
+        if cmd == 'dataSize':
+            if arg < 1:
+                print(self.address, "Data size rejected:", arg)
+            else:
+                print(self.address, "Set data size to", int(arg))
+                self.dataLength = int(arg)
+                self.resize()
+        elif cmd == 'decimation':
+            print(self.address, "Set decimation to", int(arg))
+            self.decimation = max(int(arg), 1)
+            self.resize()
+        elif cmd == 'spectrum':
+            # Mode, and bands per octave or number of harmonics
+            print(self.address, "Set spectrum mode to", int(arg))
+            self.spectrumMode = int(arg)
+            self.spectrumArg = args[1] if len(args) > 1 else 0
+            self.updateProcessor()
+        elif cmd == 'window':
+            # Index into analysis.WINDOWS and Kaiser beta
+            self.window = analysis.WINDOWS[int(arg)]
+            self.beta = args[1] if len(args) > 1 else 5
+            print(self.address, "Set window to", self.window)
+            self.updateProcessor()
+        elif cmd == 'averaging':
+            # Count, and 0 for linear or 1 for exponential averaging
+            self.averaging = max(int(arg), 1)
+            self.aveMode = 'exponential' if len(args) > 1 and args[1] else 'linear'
+            print(self.address, "Set averaging to", self.averaging, self.aveMode)
+            self.updateProcessor()
+        elif cmd == 'sendInterval':
+            print(self.address, "Set send interval to", arg)
+            self.sendInterval = max(arg, 0)
+        elif cmd == 'startSend':
+            print(self.address, "Start sending data")
+            if not self.sendData:
+                self.ring.reset()
+                self.lastOverruns = 0
+                self.sendData = True
+                self.server.updateCapturing()
+        elif cmd == 'stopSend':
+            print(self.address, "Stop sending data")
+            if self.sendData:
+                self.sendData = False
+                self.server.updateCapturing()
+        elif cmd == 'format':
+            # Codes of the sample types the client accepts, preferred first
+            accepted = [proto.DTYPES.get(int(code)) for code in args]
+            offered = [dtype for dtype in accepted if dtype in proto.TRANSPORTDTYPES]
+            if offered:
+                self.dtype = offered[0]
+            print(self.address, "Send data as", self.dtype)
+            self.updateShared()
+        elif cmd == 'compression':
+            # FLAG_* bits to apply to data frames, and the zlib level
+            self.compression = int(arg)
+            self.level = int(args[1]) if len(args) > 1 else 1
+            print(self.address, "Set compression to", self.compression, "level", self.level)
+        elif cmd == 'measure':
+            # Kind, start and end frequency, duration of the sweep or of every
+            # step, steps per octave and seconds captured after the end
+            kind, f1, f2, duration = args[:4]
+            pointsPerOctave = args[4] if len(args) > 4 else 6
+            tail = args[5] if len(args) > 5 else 0.5
+            print(self.address, "Measure from", f1, "to", f2, "Hz")
+            self.server.startMeasurement(self, int(kind), f1, f2, duration, pointsPerOctave, tail)
+        elif cmd == 'shared':
+            # Non zero from a client on the same host that can map the ring
+            self.sharedRequested = bool(arg)
+            print(self.address, "Shared memory transport", "requested" if arg else "off")
+            self.updateShared()
+        elif cmd == 'configure':
+            # Request id, then pairs of setting code and value
+            settings = {proto.CONFIGNAMES.get(int(code), int(code)): value
+                        for code, value in zip(args[1::2], args[2::2])}
+            self.configure(int(arg), settings)
+        elif cmd == 'stats':
+            # Answered right away, a non zero argument resets afterwards
+            self.sendStats()
+            if arg:
+                self.stats.reset()
+                self.server.stats.reset()
+        elif cmd != 'idle':
+            return self.server.handleCommand(cmd, args)
+
+        return True
+
+    async def commandLoop(self):
+
+        parser = proto.FrameParser()
+        while True:
+            data = await self.reader.read(MAXDATALEN)
+            if not data:
+                print("No data from", self.address)
+                return
+            parser.feed(data)
+            for header, payload in parser:
+                if header.frameType != proto.FRAME_COMMAND:
+                    continue
+                cmd, args = proto.unpackCommand(payload)
+                try:
+                    known = self.handleCommand(cmd, args)
+                except (ValueError, IndexError, OverflowError) as e:
+                    # Malformed arguments only cost the command, not the session
+                    print(self.address, "Bad arguments for", cmd, args, e)
+                    continue
+                if not known:
+                    print("Unknown command", cmd)
+                    return
+
+    def sendJson(self, frameType, content):
+        # Small enough to go out without waiting for the socket to drain
+        data = np.frombuffer(json.dumps(content).encode('utf-8'), dtype=np.uint8)
+        self.writer.write(proto.packDataHeader(data, self.server.fs, timestamp=time.time(),
+                                               frameType=frameType))
+        self.writer.write(data.tobytes())
+
+    def sendStats(self):
+
+        stats = {'server': self.server.stats.snapshot(), 'session': self.stats.snapshot()}
+        self.sendJson(proto.FRAME_STATS, stats)
+
+    def sendMeasurement(self, measurement):
+        # Runs in the event loop once the audio callback has filled the capture
+        if self not in self.server.sessions:
+            return
+        data = measurement.capture
+        self.writer.write(proto.packDataHeader(data, self.server.fs, timestamp=time.time(),
+                                               channels=self.server.channels,
+                                               frameType=proto.FRAME_SWEEP))
+        self.writer.write(memoryview(data).cast('B'))
+
+    async def send(self, frameType, data, seq, overruns, timestamp, flags=0, payload=None):
+        # payload is the encoded form of data, if it has been encoded
+
+        start = time.perf_counter()
+        if frameType in proto.PAIRFRAMES:
+            channels = 1
+        else:
+            channels = self.server.channels
+        if payload is None:
+            payload = memoryview(data).cast('B')
+        self.writer.write(proto.packDataHeader(data, self.server.fs / self.decimation,
+                                               seq, overruns, timestamp, channels, frameType,
+                                               flags, len(payload)))
+        self.writer.write(payload)
+        # Only this client waits for its socket to drain, capture and
+        # other clients carry on and this ring overruns if needed
+        await self.writer.drain()
+        self.stats.add('send', time.perf_counter() - start)
+
+    async def sendLoop(self):
+
+        lastSend = 0
+        while True:
+            await self.dataReady.wait()
+            self.dataReady.clear()
+            if isinstance(self.ring, SharedRing):
+                # The client reads the blocks itself
+                continue
+
+            self.stats.add('queueDepth', self.ring.available(), base=1)
+            if self.sendInterval > 0 and self.processor is None:
+                # Rate limited clients only get the most recent block
+                self.ring.discard()
+
+            res = self.ring.read(self.block)
+            while res is not None:
+                seq, overruns, timestamp, data = res
+                if overruns > self.lastOverruns:
+                    self.stats.count('droppedBlocks', overruns - self.lastOverruns)
+                self.lastOverruns = overruns
+                if self.decimation > 1:
+                    # Averaging each group of frames is a cheap low pass
+                    # against aliasing before dropping the rate
+                    data = data.reshape(-1, self.decimation, self.server.channels).mean(
+                        axis=1).reshape(-1)
+                if self.processor is not None:
+                    # Every block goes into the average, the FFT runs in the
+                    # executor so the other clients are served meanwhile
+                    processor = self.processor
+                    frameType, result = await self.server.loop.run_in_executor(
+                        None, self.processBlock, processor, self.spectrumMode, data)
+                    if processor is self.processor and \
+                       time.monotonic() - lastSend >= self.sendInterval:
+                        lastSend = time.monotonic()
+                        await self.send(frameType, result, seq, overruns, timestamp)
+                else:
+                    if self.compression:
+                        # Compression takes milliseconds for large blocks, the
+                        # other clients and commands are served meanwhile
+                        block = self.block
+                        data, flags, payload = await self.server.loop.run_in_executor(
+                            None, self.encodeData, data)
+                        if block is not self.block:
+                            # Resized or moved meanwhile, the block is of the old format
+                            break
+                    else:
+                        data, flags, payload = self.encodeData(data)
+                    await self.send(proto.FRAME_DATA, data, seq, overruns, timestamp,
+                                    flags, payload)
+                    if self.sendInterval > 0:
+                        break
+                # drain() does not yield while the socket keeps up, let the
+                # command reader and the other clients in between blocks
+                await asyncio.sleep(0)
+                res = self.ring.read(self.block)
+
+            if self.sendInterval > 0 and self.processor is None:
+                await asyncio.sleep(self.sendInterval)
+
+
+class AudioServer:
+    """
+    Captures from a single audio stream and fans the blocks out to every
+    connected client. The generator signal is played on every output
+    channel selected in outputMask.
+    """
+
+    def __init__(self, fs=192000, channels=1, framesPerBuffer=MAXFRAMESPERBUFFER):
+
+        self.fs = fs
+        self.framesPerBuffer = framesPerBuffer
+        self.generator = SignalGenerator(fs, self.framesPerBuffer)
+        self.channels = channels
+        self.outputMask = np.ones(channels, dtype=np.int32)
+        self.allocate()
+
+        self.audio = None
+        self.audioStream = None
+        self.loop = None
+        self.address = None
+        self.sessions = []
+        self.measurement = None
+        self.stats = PipelineStats()
+        # Replaced, never modified, so the audio callback can iterate it
+        # without locking
+        self.capturing = ()
+        # Shared rings of clients, still mapped until closeRing
+        self.retired = set()
+
+    def handleCommand(self, cmd, args):
+
+        arg = args[0]
+        if cmd == 'frequency':
+            print("Set generator frequency to", arg)
+            self.generator.setTone(arg)
+            self.updateProcessors()
+        elif cmd == 'tones':
+            # Pairs of frequency and relative amplitude
+            tones = list(zip(args[0::2], args[1::2]))
+            print("Set generator tones to", tones)
+            self.generator.setTones(tones)
+            self.updateProcessors()
+        elif cmd == 'sweep':
+            # Start and end frequency, duration, 1 for log or 0 for linear
+            f1, f2, duration = args[:3]
+            log = args[3] if len(args) > 3 else 1
+            print("Set generator sweep from", f1, "to", f2, "in", duration, "s")
+            self.generator.setSweep(f1, f2, duration, log=bool(log))
+        elif cmd == 'amplitude':
+            print("Set generator amplitude to", arg)
+            self.generator.amplitude = min(max(arg, 0), 1)
+        elif cmd in ('fs', 'channels'):
+            print("Set", cmd, "to", int(arg))
+            settings = {cmd: int(arg)}
+            error = self.checkSettings(settings)
+            if error is None:
+                error = self.configure(settings)[1]
+            if error is not None:
+                print("Settings rejected:", error)
+        elif cmd == 'outputs':
+            # Bit c set drives output channel c
+            print("Set generator outputs to", bin(int(arg)))
+            self.setOutputs(int(arg))
+        elif cmd == 'startGen':
+            print("Starting generator")
+            self.setGenerator(True)
+        elif cmd == 'stopGen':
+            print("Stopping generator")
+            self.setGenerator(False)
+        else:
+            return False
+
+        return True
+
+    def closeRing(self, ring):
+
+        if ring in self.retired:
+            self.retired.discard(ring)
+            ring.close()
+
+    def generatorFrequency(self):
+        # Frequency of the first generator tone
+        return float(self.generator.tones[0][0])
+
+    def updateProcessors(self):
+
+        for session in self.sessions:
+            session.updateProcessor()
+
+    def allocate(self):
+        # Interleaved output of all channels
+        self.outBuf = np.empty((self.framesPerBuffer, self.channels), dtype=np.int32)
+
+    def setOutputs(self, mask):
+
+        self.outputMask = np.array([(mask >> c) & 1 for c in range(self.channels)],
+                                   dtype=np.int32)
+
+    def setGenerator(self, active):
+
+        if active and not self.generator.active:
+            self.generator.reset()
+        self.generator.active = active
+
+    def settings(self):
+        # Current values of everything the 'configure' command sets on the server
+
+        outputs = sum(1 << c for c in range(self.channels) if self.outputMask[c])
+        return {'fs': self.fs, 'framesPerBuffer': self.framesPerBuffer,
+                'channels': self.channels, 'frequency': self.generatorFrequency(),
+                'amplitude': float(self.generator.amplitude),
+                'generator': int(self.generator.active), 'outputs': outputs,
+                'streaming': self.streamOpen()}
+
+    def checkSettings(self, settings):
+        # Reason why a batch of settings can not be applied, or None
+
+        for name in settings:
+            if name not in proto.CONFIGKEYS:
+                return "Unknown setting %s" % name
+        fs = settings.get('fs', self.fs)
+        if not MINFS <= fs <= MAXFS:
+            return "Sampling frequency out of range"
+        if not 1 <= settings.get('framesPerBuffer', self.framesPerBuffer) <= MAXFRAMESPERBUFFER:
+            return "Frames per buffer out of range"
+        if not 1 <= settings.get('channels', self.channels) <= 255:
+            return "Number of channels out of range"
+        if 'frequency' in settings and not 0 < settings['frequency'] < fs / 2:
+            return "Generator frequency not below half the sampling frequency"
+        if not 0 <= settings.get('amplitude', 0) <= 1:
+            return "Amplitude out of range"
+        if settings.get('dataSize', 1) < 1 or settings.get('decimation', 1) < 1:
+            return "Data size and decimation have to be positive"
+
+        return None
+
+    def configure(self, settings):
+        """
+        Applies checked settings together. The stream is only reopened when
+        the sampling frequency, buffer size or number of channels change,
+        and then every session starts over in the new format. Returns
+        whether it was reopened, and why the stream settings could not be
+        applied, or None.
+        """
+
+        stream = (int(settings.get('fs', self.fs)),
+                  int(settings.get('framesPerBuffer', self.framesPerBuffer)),
+                  int(settings.get('channels', self.channels)))
+        reopen = stream != (self.fs, self.framesPerBuffer, self.channels)
+
+        if 'frequency' in settings:
+            self.generator.setTone(settings['frequency'])
+        if 'amplitude' in settings:
+            self.generator.amplitude = settings['amplitude']
+        if 'outputs' in settings:
+            self.setOutputs(int(settings['outputs']))
+        if 'generator' in settings:
+            self.setGenerator(bool(settings['generator']))
+
+        error = None
+        if reopen:
+            error = self.restartStream(*stream)
+        elif 'frequency' in settings:
+            self.updateProcessors()
+
+        return (reopen, error)
+
+    def restartStream(self, fs, framesPerBuffer, channels):
+        """
+        Closes the stream, changes its settings and opens it again if it was
+        open. If it does not open with the new settings the previous ones are
+        restored. Returns why, or None.
+        """
+
+        previous = (self.fs, self.framesPerBuffer, self.channels)
+        # The stream is open whenever a client is connected
+        streaming = bool(self.sessions)
+        self.closeStream()
+        self.setStream(fs, framesPerBuffer, channels)
+        for session in self.sessions:
+            session.resize()
+        if not streaming:
+            return None
+        try:
+            self.openStream()
+            return None
+        except OSError as e:
+            error = "Stream not opened: %s" % e
+
+        self.setStream(*previous)
+        for session in self.sessions:
+            session.resize()
+        try:
+            self.openStream()
+        except OSError as e:
+            # The device is gone, the stream stays closed until the next change
+            error += "; not reopened with the previous settings either: %s" % e
+
+        return error
+
+    def setStream(self, fs, framesPerBuffer, channels):
+        # Only called while the stream is closed
+
+        if channels != self.channels:
+            self.outputMask = np.ones(channels, dtype=np.int32)
+        if framesPerBuffer != self.framesPerBuffer:
+            self.generator.allocate(framesPerBuffer)
+        self.fs = fs
+        self.framesPerBuffer = framesPerBuffer
+        self.channels = channels
+        self.generator.setFs(fs)
+        self.allocate()
+        # A measurement in progress was made for the old stream
+        self.measurement = None
+
+    def startMeasurement(self, session, kind, f1, f2, duration, pointsPerOctave=6, tail=0.5):
+        # The excitation replaces the generator from the next audio buffer on.
+        # Only one measurement runs at a time, a new one replaces the old one.
+
+        try:
+            signal = audioSweep.excitation(kind, f1, f2, duration, self.fs, pointsPerOctave)
+        except ValueError as e:
+            print("Measurement not started:", e)
+            return
+        signal = np.rint(signal * self.generator.amplitude * proto.fullScale(np.int32))
+        signal = signal.clip(-FULLSCALE, FULLSCALE - 1).astype(np.int32)
+        frames = len(signal) + int(tail * self.fs)
+        self.measurement = Measurement(session, signal, frames, self.channels,
+                                       self.framesPerBuffer)
+
+    def updateCapturing(self):
+
+        self.capturing = tuple(s for s in self.sessions if s.sendData)
+
+    def notify(self):
+
+        for session in self.capturing:
+            session.dataReady.set()
+
+    def processAudio(self, inData, frameCount, status=0):
+        # Hands the captured bytes to the clients and returns the next
+        # frameCount generator samples to play
+
+        start = time.perf_counter()
+        if status:
+            for flag, name in STATUSFLAGS:
+                if status & flag:
+                    self.stats.count(name)
+
+        measurement = self.measurement
+        if measurement is not None:
+            outData = measurement.play(frameCount)
+        else:
+            outData = self.generator.render(frameCount)
+        if self.channels > 1:
+            if frameCount > len(self.outBuf):
+                self.outBuf = np.empty((frameCount, self.channels), dtype=np.int32)
+            # Interleaved, the same signal on every selected output
+            out = self.outBuf[:frameCount]
+            np.multiply(outData[:,np.newaxis], self.outputMask, out=out)
+            outData = out
+
+        capturing = self.capturing
+        if inData and capturing:
+            samples = np.frombuffer(inData, dtype=np.int32)
+            for session in capturing:
+                session.ring.write(samples)
+            self.loop.call_soon_threadsafe(self.notify)
+        if inData and measurement is not None:
+            if measurement.record(np.frombuffer(inData, dtype=np.int32)):
+                self.measurement = None
+                self.loop.call_soon_threadsafe(measurement.session.sendMeasurement, measurement)
+        self.stats.add('callback', time.perf_counter() - start)
+
+        return outData
+
+    def audioCallback(self, inData, frameCount, timeInfo, status):
+
+        outData = self.processAudio(inData, frameCount, status)
+
+        # PyAudio only takes bytes back, this is the one allocation per callback
+        return (outData.tobytes(), pyaudio.paContinue)
+
+    def openAudio(self):
+
+        if pyaudio is None:
+            raise RuntimeError("PyAudio is needed for audio capture")
+        self.audio = pyaudio.PyAudio()
+
+    def closeAudio(self):
+
+        self.audio.terminate()
+
+    def openStream(self):
+
+        if self.audioStream is None:
+            self.audioStream = self.audio.open(format=pyaudio.paInt32, channels=self.channels, rate=self.fs,
+                                               output=True, input=True, input_device_index=0,
+                                               output_device_index=0, frames_per_buffer=self.framesPerBuffer,
+                                               stream_callback=self.audioCallback)
+
+    def streamOpen(self):
+
+        return self.audioStream is not None
+
+    def closeStream(self):
+
+        if self.audioStream is not None:
+            self.audioStream.stop_stream()
+            self.audioStream.close()
+            self.audioStream = None
+
+    async def handleClient(self, reader, writer):
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        session = ClientSession(self, reader, writer)
+        print("Connection from", session.address)
+        self.sessions.append(session)
+        sender = asyncio.ensure_future(session.sendLoop())
+        try:
+            self.openStream()
+            await session.commandLoop()
+        except (ConnectionError, RuntimeError) as e:
+            print("Transmission error", e)
+        finally:
+            print("Closing connection from", session.address)
+            sender.cancel()
+            self.sessions.remove(session)
+            self.updateCapturing()
+            session.close()
+            if not self.sessions:
+                self.closeStream()
+            writer.close()
+
+    async def serve(self, host='0.0.0.0', port=PORT):
+
+        self.loop = asyncio.get_running_loop()
+        self.openAudio()
+        server = await asyncio.start_server(self.handleClient, host, port)
+        self.address = server.sockets[0].getsockname()
+        print('starting up on %s port %s' % self.address[:2])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.closeStream()
+            self.closeAudio()
+            for session in self.sessions:
+                session.close()
+            for ring in list(self.retired):
+                self.closeRing(ring)
+
+
+if __name__ == '__main__':
+    asyncio.run(AudioServer().serve())
@@ -0,0 +1,137 @@
+import threading
+import ipaddress
+import numpy as np
+from audioBuffer import BlockRing
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+# Header of the shared segment, int64 fields
+HEADERFIELDS = 8
+WRITESEQ = 0        # Number of completed blocks, advanced after every block is copied in
+GENERATION = 1      # Incremented on every reset, readers start over when it changes
+BLOCKLEN = 2
+NBLOCKS = 3
+
+# Seconds a reader waits for the socket between looks at the ring
+POLLINTERVAL = 0.001
+
+# Names of the segments created by this process
+created = set()
+
+
+def isLocal(sock):
+    # True if the peer of a connected socket is this host
+    try:
+        peer = sock.getpeername()[0]
+        own = sock.getsockname()[0]
+    except (OSError, AttributeError):
+        return False
+
+    return peer == own or ipaddress.ip_address(peer).is_loopback
+
+
+def attachMemory(name):
+
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        # Before Python 3.13 attaching registers the segment as well, and
+        # this process would unlink it on exit while the server still uses it
+        if shm.name not in created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedRing(BlockRing):
+    """
+    BlockRing in shared memory, for a consumer in another process on the
+    same host. The server creates it without a name and writes into it as
+    into any BlockRing, the client attaches to it by name and reads.
+
+    Nothing is locked across processes. The producer publishes a block by
+    advancing the write sequence in the shared header after copying it in,
+    and the reader catches blocks overwritten while it copied them with
+    the same check as BlockRing.read. Every reader keeps its own read
+    position and overrun count.
+    """
+
+    def __init__(self, blockLen=1024, nBlocks=32, dtype=np.int32, name=None):
+
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.owner = name is None
+        if self.owner:
+            size = 8 * (HEADERFIELDS + nBlocks) + nBlocks * int(blockLen) * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            created.add(self.shm.name)
+        else:
+            self.shm = attachMemory(name)
+        self.name = self.shm.name
+
+        self.header = np.ndarray(HEADERFIELDS, dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[BLOCKLEN] = blockLen
+            self.header[NBLOCKS] = nBlocks
+        self.blockLen = int(self.header[BLOCKLEN])
+        self.nBlocks = int(self.header[NBLOCKS])
+        self.timestamps = np.ndarray(self.nBlocks, dtype=np.float64, buffer=self.shm.buf,
+                                     offset=8 * HEADERFIELDS)
+        self.data = np.ndarray((self.nBlocks, self.blockLen), dtype=self.dtype,
+                               buffer=self.shm.buf, offset=8 * (HEADERFIELDS + self.nBlocks))
+        self.generation = int(self.header[GENERATION])
+        self.reset()
+
+    @staticmethod
+    def available():
+        return shared_memory is not None
+
+    @property
+    def writeSeq(self):
+        return int(self.header[WRITESEQ])
+
+    @writeSeq.setter
+    def writeSeq(self, value):
+        self.header[WRITESEQ] = value
+
+    def reset(self, blockLen=None):
+        # The size is fixed, a new ring is needed for another block length
+
+        if blockLen is not None and blockLen != self.blockLen:
+            raise RuntimeError("A shared ring can not be resized")
+        with self.lock:
+            if self.owner:
+                self.header[WRITESEQ] = 0
+                self.header[GENERATION] += 1
+                self.writePos = 0
+            self.generation = int(self.header[GENERATION])
+            self.readSeq = 0
+            self.overruns = 0
+
+    def read(self, out=None):
+
+        generation = int(self.header[GENERATION])
+        if generation != self.generation:
+            # The producer started over
+            self.generation = generation
+            self.readSeq = 0
+            self.overruns = 0
+
+        return super(SharedRing, self).read(out)
+
+    def unlink(self):
+        # Removes the name, the memory stays mapped until closed
+
+        if self.owner and self.name in created:
+            created.discard(self.name)
+            self.shm.unlink()
+
+    def close(self):
+        # The arrays have to go before the mapping can be closed
+
+        self.unlink()
+        self.header = self.timestamps = self.data = None
+        self.shm.close()
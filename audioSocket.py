@@ -1,13 +1,16 @@
 import socket
+import select
 import sys
-import pickle
 import time
+import threading
 import numpy as np
+import audioProtocol as proto
+from audioShared import SharedRing, isLocal, POLLINTERVAL
 
 MAXDATALEN = 2048
 
 class DataSocket:
-    def __init__(self, dataLen=1024, dataSize=4, sock=None):
+    def __init__(self, dataLen=1024, dataSize=4, sock=None, shared=True):
         if sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         else:
@@ -16,40 +19,249 @@ class DataSocket:
         self.dataSize = dataSize
         self.dataLen = dataLen * dataSize
         
+        self.seq = -1           # Sequence number of the last received block
+        self.overruns = 0       # Blocks dropped by the server
+        self.lostBlocks = 0     # Gaps seen in the sequence numbers
+        self.lastGap = 0
+        self.header = None      # Header of the last received data frame
+        self.serverStats = None # Payload of the last stats frame
+        self.measurement = None # Capture of the last sweep measurement
+        self.stats = None       # PipelineStats for the receive time, if set
+        
+        # Answer to the last 'configure' command, see configure
+        self.settings = None
+        self.configId = 0
+        self.settingsChanged = threading.Condition()
+        
+        # Raw blocks come through shared memory from a server on this host
+        self.useShared = shared and SharedRing.available()
+        self.ring = None
+        self.sharedInfo = None
+        
     def connect(self, host, port):
         self.sock.connect((host, port))
+        if self.useShared and isLocal(self.sock):
+            self.sendCmd('shared', 1)
         
     def close(self):
+        self.attachShared(None)
         self.sock.close()
         
+    def attachShared(self, info):
+        # Switches to the ring announced by the server, or back to the socket
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        self.sharedInfo = info
+        if info and info['name']:
+            try:
+                self.ring = SharedRing(name=info['name'])
+            except OSError as e:
+                print("Shared memory not available:", e)
+                self.sendCmd('shared', 0)
+        self.seq = -1
+        
+    def readShared(self, out):
+        # Next block from the shared ring, or None if there is none yet
+        res = self.ring.read(out)
+        if res is None:
+            return None
+        seq, overruns, timestamp, data = res
+        channels = self.sharedInfo['channels']
+        self.updateSequence(proto.FrameHeader(proto.FRAME_DATA, data.nbytes, data.dtype,
+                                              channels, 0, self.sharedInfo['sampleRate'],
+                                              seq, overruns, timestamp))
+        if channels > 1:
+            return data.reshape(-1, channels)
+        return data
+        
+    def updateSettings(self, settings):
+        # Effective settings from a FRAME_CONFIG answer
+        with self.settingsChanged:
+            self.settings = settings
+            self.settingsChanged.notify_all()
+        if settings['error']:
+            print("Settings rejected:", settings['error'])
+        
+    def waitSettings(self, requestId, timeout=1.0):
+        # Settings in effect after the given 'configure' command, or None on timeout.
+        # Another thread has to be receiving meanwhile.
+        with self.settingsChanged:
+            if self.settingsChanged.wait_for(lambda: self.settings is not None and
+                                             self.settings['id'] >= requestId, timeout):
+                return self.settings
+        return None
+        
+    def waitSocket(self):
+        # True if a frame is arriving on the socket, after at most POLLINTERVAL
+        return bool(select.select([self.sock], [], [], POLLINTERVAL)[0])
+        
     def setDataLen(self, dataLen):
         self.dataLen = dataLen * self.dataSize
+        self.seq = -1
         
-    def receiveData(self):
+    def receiveExactly(self, length):
     
         chunks = []
         bytes_received = 0
+        while bytes_received < length:
+            chunk = self.sock.recv(min(length - bytes_received, MAXDATALEN))
+            if not chunk:
+                raise RuntimeError("Socket connection broken")
+            chunks.append(chunk)
+            bytes_received += len(chunk)
+        
+        return b''.join(chunks)
+        
+    def isConsecutive(self):
+        # True if the last block directly followed the one before it
+        return self.lastGap == 0
+        
+    def receiveFrame(self):
+    
+        header = proto.unpackHeader(self.receiveExactly(proto.HEADER.size))
+        return (header, self.receiveExactly(header.length))
+        
+    def receiveInto(self, view):
+        # Fill a writable memoryview directly from the socket
+        bytes_received = 0
+        length = len(view)
+        while bytes_received < length:
+            n = self.sock.recv_into(view[bytes_received:], length - bytes_received)
+            if n == 0:
+                raise RuntimeError("Socket connection broken")
+            bytes_received += n
+        
+    def updateSequence(self, header):
+        # The server restarts the numbering when the block size changes
+        if self.seq >= 0 and header.seq > self.seq:
+            self.lastGap = header.seq - self.seq - 1
+            self.lostBlocks += self.lastGap
+        else:
+            self.lastGap = 0
+        self.seq = header.seq
+        self.overruns = header.overruns
+        self.header = header
+        
+    def streamData(self, poolSize=4, frameTypes=(proto.FRAME_DATA,)):
+        """
+        Generator yielding received blocks without sleeping. Only frames of
+        the given types are yielded, spectra from a server in spectrum mode
+        included. Payloads are
+        received straight into a pool of reusable buffers, so a yielded
+        array is only valid until poolSize further blocks have been received.
+        Copy it if it has to be kept longer.
+        While the server shares its ring, raw blocks are copied straight
+        out of it, and the socket only carries the other frames.
+        """
+        
+        headerBuf = bytearray(proto.HEADER.size)
+        headerView = memoryview(headerBuf)
+        pool = [np.empty(0, dtype=np.uint8) for i in range(poolSize)]
+        idx = 0
+        while True:
+            if self.ring is not None and proto.FRAME_DATA in frameTypes:
+                start = time.perf_counter()
+                nbytes = self.ring.blockLen * self.ring.dtype.itemsize
+                if pool[idx].nbytes < nbytes:
+                    pool[idx] = np.empty(nbytes, dtype=np.uint8)
+                block = self.readShared(pool[idx][:nbytes].view(self.ring.dtype))
+                if block is not None:
+                    if self.stats is not None:
+                        self.stats.add('receive', time.perf_counter() - start)
+                    idx = (idx + 1) % poolSize
+                    yield block
+                    continue
+                if not self.waitSocket():
+                    continue
+            self.receiveInto(headerView)
+            start = time.perf_counter()
+            header = proto.unpackHeader(headerBuf)
+            buf = pool[idx]
+            if buf.nbytes < header.length:
+                buf = pool[idx] = np.empty(header.length, dtype=np.uint8)
+            self.receiveInto(memoryview(buf)[:header.length])
+            if header.frameType == proto.FRAME_STATS:
+                # Stats answers are kept aside and not counted as blocks
+                self.serverStats = proto.decodePayload(header, buf[:header.length])
+                continue
+            if header.frameType == proto.FRAME_SHARED:
+                self.attachShared(proto.decodePayload(header, buf[:header.length]))
+                continue
+            if header.frameType == proto.FRAME_CONFIG:
+                self.updateSettings(proto.decodePayload(header, buf[:header.length]))
+                continue
+            if header.frameType == proto.FRAME_SWEEP and header.frameType not in frameTypes:
+                # Copied out of the pool, it is kept until taken
+                self.measurement = proto.decodePayload(header, buf[:header.length]).copy()
+                continue
+            if header.frameType not in frameTypes:
+                continue
+            if self.stats is not None:
+                # From the end of the header, so waiting for the server is not included
+                self.stats.add('receive', time.perf_counter() - start)
+            self.updateSequence(header)
+            idx = (idx + 1) % poolSize
+            yield proto.decodePayload(header, buf[:header.length])
+        
+    def receiveData(self, frameTypes=(proto.FRAME_DATA,)):
+    
         try:
-            while bytes_received < self.dataLen:
-                chunk = self.sock.recv(min(self.dataLen - bytes_received, MAXDATALEN))
-                chunks.append(chunk)
-                bytes_received += len(chunk)
+            while True:
+                if self.ring is not None and proto.FRAME_DATA in frameTypes:
+                    block = self.readShared(None)
+                    if block is not None:
+                        time.sleep(0.1)
+                        return block
+                    if not self.waitSocket():
+                        continue
+                header, payload = self.receiveFrame()
+                if header.frameType in frameTypes:
+                    break
+                if header.frameType == proto.FRAME_STATS:
+                    self.serverStats = proto.decodePayload(header, payload)
+                elif header.frameType == proto.FRAME_SHARED:
+                    self.attachShared(proto.decodePayload(header, payload))
+                elif header.frameType == proto.FRAME_CONFIG:
+                    self.updateSettings(proto.decodePayload(header, payload))
+                elif header.frameType == proto.FRAME_SWEEP:
+                    self.measurement = proto.decodePayload(header, payload)
+            self.updateSequence(header)
         except:
             print("Data unsuccessfully received")
-            chunks = []
+            return np.zeros(0)
         
         time.sleep(0.1)
-        if self.dataSize == 4:
-            return np.frombuffer(b''.join(chunks), dtype=np.int32)
-        elif self.dataSize == 8:
-            return np.frombuffer(b''.join(chunks), dtype=np.float64)
-        else:
-            return np.frombuffer(b''.join(chunks), dtype=float)
+        return proto.decodePayload(header, payload)
     
-    def sendCmd(self, msg, arg=0):
+    def setFormat(self, dtypes=(np.int32,), compression=0, level=1):
+        # Sample types accepted, preferred first, and FLAG_* bits for data frames.
+        # Every frame header states what was actually sent.
+        codes = [proto.DTYPECODES[np.dtype(dtype)] for dtype in dtypes]
+        return self.sendCmd('format', *codes) and self.sendCmd('compression', compression, level)
+        
+    def measure(self, kind, f1, f2, duration, pointsPerOctave=6, tail=0.5):
+        # The capture arrives as a FRAME_SWEEP frame, see audioSweep for the analysis
+        return self.sendCmd('measure', kind, f1, f2, duration, pointsPerOctave, tail)
+        
+    def configure(self, **settings):
+        """
+        Sends settings named as in audioProtocol.CONFIGKEYS, which the server
+        applies together. Returns the id of the request, or None if it could
+        not be sent. The settings in effect afterwards arrive as a
+        FRAME_CONFIG frame and end up in settings, see waitSettings.
+        """
+        self.configId += 1
+        args = [self.configId]
+        for name, value in settings.items():
+            args += [proto.CONFIGKEYS[name], value]
+        if not self.sendCmd('configure', *args):
+            return None
+        return self.configId
+        
+    def sendCmd(self, msg, arg=0, *args):
         try:
-            self.sock.send(pickle.dumps([msg, arg]))
-            time.sleep(0.1)
+            self.sock.sendall(proto.packCommand(msg, arg, *args))
             return True
         except:
             return False
@@ -0,0 +1,126 @@
+import math
+import time
+import contextlib
+import numpy as np
+
+# Histogram bins double in width, the first one ends at the base value
+HISTOGRAMBINS = 32
+
+
+class StageStats:
+    """
+    Count, mean, maximum and a histogram of the values recorded for one
+    stage. Bin i holds values up to base * 2**i. Recording is O(1) and
+    allocates nothing, so it can be done in the audio callback.
+    """
+
+    def __init__(self, base=1e-6):
+
+        self.base = base
+        self.reset()
+
+    def reset(self):
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.histogram = np.zeros(HISTOGRAMBINS, dtype=np.int64)
+
+    def add(self, value):
+
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+        if value <= self.base:
+            i = 0
+        else:
+            i = min(math.ceil(math.log2(value / self.base)), HISTOGRAMBINS - 1)
+        self.histogram[i] += 1
+
+    def percentile(self, q):
+        # Upper edge of the bin holding the q-th percentile
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.histogram), q / 100 * self.count))
+
+        return min(self.base * 2.0**i, self.max)
+
+    def snapshot(self):
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'last': self.last,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'base': self.base,
+            'histogram': self.histogram.tolist(),
+        }
+
+
+class PipelineStats:
+    """
+    Durations of the pipeline stages and other sampled values such as
+    queue depths by name, and counters of events such as xruns and dropped
+    blocks. Nothing is locked. Each stage and counter has to be recorded by
+    one thread at a time, but different ones may come from different
+    threads, as on the server, where the executor records the analysis
+    stages and the event loop the sending ones of the same session.
+    """
+
+    def __init__(self):
+
+        self.stages = {}
+        self.counters = {}
+
+    def reset(self):
+
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, stage, value, base=1e-6):
+
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats(base)
+        stats.add(value)
+
+    def count(self, counter, n=1):
+
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+
+        return {
+            'stages': {name: s.snapshot() for name, s in list(self.stages.items())},
+            'counters': dict(self.counters),
+        }
+
+
+def formatStats(snapshot, title=None):
+    # Text table of a snapshot, durations in ms
+
+    lines = [] if title is None else [title]
+    for name, s in sorted(snapshot['stages'].items()):
+        if s['base'] < 1:
+            lines.append("{:<12}{:>9.3f}{:>9.3f}{:>9.3f} ms".format(
+                name, s['mean'] * 1000, s['p99'] * 1000, s['max'] * 1000))
+        else:
+            lines.append("{:<12}{:>9.1f}{:>9.1f}{:>9.1f}".format(name, s['mean'], s['p99'], s['max']))
+    for name, n in sorted(snapshot['counters'].items()):
+        lines.append("{:<12}{:>9d}".format(name, n))
+
+    return "\n".join(lines)
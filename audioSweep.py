@@ -0,0 +1,252 @@
+import numpy as np
+from audioAnalysis import rfft
+
+# Kinds of excitation for the 'measure' command
+SWEEP_CHIRP = 0
+SWEEP_STEPPED = 1
+
+# Length of the raised cosine fades at either end of a chirp in seconds
+FADE = 0.005
+
+# Harmonics evaluated by default, the fundamental counting as the first
+HARMONICS = 5
+
+# Regularisation of the spectral division, relative to the peak power of
+# the excitation spectrum
+REGULARISATION = 1e-6
+
+
+def syncSweep(f1, f2, duration, fs):
+    """
+    Synchronized exponential sweep from f1 to f2 (Novak et al.). The rate
+    L is rounded so that f1 * L is a whole number, which makes harmonic k
+    of the sweep an exact copy of the sweep advanced by L * ln(k). Returns
+    the sweep, of about duration seconds, and L.
+    """
+
+    L = max(np.round(f1 * duration / np.log(f2 / f1)), 1) / f1
+    n = int(np.ceil(L * np.log(f2 / f1) * fs))
+    t = np.arange(n) / fs
+    sweep = np.sin(2 * np.pi * f1 * L * np.exp(t / L))
+
+    # Short fades against clicks, leaving the band in between untouched
+    m = min(int(FADE * fs), n // 2)
+    fade = 0.5 - 0.5 * np.cos(np.pi * np.arange(m) / m)
+    sweep[:m] *= fade
+    sweep[n-m:] *= fade[::-1]
+
+    return (sweep, L)
+
+
+def stepFrequencies(f1, f2, pointsPerOctave):
+    # Log spaced frequencies from f1 to f2
+    count = int(np.floor(np.log2(f2 / f1) * pointsPerOctave)) + 1
+
+    return f1 * 2.0**(np.arange(count) / pointsPerOctave)
+
+
+def steppedSine(f1, f2, duration, fs, pointsPerOctave=6):
+    """
+    Sine steps of duration seconds each at pointsPerOctave log spaced
+    frequencies. The phase runs on continuously across the steps. Returns
+    the signal, the frequencies and the step length in samples.
+    """
+
+    frequencies = stepFrequencies(f1, f2, pointsPerOctave)
+    stepLength = int(round(duration * fs))
+    step = np.repeat(2 * np.pi * frequencies / fs, stepLength)
+    signal = np.sin(np.cumsum(step) - step[0])
+
+    return (signal, frequencies, stepLength)
+
+
+def excitation(kind, f1, f2, duration, fs, pointsPerOctave=6):
+    # The same excitation on the server, which plays it, and the client,
+    # which deconvolves with it
+
+    if kind == SWEEP_CHIRP:
+        return syncSweep(f1, f2, duration, fs)[0]
+    elif kind == SWEEP_STEPPED:
+        return steppedSine(f1, f2, duration, fs, pointsPerOctave)[0]
+    else:
+        raise ValueError("Unknown excitation {}".format(kind))
+
+
+def nextPow2(n):
+
+    return 1 << (int(n) - 1).bit_length()
+
+
+def spectralDivision(captured, signal, n):
+    # Impulse responses of the channels in rows, by regularised division
+    # of their spectra by that of the excitation, all in one batched FFT
+    X = rfft(np.pad(signal, (0, n - len(signal))))
+    Y = rfft(np.pad(captured.T, ((0, 0), (0, n - len(captured)))), axis=-1)
+    power = X.real**2 + X.imag**2
+
+    return np.fft.irfft(Y * np.conj(X) / (power + REGULARISATION * power.max()), n, axis=-1)
+
+
+def findDelay(captured, signal):
+    # Round trip latency of every channel in samples, from the peak of
+    # the impulse response
+    n = nextPow2(len(captured) + len(signal))
+    h = spectralDivision(captured, signal, n)
+
+    return np.argmax(np.abs(h[:,:n//2]), axis=-1)
+
+
+def harmonicLevels(frequency, responses, f2, fs):
+    # Level of harmonic k, responses[k-1] evaluated at k times the
+    # fundamental, relative to the fundamental. NaN above f2.
+    fundamental = np.abs(responses[...,0,:]) + np.finfo(float).tiny
+    levels = np.full(responses.shape[:-2] + (responses.shape[-2] - 1, len(frequency)), np.nan)
+    for k in range(2, responses.shape[-2] + 1):
+        valid = k * frequency <= min(f2, fs / 2)
+        for c in np.ndindex(responses.shape[:-2]):
+            levels[c + (k - 2, valid)] = np.interp(k * frequency[valid], frequency,
+                                                    np.abs(responses[c + (k - 1,)]))
+    levels /= fundamental[...,np.newaxis,:]
+
+    return levels
+
+
+def analyzeChirp(captured, fs, f1, f2, duration, amplitude=1.0, fullScale=2**31,
+                 harmonics=HARMONICS):
+    """
+    Frequency response and harmonic distortion from the capture of a
+    synchronized sweep, as (frames, channels) with the first sample
+    aligned to the start of the sweep.
+
+    The capture is deconvolved in one batched FFT. The linear impulse
+    response appears at the round trip delay, the response of harmonic k
+    L * ln(k) earlier, so every harmonic is cut out with its own window
+    and all of them are transformed together.
+
+    Returns a dict with the Frequency of every point from f1 to f2, and
+    with channels in rows the Magnitude in dB and the Phase in degrees
+    relative to the excitation, with the Delay removed, the Harmonics in
+    dB relative to the fundamental as (channels, harmonics - 1, points),
+    NaN where the harmonic is above f2, the THD in percent and the Delay
+    in seconds.
+    """
+
+    captured = np.asarray(captured, dtype=np.float64).reshape(len(captured), -1) / fullScale
+    sweep, L = syncSweep(f1, f2, duration, fs)
+    sweep *= amplitude
+    n = nextPow2(len(captured) + len(sweep))
+    h = spectralDivision(captured, sweep, n)
+    channels = len(h)
+
+    # Harmonic k ends where harmonic k - 1 starts, L * ln(k / (k - 1))
+    # later, and the linear response gets as much room as the second
+    # harmonic. Every window starts a few samples before the peak, and all
+    # are zero padded to the length of the linear one.
+    order = np.arange(1, harmonics + 1)
+    room = L * np.log(np.maximum(order, 2) / np.maximum(order - 1, 1)) * fs
+    pre = max(int(L * np.log((harmonics + 1) / harmonics) * fs) // 2, 1)
+    size = 1 << (int(room[0]) - pre).bit_length() - 1
+    delay = np.argmax(np.abs(h[:,:n//2]), axis=-1)
+
+    windows = np.zeros((channels, harmonics, size))
+    for k in range(harmonics):
+        length = min(int(room[k]) - pre, size)
+        fadeLength = max(length // 8, 1)
+        taper = np.ones(length + pre)
+        taper[:pre] = 0.5 - 0.5 * np.cos(np.pi * np.arange(pre) / pre)
+        taper[-fadeLength:] = 0.5 + 0.5 * np.cos(np.pi * np.arange(fadeLength) / fadeLength)
+        for c in range(channels):
+            start = delay[c] - int(round(L * np.log(k + 1) * fs)) - pre
+            idx = np.arange(start, start + length + pre) % n
+            # The window starts pre samples early, rotate that back to 0
+            windows[c,k,:length] = (h[c,idx] * taper)[pre:]
+            windows[c,k,size-pre:] = (h[c,idx] * taper)[:pre]
+    responses = rfft(windows, axis=-1)
+
+    bins = np.arange(size // 2 + 1) * fs / size
+    band = (bins >= f1) & (bins <= f2)
+    frequency = bins[band]
+    responses = responses[...,band]
+    linear = responses[:,0]
+    levels = harmonicLevels(frequency, responses, f2, fs)
+
+    return {
+        'Frequency': frequency,
+        'Magnitude': 20 * np.log10(np.abs(linear) + np.finfo(float).tiny),
+        'Phase': np.degrees(np.angle(linear)),
+        'Harmonics': 20 * np.log10(levels + np.finfo(float).tiny),
+        'THD': np.sqrt(np.nansum(levels**2, axis=1)) * 100,
+        'Delay': delay / fs,
+    }
+
+
+def analyzeSteps(captured, fs, f1, f2, duration, amplitude=1.0, fullScale=2**31,
+                 pointsPerOctave=6, harmonics=HARMONICS, settle=0.25):
+    """
+    Frequency response and harmonic distortion from the capture of a
+    stepped sine, aligned as with analyzeChirp. The delay is found first,
+    then every step is evaluated over the whole periods that follow the
+    first settle fraction of it.
+    The single frequency DFTs of all steps at the fundamental and at
+    every harmonic are matrix products over all steps and channels. The
+    result is the same as that of analyzeChirp, at the step frequencies.
+    """
+
+    captured = np.asarray(captured, dtype=np.float64).reshape(len(captured), -1) / fullScale
+    signal, frequency, stepLength = steppedSine(f1, f2, duration, fs, pointsPerOctave)
+    signal *= amplitude
+    delay = findDelay(captured, signal)
+    channels = captured.shape[1]
+
+    # A Hann window over whole periods of every step frequency, so that
+    # the harmonics fall on its nulls and not on the fundamental's leakage
+    skip = int(settle * stepLength)
+    size = stepLength - skip
+    periods = np.maximum(np.floor(size * frequency / fs), 1)
+    lengths = np.minimum(np.round(periods * fs / frequency), size)
+    x = np.arange(size) / lengths[:,np.newaxis]
+    win = np.where(x < 1, 0.5 - 0.5 * np.cos(2 * np.pi * x), 0)
+    starts = np.arange(len(frequency)) * stepLength + skip
+    idx = starts[:,np.newaxis] + np.arange(size)
+    reference = signal[idx] * win
+    # Segments of every channel after its own delay, zero past the capture
+    padded = np.pad(captured, ((0, stepLength + int(delay.max())), (0, 0)))
+    segments = np.stack([padded[idx + delay[c], c] for c in range(channels)]) * win
+
+    t = np.arange(size) / fs
+    responses = np.empty((channels, harmonics, len(frequency)), dtype=complex)
+    for k in range(1, harmonics + 1):
+        basis = np.exp(-2j * np.pi * k * frequency[:,np.newaxis] * t)
+        Y = np.einsum('csm,sm->cs', segments, basis)
+        if k == 1:
+            X = np.einsum('sm,sm->s', reference, basis)
+            responses[:,0] = Y / X
+        else:
+            responses[:,k-1] = Y / np.abs(X)
+    # Latency was removed with the segment offsets
+    levels = np.abs(responses[:,1:]) / (np.abs(responses[:,:1]) + np.finfo(float).tiny)
+    # With less than two periods the second harmonic is inside the main lobe
+    valid = np.arange(2, harmonics + 1)[:,np.newaxis] * frequency <= min(f2, fs / 2)
+    levels = np.where(valid & (periods >= 2), levels, np.nan)
+    linear = responses[:,0]
+
+    return {
+        'Frequency': frequency,
+        'Magnitude': 20 * np.log10(np.abs(linear) + np.finfo(float).tiny),
+        'Phase': np.degrees(np.angle(linear)),
+        'Harmonics': 20 * np.log10(levels + np.finfo(float).tiny),
+        'THD': np.sqrt(np.nansum(levels**2, axis=1)) * 100,
+        'Delay': delay / fs,
+    }
+
+
+def analyzeMeasurement(kind, captured, fs, f1, f2, duration, amplitude=1.0,
+                       fullScale=2**31, pointsPerOctave=6, harmonics=HARMONICS):
+
+    if kind == SWEEP_CHIRP:
+        return analyzeChirp(captured, fs, f1, f2, duration, amplitude, fullScale, harmonics)
+    elif kind == SWEEP_STEPPED:
+        return analyzeSteps(captured, fs, f1, f2, duration, amplitude, fullScale,
+                            pointsPerOctave, harmonics)
+    else:
+        raise ValueError("Unknown excitation {}".format(kind))
@@ -0,0 +1,96 @@
+import numpy as np
+from audioAnalysis import SpectrumProcessor, SpectrumAverager, rfft
+
+
+class TransferAnalyzer(SpectrumProcessor):
+    """
+    Cross spectral analysis of every channel against a reference channel.
+
+    All channels are transformed in one batched FFT. The power spectra of
+    every channel and the cross spectra with the reference are averaged
+    together, so the transfer function is the H1 estimate
+    Sxy / Sxx and the coherence |Sxy|**2 / (Sxx * Syy), which both come out
+    unbiased by uncorrelated noise on the measured channel.
+    """
+
+    def __init__(self, blockSize, fs, window='Hann', averaging=1, aveMode='linear', beta=5,
+                 fullScale=1.0, overlap=0, channels=2, reference=0):
+
+        super(TransferAnalyzer, self).__init__(blockSize, fs, window, averaging, aveMode, beta,
+                                               fullScale, overlap, channels)
+        self.reference = reference
+        # Power spectra, and real and imaginary cross spectra, as rows
+        self.averager = SpectrumAverager((3 * channels, self.bins), averaging, aveMode)
+
+    def crossSpectra(self, transformed):
+
+        ref = transformed[...,self.reference:self.reference+1,:]
+        cross = transformed * np.conj(ref)
+        power = transformed.real**2 + transformed.imag**2
+
+        return np.concatenate((power, cross.real, cross.imag), axis=-2)
+
+    def spectrum(self, block):
+
+        return self.crossSpectra(self.transform(block))
+
+    def spectra(self, segments):
+
+        return self.crossSpectra(rfft(segments * self.win, axis=-1))
+
+    def peakSpectrum(self):
+
+        power = np.max(self.unaveraged, axis=0)[:self.channels]
+
+        return np.sqrt(power) * self.scale
+
+    def process(self, block, continuous=True):
+        """
+        Averages the block in and returns a dict with the amplitude Spectra
+        of every channel as with SpectrumProcessor, and the transfer
+        function Magnitude in dB, its Phase in degrees and the Coherence of
+        every channel relative to the reference, all with channels in rows.
+        """
+
+        average = super(TransferAnalyzer, self).process(block, continuous)
+        if average is None:
+            return None
+
+        c = self.channels
+        tiny = np.finfo(float).tiny
+        power = average[:c]
+        cross = average[c:2*c] + 1j * average[2*c:]
+        refPower = power[self.reference] + tiny
+        transfer = cross / refPower
+
+        return {
+            'Spectra': np.sqrt(power) * self.scale,
+            'Magnitude': 20 * np.log10(np.abs(transfer) + tiny),
+            'Phase': np.degrees(np.angle(transfer)),
+            'Coherence': np.abs(cross)**2 / (power * refPower + tiny),
+        }
+
+
+def crosstalk(spectra, fs, enbw=1.5, frequency=None, driven=None, width=None):
+    """
+    Level of every channel at the test frequency relative to the driven
+    channel in dB, from amplitude spectra with channels in rows. The driven
+    channel is the loudest one and the frequency its largest peak unless
+    given. The power is summed over the main lobe of the window.
+    """
+
+    bins = spectra.shape[-1]
+    df = fs / (2 * (bins - 1))
+    if width is None:
+        width = int(np.ceil(2 * enbw))
+    if driven is None:
+        driven = int(np.argmax(spectra[:,1:].max(axis=1)))
+    if frequency is None:
+        k = 1 + int(np.argmax(spectra[driven,1:]))
+    else:
+        k = int(round(frequency / df))
+    lo = max(k - width, 0)
+    hi = min(k + width + 1, bins)
+    power = np.sum(spectra[:,lo:hi].astype(np.float64)**2, axis=1) + np.finfo(float).tiny
+
+    return 10 * np.log10(power / power[driven])
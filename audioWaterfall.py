@@ -0,0 +1,82 @@
+import numpy as np
+
+# dB relative to full scale of empty rows, and the bottom of the colour scale
+FLOOR = -140.0
+
+
+class Waterfall:
+    """
+    Rolling spectrogram of the last rows spectra, for transients that an
+    average hides.
+
+    Rows are kept in a preallocated float32 ring twice as tall as shown.
+    Every row is written twice, rows apart, so the last rows are always
+    one contiguous view in time order and nothing is ever shifted. The
+    columns are spaced evenly on a log or linear frequency axis between
+    fmin and fmax, each holding the largest bin it covers, and
+    timeDecimation spectra are merged into one row the same way, so clicks
+    and narrow spurs survive both reductions.
+    """
+
+    def __init__(self, frequencies, fmin, fmax, columns=1024, rows=256, log=True,
+                 timeDecimation=1):
+
+        frequencies = np.asarray(frequencies)
+        if log:
+            # The first bin above 0 Hz, a log axis can not start at 0
+            fmin = max(fmin, frequencies[frequencies > 0][0])
+            self.edges = np.geomspace(fmin, fmax, columns + 1)
+        else:
+            self.edges = np.linspace(fmin, fmax, columns + 1)
+        # Columns without a bin of their own repeat the bin at their start
+        self.starts = np.searchsorted(frequencies, self.edges[:-1]).clip(0, len(frequencies) - 1)
+        self.stop = max(int(np.searchsorted(frequencies, fmax, 'right')), int(self.starts[-1]) + 1)
+        self.log = log
+        self.columns = columns
+        self.rows = rows
+        self.timeDecimation = max(int(timeDecimation), 1)
+
+        self.buffer = np.full((2 * rows, columns), FLOOR, dtype=np.float32)
+        self.peak = np.zeros(columns, dtype=np.float32)
+        self.pending = 0
+        self.pos = 0
+        self.count = 0      # Rows completed so far
+
+    def column(self, frequency):
+        # Column coordinate of a frequency, for placing ticks
+
+        if self.log:
+            edges, frequency = np.log(self.edges), np.log(frequency)
+        else:
+            edges = self.edges
+
+        return (frequency - edges[0]) / (edges[-1] - edges[0]) * self.columns
+
+    def add(self, spectrum):
+        """
+        Adds an amplitude spectrum relative to full scale. Returns True
+        when a row was completed.
+        """
+
+        np.maximum(self.peak, np.maximum.reduceat(spectrum[:self.stop], self.starts),
+                   out=self.peak)
+        self.pending += 1
+        if self.pending < self.timeDecimation:
+            return False
+
+        row = self.buffer[self.pos]
+        np.log10(self.peak + np.finfo(np.float32).tiny, out=row)
+        row *= 20
+        np.maximum(row, FLOOR, out=row)
+        self.buffer[self.pos + self.rows] = row
+        self.pos = (self.pos + 1) % self.rows
+        self.count += 1
+        self.peak.fill(0)
+        self.pending = 0
+
+        return True
+
+    def image(self):
+        # The last rows, oldest first, as a view into the ring
+
+        return self.buffer[self.pos:self.pos + self.rows]
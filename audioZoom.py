@@ -0,0 +1,189 @@
+import time
+import functools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from audioAnalysis import SpectrumAverager, getWindow, windowGains, fftpack, FFTARGS, deinterleave
+from audioDistortion import interpolatePeak
+
+# Filter taps per polyphase branch, the filter is this many times the
+# decimation factor long
+TAPSPERPHASE = 32
+
+# Fraction of the decimated band that is shown, the rest is the transition
+# band of the filter where aliases are not yet suppressed
+USABLE = 0.8
+
+
+@functools.lru_cache(maxsize=8)
+def decimationFilter(decimation, tapsPerPhase=TAPSPERPHASE, beta=8.0):
+    """
+    Kaiser windowed sinc low pass for decimation by the given factor, as
+    a (tapsPerPhase, decimation) array of polyphase branches of the time
+    reversed filter. Unity gain at DC, cut off halfway between the usable
+    band and the new Nyquist frequency.
+    """
+
+    length = tapsPerPhase * decimation
+    cutoff = (1 + USABLE) / 4 / decimation
+    n = np.arange(length) - (length - 1) / 2
+    h = np.sinc(2 * cutoff * n) * np.kaiser(length, beta)
+    h /= h.sum()
+    branches = h[::-1].reshape(tapsPerPhase, decimation).copy()
+    branches.flags.writeable = False
+
+    return branches
+
+
+class ZoomProcessor:
+    """
+    High resolution spectrum of a narrow band around center.
+
+    Every block is mixed down by center with a phase that runs on from
+    block to block, then low pass filtered and decimated in one step by a
+    polyphase filter that only computes the kept outputs. The decimated
+    complex samples are collected into segments of size, which are
+    windowed, transformed and averaged as in SpectrumProcessor. The
+    resolution is that of a full band FFT decimation times longer, at a
+    fraction of the cost per block, and the filter history and the mixer
+    phase are carried over between blocks.
+
+    Spectra are amplitude spectra relative to fullScale of the usable
+    part of the band, channels in rows for several channels.
+    """
+
+    def __init__(self, fs, center, decimation=64, size=4096, window='Hann', averaging=1,
+                 aveMode='linear', beta=5, fullScale=1.0, overlap=0, channels=1):
+
+        self.fs = fs
+        self.center = center
+        self.decimation = decimation
+        self.size = size
+        self.channels = channels
+        self.overlap = overlap
+        self.hop = max(int(round(size * (1 - overlap))), 1)
+        self.branches = decimationFilter(decimation)
+        self.win = getWindow(window, size, beta)
+        coherentGain, self.enbw = windowGains(window, size, beta)
+        # A real sine splits into two halves, only one is in the band
+        self.scale = 2 / (size * coherentGain * fullScale)
+
+        # Bins of the fftshifted spectrum inside the usable band
+        half = int(USABLE * size / 2)
+        self.first = size // 2 - half
+        self.bins = 2 * half + 1
+        self.averager = SpectrumAverager((channels, self.bins), averaging, aveMode)
+        self.mixers = {}
+        self.unaveraged = np.zeros((1, channels, self.bins))
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+
+        self.phase = 0.0
+        # Real and imaginary parts of every channel as separate real rows
+        self.history = np.zeros((2 * self.channels, 0))
+        self.baseband = np.zeros((self.channels, 0), dtype=complex)
+
+    def frequencies(self):
+
+        df = self.fs / (self.decimation * self.size)
+
+        return self.center + (np.arange(self.bins) - self.bins // 2) * df
+
+    def mixer(self, n):
+        # cos(w k) and -sin(w k) for k up to n, the running phase is applied on top
+        mixer = self.mixers.get(n)
+        if mixer is None:
+            mixer = np.exp(-2j * np.pi * self.center / self.fs * np.arange(n))
+            mixer = self.mixers[n] = (mixer.real.copy(), mixer.imag.copy())
+
+        return mixer
+
+    def decimate(self, block):
+        # Mixed and decimated samples of the block, channels in rows
+        block = deinterleave(block, self.channels).T
+        c = self.channels
+        n = block.shape[-1]
+        cos, sin = self.mixer(n)
+        rotation = np.exp(-1j * self.phase)
+        self.phase = (self.phase + 2 * np.pi * self.center / self.fs * n) % (2 * np.pi)
+
+        # The filter is real, so the real and imaginary parts are filtered
+        # as real rows, which keeps the products real as well
+        samples = np.empty((2 * c, self.history.shape[-1] + n))
+        samples[:, :self.history.shape[-1]] = self.history
+        mixed = samples[:, self.history.shape[-1]:]
+        np.multiply(block, rotation.real * cos - rotation.imag * sin, out=mixed[:c])
+        np.multiply(block, rotation.real * sin + rotation.imag * cos, out=mixed[c:])
+
+        taps, d = self.branches.shape
+        rows = samples.shape[-1] // d
+        count = rows - taps + 1
+        if count <= 0:
+            self.history = samples
+            return np.zeros((c, 0), dtype=complex)
+
+        # Output m is the sum over branches q of rows m + q times branch q
+        frames = samples[:, :rows * d].reshape(2 * c, rows, d)
+        out = frames[:, :count] @ self.branches[0]
+        for q in range(1, taps):
+            out += frames[:, q:q + count] @ self.branches[q]
+        self.history = samples[:, count * d:]
+
+        return out[:c] + 1j * out[c:]
+
+    def process(self, block, continuous=True):
+        """
+        Averaged spectrum including this block, as a new array, or None
+        while not even one segment has been collected. continuous must be
+        False when samples were lost since the previous block.
+        """
+
+        start = time.perf_counter()
+        if not continuous:
+            self.reset()
+        baseband = np.concatenate((self.baseband, self.decimate(block)), axis=-1)
+        decimated = time.perf_counter()
+        n = baseband.shape[-1]
+        count = (n - self.size) // self.hop + 1 if n >= self.size else 0
+        self.baseband = baseband[:, count * self.hop:]
+        if count == 0:
+            return None
+
+        segments = sliding_window_view(baseband, self.size, axis=-1)[:, :count * self.hop:self.hop]
+        spectra = np.abs(fftpack.fft(segments * self.win, axis=-1, **FFTARGS))
+        spectra = np.fft.fftshift(spectra, axes=-1)[..., self.first:self.first + self.bins]
+        spectra *= self.scale
+        transformed = time.perf_counter()
+        self.unaveraged = spectra.swapaxes(0, 1)
+        average = self.averager.addMany(self.unaveraged)
+
+        if self.stats is not None:
+            self.stats.add('decimation', decimated - start)
+            self.stats.add('fft', transformed - decimated)
+            self.stats.add('averaging', time.perf_counter() - transformed)
+
+        if self.channels == 1:
+            return average[0]
+
+        return average
+
+    def peakSpectrum(self):
+        # Largest of the spectra of the last call before averaging
+
+        spectrum = np.max(self.unaveraged, axis=0)
+        if self.channels == 1:
+            return spectrum[0]
+
+        return spectrum
+
+    def peak(self, spectrum):
+        # Interpolated frequency and amplitude of the largest peak
+
+        k = int(np.argmax(spectrum))
+        df = self.fs / (self.decimation * self.size)
+
+        return {
+            'Fundamental': self.center + (interpolatePeak(spectrum, k) - self.bins // 2) * df,
+            'Amplitude': spectrum[k],
+        }
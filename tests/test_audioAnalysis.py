@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from audioAnalysis import SpectrumAverager
+
+
+@pytest.mark.parametrize('shape', [64, (2, 64)])
+def testLinearIsMeanOfLastCount(shape):
+
+    rng = np.random.default_rng(2)
+    spectra = rng.random((40,) + np.shape(np.zeros(shape))).astype(np.float32)
+    averager = SpectrumAverager(shape, 8)
+    for i, spectrum in enumerate(spectra):
+        average = averager.add(spectrum)
+        expected = spectra[max(i - 7, 0):i + 1].mean(axis=0)
+        np.testing.assert_allclose(average, expected, rtol=1e-5)
+
+
+def testExponential():
+
+    rng = np.random.default_rng(3)
+    spectra = rng.random((40, 64))
+    averager = SpectrumAverager(64, 8, 'exponential')
+    expected = np.zeros(64)
+    for i, spectrum in enumerate(spectra):
+        # Plain mean for the first count spectra, then a factor of 1/count
+        expected += (spectrum - expected) / min(i + 1, 8)
+        np.testing.assert_allclose(averager.add(spectrum), expected)
+    assert averager.history is None
+
+
+def testAddManyAndConfigure():
+
+    spectra = np.arange(5 * 4, dtype=np.float64).reshape(5, 4)
+    averager = SpectrumAverager(4, 3)
+    np.testing.assert_allclose(averager.addMany(spectra), spectra[2:].mean(axis=0))
+
+    averager.configure(mode='exponential')
+    np.testing.assert_allclose(averager.add(spectra[0]), spectra[0])
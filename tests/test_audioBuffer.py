@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from audioBuffer import BlockRing
+
+
+def blocks(first, count, blockLen):
+    # Blocks numbered by their first sample
+    return np.arange(first * blockLen, (first + count) * blockLen, dtype=np.int32)
+
+
+def testBlocksInOrder():
+
+    ring = BlockRing(16, 8)
+    # Writes that do not line up with the blocks
+    data = blocks(0, 5, 16)
+    for chunk in np.array_split(data, 7):
+        ring.write(chunk)
+
+    for seq in range(5):
+        res = ring.read()
+        assert res is not None
+        assert res[0] == seq and res[1] == 0
+        np.testing.assert_array_equal(res[3], blocks(seq, 1, 16))
+    assert ring.read() is None
+
+
+def testPartialBlockNotReady():
+
+    ring = BlockRing(16, 8)
+    ring.write(blocks(0, 1, 16)[:10])
+    assert ring.available() == 0 and ring.read() is None
+    ring.write(blocks(0, 1, 16)[10:])
+    assert ring.available() == 1
+
+
+def testOverrunsCounted():
+
+    ring = BlockRing(16, 8)
+    ring.write(blocks(0, 13, 16))
+
+    # One slot of margin is kept, so 13 - 8 + 1 blocks are lost
+    seq, overruns, timestamp, data = ring.read()
+    assert (seq, overruns) == (6, 6)
+    np.testing.assert_array_equal(data, blocks(6, 1, 16))
+    seqs = [ring.read()[0] for i in range(ring.available())]
+    assert seqs == list(range(7, 13))
+    assert ring.overruns == 6
+
+
+def testDiscardIsNotAnOverrun():
+
+    ring = BlockRing(16, 8)
+    ring.write(blocks(0, 5, 16))
+    ring.discard()
+    seq, overruns, timestamp, data = ring.read()
+    assert (seq, overruns) == (4, 0)
+
+
+def testReset():
+
+    ring = BlockRing(16, 8)
+    ring.write(blocks(0, 12, 16))
+    ring.read()
+    ring.reset(32)
+    assert (ring.blockLen, ring.overruns, ring.available()) == (32, 0, 0)
+    ring.write(blocks(0, 1, 32))
+    assert ring.read()[0] == 0
+
+    with pytest.raises(ValueError):
+        ring.reset(0)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from audioAnalysis import SpectrumProcessor
+from audioDistortion import analyzeDistortion
+
+FS = 48000
+N = 8192
+
+
+def analyze(frequency, harmonics, window='Blackman', fundamental=None):
+    # Amplitude 0.5 of full scale, harmonics relative to the fundamental
+    t = np.arange(N) / FS
+    x = 0.5 * np.sin(2 * np.pi * frequency * t)
+    for order, level in enumerate(harmonics, 2):
+        x += 0.5 * level * np.sin(2 * np.pi * order * frequency * t + 0.3)
+    x += np.random.default_rng(4).normal(0, 1e-6, N)
+    processor = SpectrumProcessor(N, FS, window)
+
+    return analyzeDistortion(processor.process(x), FS, processor.enbw, fundamental)
+
+
+@pytest.mark.parametrize('frequency', [1000, 997.3])
+@pytest.mark.parametrize('harmonics', [[0.01], [0.006, 0.008]])
+def testKnownThd(frequency, harmonics):
+
+    res = analyze(frequency, harmonics)
+
+    assert res['THD'] == pytest.approx(1.0, abs=0.005)
+    assert res['THD+N'] == pytest.approx(1.0, abs=0.005)
+    assert res['Amplitude'] == pytest.approx(0.5, rel=1e-3)
+    assert res['Fundamental'] == pytest.approx(frequency, abs=0.1)
+    assert res['Harmonics'][0,0] == pytest.approx(2 * frequency, abs=0.2)
+
+
+def testPureTone():
+
+    res = analyze(1000, [], 'Hann')
+    assert res['THD'] < 1e-3
+    assert res['SNR'] > 100
+
+
+def testGivenFundamentalOutsideBand():
+
+    # Clamped into the band instead of failing
+    res = analyze(1000, [0.01], fundamental=1)
+    assert np.isfinite(res['Fundamental'])
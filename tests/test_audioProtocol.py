@@ -0,0 +1,85 @@
+import itertools
+import numpy as np
+import pytest
+import audioProtocol as proto
+
+FLAGS = [sum(c) for n in range(4)
+         for c in itertools.combinations((proto.FLAG_ZLIB, proto.FLAG_DELTA, proto.FLAG_SHUFFLE), n)]
+
+
+def roundTrip(data, flags, channels=1, frameType=proto.FRAME_DATA):
+
+    payload = proto.encodePayload(data, flags, channels)
+    frame = proto.packDataHeader(data, 48000, seq=7, overruns=2, timestamp=1.5,
+                                 channels=channels, frameType=frameType, flags=flags,
+                                 length=len(payload)) + payload
+    parser = proto.FrameParser()
+    # Byte by byte, as from a reader that gets partial frames
+    for i in range(len(frame)):
+        parser.feed(frame[i:i + 1])
+    frames = list(parser)
+    assert len(frames) == 1
+    header, received = frames[0]
+    assert (header.seq, header.overruns, header.timestamp) == (7, 2, 1.5)
+    assert header.sampleRate == 48000 and header.flags == flags
+
+    return proto.decodePayload(header, received)
+
+
+@pytest.mark.parametrize('flags', FLAGS)
+@pytest.mark.parametrize('dtype', [np.int16, np.int32, np.float32])
+@pytest.mark.parametrize('channels', [1, 2])
+def testPayloadRoundTrip(flags, dtype, channels):
+
+    if flags & proto.FLAG_DELTA and np.dtype(dtype).kind == 'f':
+        pytest.skip("Delta coding is only for integer samples")
+    rng = np.random.default_rng(1)
+    if np.dtype(dtype).kind == 'i':
+        info = np.iinfo(dtype)
+        data = rng.integers(info.min, info.max, 1024 * channels, dtype=dtype, endpoint=True)
+        # Differences that wrap around
+        data[:4] = [info.max, info.min, info.max, info.min]
+    else:
+        data = rng.standard_normal(1024 * channels).astype(dtype)
+
+    decoded = roundTrip(data, flags, channels)
+
+    assert decoded.dtype == np.dtype(dtype)
+    if channels > 1:
+        assert decoded.shape == (1024, channels)
+    np.testing.assert_array_equal(decoded.reshape(-1), data)
+
+
+def testCompressionShrinksSmoothSignal():
+
+    data = np.rint(1e6 * np.sin(np.arange(4096) / 50)).astype(np.int32)
+    flags = proto.FLAG_ZLIB | proto.FLAG_DELTA | proto.FLAG_SHUFFLE
+    assert len(proto.encodePayload(data, flags)) < data.nbytes / 2
+    np.testing.assert_array_equal(roundTrip(data, flags), data)
+
+
+def testCommandRoundTrip():
+
+    parser = proto.FrameParser()
+    parser.feed(proto.packCommand('measure', 1, 20, 20000, 2.0))
+    parser.feed(proto.packCommand('startSend'))
+    commands = [proto.unpackCommand(payload) for header, payload in parser]
+
+    assert commands == [('measure', (1.0, 20.0, 20000.0, 2.0)), ('startSend', (0.0,))]
+
+
+def testJsonFrame():
+
+    content = {'fs': 96000, 'error': None}
+    data = np.frombuffer(b'{"fs": 96000, "error": null}', dtype=np.uint8)
+    header = proto.unpackHeader(proto.packDataHeader(data, frameType=proto.FRAME_CONFIG))
+
+    assert proto.decodePayload(header, data.tobytes()) == content
+
+
+def testBadMagic():
+
+    frame = bytearray(proto.packHeader(proto.FRAME_DATA, 0))
+    frame[0:2] = b'XX'
+    with pytest.raises(RuntimeError):
+        proto.unpackHeader(bytes(frame))
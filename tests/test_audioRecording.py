@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import audioProtocol as proto
+from audioRecording import Recorder, ReplaySocket
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+def testRecordAndReplay(tmp_path, channels):
+
+    path = str(tmp_path / 'capture.npy')
+    rng = np.random.default_rng(5)
+    shape = (256, channels) if channels > 1 else (256,)
+    blocks = [rng.integers(-2**31, 2**31, shape, dtype=np.int32) for i in range(100)]
+    # A gap of two blocks after the tenth
+    seqs = list(range(10)) + list(range(12, 102))
+
+    recorder = Recorder(path)
+    for seq, block in zip(seqs, blocks):
+        header = proto.FrameHeader(proto.FRAME_DATA, block.nbytes, block.dtype, channels, 0,
+                                   48000, seq, seq // 10, 0.01 * seq)
+        assert recorder.write(block, header)
+    # A block of another size is refused
+    assert not recorder.write(np.zeros(128, dtype=np.int32), header)
+    recorder.close()
+
+    replay = ReplaySocket(path, realtime=False)
+    replayed = [np.array(block) for block in replay.streamData()]
+
+    assert len(replayed) == len(blocks)
+    for block, original in zip(replayed, blocks):
+        np.testing.assert_array_equal(block, original)
+    assert replay.lostBlocks == 2
+    assert replay.header.seq == 101 and replay.header.overruns == 10
+    assert replay.header.sampleRate == 48000